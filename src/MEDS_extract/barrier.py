@@ -0,0 +1,204 @@
+"""Completion markers and a notifying barrier for workers sharing a filesystem.
+
+A worker that finishes writing an output calls ``mark_done`` to atomically drop a small JSON marker next to
+it, recording the output's size and modification time. Another worker (e.g., a reducer) calls
+``wait_until_done`` to block until every output it needs has a marker that still matches it, so outputs that
+are still being written, or that were deleted or rewritten since they were marked (as with ``do_overwrite``),
+never count as done.
+
+Rather than sleeping for a fixed interval between checks, the barrier sleeps on an inotify watch of the marker
+directories where that is available (on Linux), so it wakes the moment a marker lands. As inotify does not see
+writes made by other hosts on network filesystems, and is not available everywhere, it is backed by an
+exponential backoff between re-checks, up to a maximum interval.
+"""
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import sys
+import time
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+MARKER_SUFFIX = ".done"
+
+# inotify event masks, from <sys/inotify.h>.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+
+
+def marker_fp(out_fp: Path, marker_dir: Path) -> Path:
+    """Returns the path of the completion marker of ``out_fp`` in ``marker_dir``.
+
+    Examples:
+        >>> marker_fp(Path("out/labs_0.parquet"), Path("out/.done"))
+        PosixPath('out/.done/labs_0.parquet.done')
+    """
+    return marker_dir / f"{out_fp.name}{MARKER_SUFFIX}"
+
+
+def mark_done(out_fp: Path, marker_dir: Path):
+    """Atomically writes the completion marker of the (complete) output ``out_fp`` to ``marker_dir``.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "out.parquet"
+        ...     _ = out_fp.write_text("data")
+        ...     mark_done(out_fp, Path(tmpdir) / ".done")
+        ...     print(is_done(out_fp, Path(tmpdir) / ".done"))
+        ...     _ = out_fp.write_text("new data")
+        ...     print(is_done(out_fp, Path(tmpdir) / ".done"))
+        True
+        False
+    """
+    stat = out_fp.stat()
+    marker = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "pid": os.getpid()}
+
+    marker_dir.mkdir(parents=True, exist_ok=True)
+    fp = marker_fp(out_fp, marker_dir)
+    tmp_fp = fp.with_name(f".{fp.name}.{os.getpid()}.tmp")
+    tmp_fp.write_text(json.dumps(marker))
+    os.replace(tmp_fp, fp)
+
+
+def is_done(out_fp: Path, marker_dir: Path) -> bool:
+    """Returns whether ``out_fp`` has a completion marker that matches its current size and modification time.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     print(is_done(Path(tmpdir) / "out.parquet", Path(tmpdir) / ".done"))
+        False
+    """
+    try:
+        marker = json.loads(marker_fp(out_fp, marker_dir).read_text())
+        stat = out_fp.stat()
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return marker.get("size") == stat.st_size and marker.get("mtime_ns") == stat.st_mtime_ns
+
+
+class _DirectoryWatch:
+    """An inotify watch for files being created in or moved into a set of directories (Linux only)."""
+
+    def __init__(self, dirs: Sequence[Path]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        try:
+            for d in dirs:
+                mask = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+                if libc.inotify_add_watch(self.fd, os.fsencode(d), mask) < 0:
+                    raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {d}")
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+    def wait(self, timeout: float):
+        """Blocks until some watched event happens or ``timeout`` seconds pass, then drains pending events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+@contextmanager
+def _watch(dirs: Sequence[Path]) -> Iterator[_DirectoryWatch | None]:
+    """Yields an inotify watch of ``dirs``, or ``None`` if inotify is not available here."""
+    watch = None
+    if sys.platform.startswith("linux"):
+        try:
+            watch = _DirectoryWatch(dirs)
+        except (OSError, AttributeError) as e:
+            logger.debug(f"inotify is not available ({e}); polling instead.")
+    try:
+        yield watch
+    finally:
+        if watch is not None:
+            watch.close()
+
+
+def wait_until_done(
+    out_fps: Sequence[Path],
+    marker_dir: Path,
+    max_interval: float = 60,
+    initial_interval: float = 0.05,
+    timeout: float | None = None,
+):
+    """Blocks until every output in ``out_fps`` is done (see ``is_done``).
+
+    Args:
+        out_fps: The outputs to wait for.
+        marker_dir: The directory of their completion markers.
+        max_interval: The longest time (in seconds) to go between checks.
+        initial_interval: The time (in seconds) to go before the first re-check; this doubles after every
+            check, up to ``max_interval``. Where inotify is available, a check is also made the moment a
+            marker lands.
+        timeout: If set, the time (in seconds) after which to give up.
+
+    Raises:
+        TimeoutError: If ``timeout`` passes before all outputs are done.
+
+    Examples:
+        >>> import threading
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fps = [Path(tmpdir) / f"{i}.parquet" for i in range(3)]
+        ...     marker_dir = Path(tmpdir) / ".done"
+        ...     def write(fp):
+        ...         time.sleep(0.1)
+        ...         _ = fp.write_text("data")
+        ...         mark_done(fp, marker_dir)
+        ...     threads = [threading.Thread(target=write, args=(fp,)) for fp in out_fps]
+        ...     for thread in threads:
+        ...         thread.start()
+        ...     wait_until_done(out_fps, marker_dir, max_interval=10)
+        ...     print(all(is_done(fp, marker_dir) for fp in out_fps))
+        ...     for thread in threads:
+        ...         thread.join()
+        True
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     wait_until_done([Path(tmpdir) / "missing.parquet"], Path(tmpdir) / ".done", timeout=0.2)
+        Traceback (most recent call last):
+            ...
+        TimeoutError: Timed out after 0.2s waiting for 1 outputs, e.g. .../missing.parquet
+    """
+    marker_dir.mkdir(parents=True, exist_ok=True)
+    start = time.monotonic()
+    interval = initial_interval
+
+    with _watch([marker_dir]) as watch:
+        while True:
+            # The watch is set up before checking, so a marker that lands after the check still wakes us.
+            missing = [fp for fp in out_fps if not is_done(fp, marker_dir)]
+            if not missing:
+                return
+
+            elapsed = time.monotonic() - start
+            if timeout is not None and elapsed >= timeout:
+                raise TimeoutError(
+                    f"Timed out after {timeout}s waiting for {len(missing)} outputs, e.g. {missing[0]}"
+                )
+            logger.debug(f"Waiting on {len(missing)} outputs, e.g. {missing[0]}")
+
+            wait = min(interval, max_interval)
+            if timeout is not None:
+                wait = min(wait, timeout - elapsed)
+            if watch is None:
+                time.sleep(wait)
+            else:
+                watch.wait(wait)
+            interval = min(interval * 2, max_interval)
@@ -5,54 +5,37 @@ string interpolation uses f-strings (e.g., ``f"CODE//{$col}"``), type casts use
 (e.g., ``$ts::"%Y-%m-%d"``), and bare quoted strings are literals (e.g., ``"ADMISSION"``).
 """
 
-import copy
 import json
 import logging
-import random
-from collections.abc import Callable, Sequence
+import shutil
+from collections.abc import Sequence
 from functools import partial
 from pathlib import Path
 
 import polars as pl
-from dftly import Parser
 from MEDS_transforms.dataframe import write_df
 from MEDS_transforms.mapreduce.rwlock import rwlock_wrap
 from MEDS_transforms.stages import Stage
 from omegaconf import DictConfig, OmegaConf
 from upath import UPath
 
-from ..dftly_bridge import EVENT_META_KEYS, compile_subject_id_expr
+from ..dedup import dedup_per_block, get_dedup_strategy
+from ..dftly_bridge import EVENT_META_KEYS
+from ..plan import EventPlan, PrefixPlan, compile_event, get_extraction_plan
+from ..shared_state import load_event_conversion_cfg, load_shards_map
+from ..task_queue import run_tasks
 
 logger = logging.getLogger(__name__)
 
-pl.enable_string_cache()
-
-
-def _null_safe_code_expr(code_node) -> pl.Expr:
-    """Compile a composite ``code`` so each null component renders as the literal ``"UNK"``.
-
-    dftly string interpolation null-propagates, so a null in any referenced component would make
-    the whole ``code`` null (which MEDS forbids). This rebuilds the interpolation from the dftly
-    node's ordered pieces, casting each to a string and filling nulls with ``"UNK"`` — restoring
-    the pre-dftly ``pl.col(c).cast(pl.Utf8).fill_null("UNK")`` behaviour (including non-string
-    columns, which are cast to their string form). It is scoped to the code expression, so
-    ``code_components`` keeps the raw, typed values. See issue #109.
-    """
-    if type(code_node).__name__ == "StringInterpolate":
-        template = code_node.args[0].args[0]  # e.g. "LAB//{}//{}"
-        pieces = [arg.polars_expr for arg in code_node.args[1:]]
-        if isinstance(template, str) and template.count("{}") == len(pieces):
-            filled = [p.cast(pl.Utf8, strict=False).fill_null(pl.lit("UNK")) for p in pieces]
-            return pl.format(template, *filled)
-    # Unexpected node shape: at least guarantee the whole code is never null.
-    return code_node.polars_expr.cast(pl.Utf8, strict=False).fill_null(pl.lit("UNK"))
-
 
 def extract_event(
     df: pl.LazyFrame,
-    event_cfg: dict[str, str | None],
+    event_cfg: dict[str, str | None] | EventPlan,
     do_dedup_text_and_numeric: bool = False,
     source_block: str | None = None,
+    schema: pl.Schema | None = None,
+    distinct_eval: str = "never",
+    unique_rows: bool = True,
 ) -> pl.LazyFrame:
     """Extracts a single event dataframe from the raw data using dftly expressions.
 
@@ -64,15 +47,24 @@ def extract_event(
         df: The raw data DataFrame with a ``"subject_id"`` column.
         event_cfg: Event configuration dict. Must contain ``"code"`` and ``"time"`` keys.
             ``"time"`` may be ``None`` for static events. All other keys are treated as
-            additional output columns whose values are dftly expressions.
+            additional output columns whose values are dftly expressions. May also be an
+            already-compiled ``EventPlan`` (see ``MEDS_extract.plan.compile_event``).
         do_dedup_text_and_numeric: If true, nullify ``text_value`` when it equals ``numeric_value``.
         source_block: If provided, added as a ``source_block`` column tracking the MESSY config
             origin of each event (e.g., ``"patients/eye_color"``).
+        schema: The schema of ``df``, if already known. It is only collected from ``df`` if
+            needed and not given (or, for unpivoted blocks, from the unpivoted frame).
+        distinct_eval: How to evaluate the ``code`` and ``time`` expressions; one of ``"never"`` (once per
+            row), ``"always"`` (once per distinct tuple of their input columns), or ``"auto"`` (an opt-in
+            heuristic that samples ``df`` as the query is built, evaluating over distinct tuples only for
+            input columns with few distinct values). See ``with_distinct_columns``.
+        unique_rows: If false, duplicate events are kept, to be removed (if at all) when the events are merged
+            (see ``MEDS_extract.dedup``).
 
     Returns:
-        A deduplicated DataFrame with ``subject_id``, ``code``, ``time``, and any additional columns.
-        If the code expression references source columns, a ``code_components`` struct column is
-        included with the individual column values that compose the code.
+        A DataFrame, deduplicated unless ``unique_rows`` is false, with ``subject_id``, ``code``, ``time``,
+        and any additional columns. If the code expression references source columns, a ``code_components``
+        struct column is included with the individual column values that compose the code.
 
     Examples:
         >>> _ = pl.Config.set_tbl_width_chars(600)
@@ -171,75 +163,77 @@ def extract_event(
         │ 1          ┆ 2021-03-09 09:30:00 │
         │ 2          ┆ 2022-11-15 14:05:00 │
         └────────────┴─────────────────────┘
+
+        With ``distinct_eval``, the ``code`` and ``time`` expressions are evaluated once per distinct tuple of
+        the columns they read and joined back onto the rows, which yields the same events:
+
+        >>> raw = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2, 2],
+        ...     "lab": ["K", "K", "NA", None],
+        ...     "ts": ["2021-01-01", "2021-01-01", "2021-01-02", "2021-01-02"],
+        ...     "result": [4.1, 4.3, 140.0, 1.0],
+        ... })
+        >>> cfg = {"code": 'f"LAB//{$lab}"', "time": '$ts::"%Y-%m-%d"', "numeric_value": "$result"}
+        >>> extract_event(raw, cfg, distinct_eval="always").equals(extract_event(raw, cfg))
+        True
+
+        A wide table (one column per measurement) can be extracted by a single ``_unpivot`` block, which
+        unpivots the listed columns and exposes each column's name and value to the block's expressions
+        (as ``$variable`` and ``$value`` by default). Null values are dropped unless
+        ``drop_nulls: false`` is set:
+
+        >>> wide = pl.DataFrame({
+        ...     "subject_id": [1, 2],
+        ...     "charttime": ["2021-01-01", "2021-01-02"],
+        ...     "HR": [80.0, None],
+        ...     "SBP": [120.0, 110.0],
+        ... })
+        >>> extract_event(
+        ...     wide,
+        ...     {
+        ...         "_unpivot": {"columns": ["HR", "SBP"], "variable_name": "vital"},
+        ...         "code": 'f"VITAL//{$vital}"',
+        ...         "time": '$charttime::"%Y-%m-%d"',
+        ...         "numeric_value": "$value",
+        ...     },
+        ... ).sort("subject_id", "code")
+        shape: (3, 5)
+        ┌────────────┬────────────┬─────────────────┬────────────┬───────────────┐
+        │ subject_id ┆ code       ┆ code_components ┆ time       ┆ numeric_value │
+        │ ---        ┆ ---        ┆ ---             ┆ ---        ┆ ---           │
+        │ i64        ┆ str        ┆ struct[1]       ┆ date       ┆ f64           │
+        ╞════════════╪════════════╪═════════════════╪════════════╪═══════════════╡
+        │ 1          ┆ VITAL//HR  ┆ {"HR"}          ┆ 2021-01-01 ┆ 80.0          │
+        │ 1          ┆ VITAL//SBP ┆ {"SBP"}         ┆ 2021-01-01 ┆ 120.0         │
+        │ 2          ┆ VITAL//SBP ┆ {"SBP"}         ┆ 2021-01-02 ┆ 110.0         │
+        └────────────┴────────────┴─────────────────┴────────────┴───────────────┘
     """
-    event_cfg = copy.deepcopy(event_cfg)
-    event_exprs = {"subject_id": pl.col("subject_id")}
+    plan = event_cfg if isinstance(event_cfg, EventPlan) else compile_event(event_cfg)
 
-    if "code" not in event_cfg:
-        raise KeyError(
-            f"Event configuration dictionary must contain 'code' key. Got: [{', '.join(event_cfg.keys())}]."
-        )
-    if "time" not in event_cfg:
-        raise KeyError(
-            f"Event configuration dictionary must contain 'time' key. Got: [{', '.join(event_cfg.keys())}]."
-        )
+    if plan.unpivot is not None:
+        df = plan.source_frame(df)
+        schema = None
 
-    code_value = str(event_cfg.pop("code"))
-    code_node = Parser()(code_value)
-    code_cols = code_node.referenced_columns
-
-    # Null handling, restoring the pre-dftly behavior the dftly migration regressed (dftly string
-    # interpolation null-propagates, yielding a null ``code`` which MEDS forbids). See issue #109.
-    # A bare-column code (``code: $col``) is a bare identifier: drop the row when null. A composite
-    # code renders each null component as the literal "UNK" so a missing part (e.g. a unit) doesn't
-    # discard the whole event.
-    code_null_filter = None
-    if code_cols and type(code_node).__name__ == "Column":
-        (only_col,) = code_cols
-        code_null_filter = pl.col(only_col).is_not_null()
-        event_exprs["code"] = code_node.polars_expr
-    elif code_cols:
-        event_exprs["code"] = _null_safe_code_expr(code_node)
-    else:
-        event_exprs["code"] = code_node.polars_expr
+    if plan.needs_schema and schema is None:
+        schema = df.collect_schema()
+
+    # Apply null filters and select.
+    for row_filter in plan.row_filters(schema):
+        df = df.filter(row_filter)
 
-    # Store the individual (raw, typed) column values that compose the code as a struct.
-    if code_cols:
-        event_exprs["code_components"] = pl.struct(**{col: pl.col(col) for col in sorted(code_cols)})
+    df, (event_exprs,) = _with_computed_columns(df, [plan.exprs], distinct_eval, share=False)
+    return _select_event(df, event_exprs, do_dedup_text_and_numeric, source_block, unique_rows)
 
-    # Compile time field
-    ts_value = event_cfg.pop("time")
-    ts_null_filter = None
-    if ts_value is None:
-        event_exprs["time"] = pl.lit(None, dtype=pl.Datetime)
-    else:
-        ts_node = Parser()(str(ts_value))
-        event_exprs["time"] = ts_node.polars_expr
-        # Filter on source columns being non-null/non-empty rather than on the parsed expression,
-        # to avoid a polars predicate-pushdown bug where strptime(strict=True) is evaluated during
-        # parquet scanning before nulls are filtered (see polars issue with scan_parquet + filter).
-        ts_source_cols = ts_node.referenced_columns
-        if ts_source_cols:
-            schema = df.collect_schema()
-            ts_filters = []
-            for c in sorted(ts_source_cols):
-                col_filter = pl.col(c).is_not_null()
-                # The empty-string sentinel is only meaningful for string columns; a numeric
-                # source column has no "" and the `!= ""` comparison would crash (issue #120).
-                if schema.get(c) == pl.String or schema.get(c) is None:
-                    col_filter = col_filter & (pl.col(c) != pl.lit(""))
-                ts_filters.append(col_filter)
-            ts_null_filter = pl.all_horizontal(*ts_filters)
-        else:
-            ts_null_filter = event_exprs["time"].is_not_null()
-
-    # Compile remaining fields (value columns, etc.)
-    for k, v in event_cfg.items():
-        if k in EVENT_META_KEYS:
-            continue
-        if not isinstance(v, str):
-            raise ValueError(f"For event column {k}, value {v} must be a string. Got {type(v)}.")
-        event_exprs[k] = Parser.expr_to_polars(v)
+
+def _select_event(
+    df: pl.LazyFrame,
+    event_exprs: dict[str, pl.Expr],
+    do_dedup_text_and_numeric: bool,
+    source_block: str | None,
+    unique_rows: bool = True,
+) -> pl.LazyFrame:
+    """Projects an (already row-filtered) frame onto the (deduplicated) output columns of one event."""
+    event_exprs = dict(event_exprs)
 
     # Text/numeric dedup
     if do_dedup_text_and_numeric and "numeric_value" in event_exprs and "text_value" in event_exprs:
@@ -255,13 +249,331 @@ def extract_event(
     if source_block is not None:
         event_exprs["source_block"] = pl.lit(source_block)
 
-    # Apply null filters and select.
-    if code_null_filter is not None:
-        df = df.filter(code_null_filter)
-    if ts_null_filter is not None:
-        df = df.filter(ts_null_filter)
+    df = df.select(**event_exprs)
+    return df.unique(maintain_order=True) if unique_rows else df
+
+
+def _expr_key(expr: pl.Expr) -> bytes:
+    return expr.meta.serialize()
+
+
+def shared_subexpressions(event_exprs: Sequence[dict[str, pl.Expr]]) -> dict[bytes, pl.Expr]:
+    """Finds the output expressions that are computed identically by more than one event.
+
+    Bare column references and expressions that reference no columns (e.g., literals) are never reported,
+    as they are free to evaluate. Expressions are compared structurally, so two events that spell the same
+    parse independently in the MESSY config (e.g., ``$ts::"%Y-%m-%d"``) share it.
+
+    Args:
+        event_exprs: The output expressions of each event, keyed by output column name.
+
+    Returns:
+        The shared expressions, keyed by their serialized form, in order of first appearance.
+
+    Examples:
+        >>> events = [
+        ...     compile_event({"code": "ADMIT", "time": '$ts::"%Y-%m-%d"', "dept": "$dept"}).exprs,
+        ...     compile_event({"code": 'f"DEPT//{$dept}"', "time": '$ts::"%Y-%m-%d"'}).exprs,
+        ...     compile_event({"code": '$x + 1', "time": None, "numeric_value": "$x + 1"}).exprs,
+        ... ]
+        >>> [str(expr) for expr in shared_subexpressions(events).values()]
+        ['col("ts").str.strptime(["raise"])']
+    """
+    counts = {}
+    first = {}
+    for exprs in event_exprs:
+        seen = set()
+        for expr in exprs.values():
+            if expr.meta.is_column() or not expr.meta.root_names():
+                continue
+            key = _expr_key(expr)
+            if key in seen:
+                continue
+            seen.add(key)
+            counts[key] = counts.get(key, 0) + 1
+            first.setdefault(key, expr)
+    return {key: expr for key, expr in first.items() if counts[key] > 1}
+
+
+DISTINCT_EVAL_MODES = ("never", "always", "auto")
+DISTINCT_EVAL_COLUMNS = ("code", "time")
+
+
+def distinct_eval_candidates(event_exprs: Sequence[dict[str, pl.Expr]]) -> dict[bytes, pl.Expr]:
+    """Finds the ``code`` and ``time`` expressions that could be evaluated over distinct input values.
+
+    These are the expressions that carry the per-row string work of extraction (code interpolation and
+    timestamp parsing); bare column references and expressions that reference no columns are free to
+    evaluate and are never returned.
+
+    Args:
+        event_exprs: The output expressions of each event, keyed by output column name.
+
+    Returns:
+        The candidate expressions, keyed by their serialized form, in order of first appearance.
+
+    Examples:
+        >>> events = [
+        ...     compile_event({"code": 'f"LAB//{$name}"', "time": '$ts::"%Y-%m-%d"', "v": "$v"}).exprs,
+        ...     compile_event({"code": "$name", "time": '$ts::"%Y-%m-%d"'}).exprs,
+        ...     compile_event({"code": "BIRTH", "time": None}).exprs,
+        ... ]
+        >>> [str(expr) for expr in distinct_eval_candidates(events).values()]
+        ['...', 'col("ts").str.strptime(["raise"])']
+    """
+    candidates = {}
+    for exprs in event_exprs:
+        for col in DISTINCT_EVAL_COLUMNS:
+            expr = exprs.get(col)
+            if expr is None or expr.meta.is_column() or not expr.meta.root_names():
+                continue
+            candidates.setdefault(_expr_key(expr), expr)
+    return candidates
+
+
+def with_distinct_columns(
+    df: pl.LazyFrame,
+    exprs: dict[str, pl.Expr],
+    mode: str = "never",
+    max_distinct_ratio: float = 0.1,
+    sample_rows: int = 100_000,
+) -> pl.LazyFrame:
+    """Adds expressions as columns, evaluating each once per distinct tuple of the input columns it reads.
+
+    Expressions that read the same input columns are evaluated together over the distinct rows of those
+    columns, and the results are joined back onto ``df`` (in its row order, treating nulls as equal keys).
+    This replaces one evaluation per row with one per distinct value, which pays off when (as is typical for
+    codes and timestamps) values repeat heavily.
+
+    Args:
+        df: The frame to add the columns to.
+        exprs: The expressions to add, keyed by output column name.
+        mode: ``"never"`` (the default) simply adds the expressions with ``with_columns``; ``"always"``
+            evaluates every expression over distinct values; ``"auto"`` evaluates an input column set over its
+            distinct values if at most ``max_distinct_ratio`` of the first ``sample_rows`` rows of ``df`` are
+            distinct in it. ``"auto"`` is an opt-in heuristic: it collects that sample of every input column
+            set eagerly, when this function is called, which is cheap for a scan of a file but runs the whole
+            upstream query of ``df`` otherwise, and a sample may not represent the rest of ``df``. Prefer
+            ``"always"`` where values are known to repeat.
+        max_distinct_ratio: The distinct-row ratio at or below which ``"auto"`` evaluates over distinct
+            values.
+        sample_rows: The number of rows ``"auto"`` samples to estimate the distinct-row ratio.
+
+    Returns:
+        ``df`` with the expressions added as columns.
+
+    Raises:
+        ValueError: If ``mode`` is not one of `DISTINCT_EVAL_MODES`.
+
+    Examples:
+        >>> df = pl.LazyFrame({
+        ...     "id": [1, 2, 3, 4, 5],
+        ...     "item": ["A", "B", None, "A", "A"],
+        ...     "ts": ["2021-01-01", "2021-01-01", "2021-01-02", "2021-01-01", "2021-01-02"],
+        ... })
+        >>> exprs = {
+        ...     "code": pl.format("LAB//{}", pl.col("item").fill_null("UNK")),
+        ...     "time": pl.col("ts").str.strptime(pl.Date, "%Y-%m-%d"),
+        ... }
+        >>> with_distinct_columns(df, exprs, mode="always").collect()
+        shape: (5, 5)
+        ┌─────┬──────┬────────────┬──────────┬────────────┐
+        │ id  ┆ item ┆ ts         ┆ code     ┆ time       │
+        │ --- ┆ ---  ┆ ---        ┆ ---      ┆ ---        │
+        │ i64 ┆ str  ┆ str        ┆ str      ┆ date       │
+        ╞═════╪══════╪════════════╪══════════╪════════════╡
+        │ 1   ┆ A    ┆ 2021-01-01 ┆ LAB//A   ┆ 2021-01-01 │
+        │ 2   ┆ B    ┆ 2021-01-01 ┆ LAB//B   ┆ 2021-01-01 │
+        │ 3   ┆ null ┆ 2021-01-02 ┆ LAB//UNK ┆ 2021-01-02 │
+        │ 4   ┆ A    ┆ 2021-01-01 ┆ LAB//A   ┆ 2021-01-01 │
+        │ 5   ┆ A    ┆ 2021-01-02 ┆ LAB//A   ┆ 2021-01-02 │
+        └─────┴──────┴────────────┴──────────┴────────────┘
+        >>> with_distinct_columns(df, exprs, mode="always").collect().equals(
+        ...     with_distinct_columns(df, exprs, mode="never").collect()
+        ... )
+        True
+
+        With ``"auto"``, only input columns with few distinct values (relative to the rows sampled, here
+        eagerly, as the plan is built) are evaluated over distinct values; here, that is ``ts`` but not
+        ``item``:
+
+        >>> plan = with_distinct_columns(df, exprs, mode="auto", max_distinct_ratio=0.5).explain()
+        >>> plan.count("LEFT PLAN ON")
+        1
+
+        By default, nothing is evaluated over distinct values (and nothing is sampled):
+
+        >>> with_distinct_columns(df, exprs).explain().count("LEFT PLAN ON")
+        0
+        >>> with_distinct_columns(df, exprs, mode="sometimes")
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid distinct_eval mode 'sometimes'; expected one of never, always, auto.
+    """
+    if mode not in DISTINCT_EVAL_MODES:
+        modes = ", ".join(DISTINCT_EVAL_MODES)
+        raise ValueError(f"Invalid distinct_eval mode '{mode}'; expected one of {modes}.")
+
+    by_inputs: dict[tuple[str, ...], dict[str, pl.Expr]] = {}
+    for name, expr in exprs.items():
+        by_inputs.setdefault(tuple(sorted(set(expr.meta.root_names()))), {})[name] = expr
+
+    direct = {}
+    for inputs, input_exprs in by_inputs.items():
+        if mode == "never" or not inputs:
+            direct.update(input_exprs)
+            continue
+
+        if mode == "auto":
+            sample = df.lazy().select(inputs).head(sample_rows).collect()
+            ratio = sample.n_unique() / sample.height if sample.height else 1.0
+            if ratio > max_distinct_ratio:
+                direct.update(input_exprs)
+                continue
+            logger.info(f"Evaluating {', '.join(input_exprs)} over distinct values ({ratio:.1%} distinct)")
+
+        distinct = df.select(inputs).unique().with_columns(**input_exprs)
+        df = df.join(distinct, on=list(inputs), how="left", nulls_equal=True, maintain_order="left")
+
+    return df.with_columns(**direct) if direct else df
+
+
+def _with_computed_columns(
+    df: pl.LazyFrame,
+    event_exprs: Sequence[dict[str, pl.Expr]],
+    distinct_eval: str = "never",
+    share: bool = True,
+) -> tuple[pl.LazyFrame, list[dict[str, pl.Expr]]]:
+    """Precomputes shared (if ``share``) and distinct-evaluated expressions of events extracted from ``df``.
+
+    Returns ``df`` with those expressions added as helper columns, and each event's expressions with the
+    precomputed ones replaced by references to their helper columns.
+    """
+    shared = shared_subexpressions(event_exprs) if share else {}
+    distinct = distinct_eval_candidates(event_exprs) if distinct_eval != "never" else {}
+    if not shared and not distinct:
+        return df, [dict(exprs) for exprs in event_exprs]
+
+    if shared:
+        logger.info(f"Computing {len(shared)} subexpressions once for {len(event_exprs)} events")
+
+    computed = {**shared, **distinct}
+    cols = {key: f"__MEDS_extract_shared_{i}" for i, key in enumerate(computed)}
+    direct = {cols[key]: expr for key, expr in computed.items() if key not in distinct}
+    if direct:
+        df = df.with_columns(**direct)
+    if distinct:
+        df = with_distinct_columns(df, {cols[key]: distinct[key] for key in distinct}, mode=distinct_eval)
+
+    return df, [
+        {col: pl.col(cols[key]) if (key := _expr_key(expr)) in cols else expr for col, expr in exprs.items()}
+        for exprs in event_exprs
+    ]
+
+
+def convert_to_event_blocks(
+    df: pl.LazyFrame,
+    event_cfgs: dict[str, dict[str, str | Sequence[str] | None] | EventPlan],
+    do_dedup_text_and_numeric: bool = False,
+    input_prefix: str | None = None,
+    distinct_eval: str = "never",
+    unique_rows: bool = True,
+) -> dict[str, pl.LazyFrame]:
+    """Converts a DataFrame of raw data into one DataFrame of events per event block.
+
+    Takes the same arguments as ``convert_to_events``, which concatenates the blocks returned here.
+
+    Returns:
+        The extracted events of each event block, keyed by event name, in config order.
+
+    Examples:
+        >>> raw = pl.DataFrame({"subject_id": [1, 2], "ts": ["2021-01-01", None]})
+        >>> cfgs = {
+        ...     "admit": {"code": "ADMISSION", "time": '$ts::"%Y-%m-%d"'},
+        ...     "birth": {"code": "BIRTH", "time": None},
+        ... }
+        >>> {k: v.shape for k, v in convert_to_event_blocks(raw, cfgs).items()}
+        {'admit': (1, 3), 'birth': (2, 3)}
+    """
+    if not event_cfgs:
+        raise ValueError("No event configurations provided.")
+
+    event_plans = {}
+    for event_name, event_cfg in event_cfgs.items():
+        if event_name in EVENT_META_KEYS:
+            continue
+        try:
+            event_plans[event_name] = (
+                event_cfg if isinstance(event_cfg, EventPlan) else compile_event(event_cfg)
+            )
+        except Exception as e:
+            raise ValueError(f"Error extracting event {event_name}: {e}") from e
 
-    return df.select(**event_exprs).unique(maintain_order=True)
+    # The input schema is shared by all events, so resolve it (at most) once per frame. Unpivoted blocks are
+    # evaluated on (and so filtered against the schema of) their unpivoted frame instead.
+    schema = None
+    if any(p.needs_schema and p.unpivot is None for p in event_plans.values()):
+        schema = df.collect_schema()
+
+    # Events with identical row filters (and, for unpivoted blocks, identical unpivots) are extracted from one
+    # shared, filtered frame, on which every expression that more than one of them computes (e.g., the same
+    # timestamp parse) is evaluated once. The shared expressions are evaluated *after* the filters, so parses
+    # that are only valid on the filtered rows (like a strict ``strptime``) remain protected. Polars' common
+    # subplan elimination then executes each shared frame (and the input scan) once for all the event
+    # branches built on it. With ``distinct_eval``, the (shared or not) ``code`` and ``time`` expressions are
+    # likewise evaluated on the filtered frame, but once per distinct tuple of their inputs.
+    groups: dict[tuple, list[str]] = {}
+    source_dfs = {}
+    filters_by_event = {}
+    for event_name, event_plan in event_plans.items():
+        source_key = (event_plan.unpivot, event_plan.index_columns)
+        if source_key not in source_dfs:
+            source_dfs[source_key] = (
+                event_plan.source_frame(df),
+                schema if event_plan.unpivot is None else None,
+            )
+        source_df, source_schema = source_dfs[source_key]
+        if event_plan.needs_schema and source_schema is None:
+            source_schema = source_df.collect_schema()
+            source_dfs[source_key] = (source_df, source_schema)
+
+        filters_by_event[event_name] = event_plan.row_filters(source_schema)
+        group_key = (source_key, tuple(_expr_key(f) for f in filters_by_event[event_name]))
+        groups.setdefault(group_key, []).append(event_name)
+
+    event_dfs_in = {}
+    event_exprs = {}
+    for (source_key, _), event_names in groups.items():
+        group_df = source_dfs[source_key][0]
+        for row_filter in filters_by_event[event_names[0]]:
+            group_df = group_df.filter(row_filter)
+
+        group_df, group_exprs = _with_computed_columns(
+            group_df, [event_plans[n].exprs for n in event_names], distinct_eval
+        )
+
+        for n, exprs in zip(event_names, group_exprs, strict=True):
+            event_dfs_in[n] = group_df
+            event_exprs[n] = exprs
+
+    # Events are emitted in config order, regardless of how they were grouped.
+    event_dfs = {}
+    for event_name in event_plans:
+        source_block = f"{input_prefix}/{event_name}" if input_prefix is not None else None
+
+        try:
+            logger.info(f"Building computational graph for extracting {event_name}")
+            event_dfs[event_name] = _select_event(
+                event_dfs_in[event_name],
+                event_exprs[event_name],
+                do_dedup_text_and_numeric,
+                source_block,
+                unique_rows,
+            )
+        except Exception as e:  # pragma: no cover
+            raise ValueError(f"Error extracting event {event_name}: {e}") from e
+
+    return event_dfs
 
 
 def convert_to_events(
@@ -269,15 +581,21 @@ def convert_to_events(
     event_cfgs: dict[str, dict[str, str | None | Sequence[str]]],
     do_dedup_text_and_numeric: bool = False,
     input_prefix: str | None = None,
+    distinct_eval: str = "never",
+    unique_rows: bool = True,
 ) -> pl.LazyFrame:
     """Converts a DataFrame of raw data into a DataFrame of events.
 
     Args:
         df: The raw data DataFrame with a ``"subject_id"`` column.
-        event_cfgs: Dict mapping event names to event config dicts (see ``extract_event``).
+        event_cfgs: Dict mapping event names to event config dicts or compiled ``EventPlan`` objects (see
+            ``extract_event``).
         do_dedup_text_and_numeric: If true, nullify ``text_value`` when it equals ``numeric_value``.
         input_prefix: If provided, combined with each event name to form the ``source_block``
             column (e.g., ``"patients/eye_color"``).
+        distinct_eval: How to evaluate the ``code`` and ``time`` expressions of each event (see
+            ``extract_event``).
+        unique_rows: If false, duplicate events within each event block are kept (see ``extract_event``).
 
     Returns:
         A concatenated DataFrame of all extracted events.
@@ -315,30 +633,383 @@ def convert_to_events(
         ValueError: No event configurations provided.
     """
 
-    if not event_cfgs:
-        raise ValueError("No event configurations provided.")
+    event_dfs = convert_to_event_blocks(
+        df,
+        event_cfgs,
+        do_dedup_text_and_numeric,
+        input_prefix,
+        distinct_eval=distinct_eval,
+        unique_rows=unique_rows,
+    )
+    return pl.concat(list(event_dfs.values()), how="diagonal_relaxed")
 
-    event_dfs = []
-    for event_name, event_cfg in event_cfgs.items():
-        if event_name in EVENT_META_KEYS:
-            continue
 
-        source_block = f"{input_prefix}/{event_name}" if input_prefix is not None else None
+def compact_events(df: pl.LazyFrame, source_blocks: pl.Enum | None = None) -> pl.LazyFrame:
+    """Narrows extracted events to a compact intermediate representation.
 
-        try:
-            logger.info(f"Building computational graph for extracting {event_name}")
-            event_dfs.append(
-                extract_event(
-                    df,
-                    event_cfg,
-                    do_dedup_text_and_numeric=do_dedup_text_and_numeric,
-                    source_block=source_block,
-                )
+    ``code`` is encoded as a ``Categorical``, ``numeric_value`` is narrowed to its final MEDS type
+    (``Float32``), and, if ``source_blocks`` is given, ``source_block`` is encoded as that ``Enum``. The
+    repeated strings of a shard are then stored once (in memory and on disk) rather than once per row.
+    ``finalize_MEDS_data`` decodes the columns back to strings.
+
+    Args:
+        df: The extracted events.
+        source_blocks: An ``Enum`` over the names of all MESSY event blocks, if ``source_block`` should be
+            encoded. It must be identical across all files, so that they can be concatenated.
+
+    Examples:
+        >>> events = pl.LazyFrame({
+        ...     "subject_id": [1, 2],
+        ...     "code": ["LAB//A", "LAB//A"],
+        ...     "numeric_value": [1.5, 2.5],
+        ...     "source_block": ["labs/lab", "labs/lab"],
+        ... })
+        >>> schema = compact_events(events, pl.Enum(["labs/lab", "patients/dob"])).collect_schema()
+        >>> schema["subject_id"], schema["numeric_value"]
+        (Int64, Float32)
+        >>> schema["code"] == pl.Categorical, schema["source_block"] == pl.Enum(["labs/lab", "patients/dob"])
+        (True, True)
+        >>> schema = compact_events(events.drop("numeric_value", "source_block")).collect_schema()
+        >>> schema.names(), schema["code"] == pl.Categorical
+        (['subject_id', 'code'], True)
+    """
+    schema = df.collect_schema()
+    casts = {"code": pl.Categorical(), "numeric_value": pl.Float32}
+    if source_blocks is not None:
+        casts["source_block"] = source_blocks
+    return df.with_columns(pl.col(c).cast(dtype) for c, dtype in casts.items() if c in schema)
+
+
+def sink_event_blocks(
+    event_dfs: dict[str, pl.LazyFrame],
+    out_fp: Path,
+    storage_options: dict | None = None,
+):
+    """Writes the extracted event blocks to a single parquet file using Polars' streaming engine.
+
+    The concatenation of all blocks is first sunk directly to ``out_fp``, so the output is never fully
+    materialized in memory. If the streaming engine cannot execute that query (i.e., it raises an
+    ``InvalidOperationError``, as for an operation the streaming sink does not support), each block is instead
+    sunk to its own part file, and the part files are then streamed into ``out_fp``. Only the blocks that
+    cannot be sunk on their own are collected in memory, and the fallback and those blocks are logged. Any
+    other error (e.g., in the data or on writing) is raised as is.
+
+    Args:
+        event_dfs: The extracted events of each event block, keyed by block name (see
+            ``convert_to_event_blocks``).
+        out_fp: The parquet file to write.
+        storage_options: Cloud storage options, if ``out_fp`` is remote.
+
+    Examples:
+        >>> blocks = {
+        ...     "a": pl.LazyFrame({"subject_id": [1], "code": ["A"]}),
+        ...     "b": pl.LazyFrame({"subject_id": [2], "code": ["B"], "numeric_value": [1.5]}),
+        ... }
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "train" / "0" / "data.parquet"
+        ...     sink_event_blocks(blocks, out_fp)
+        ...     pl.read_parquet(out_fp)
+        shape: (2, 3)
+        ┌────────────┬──────┬───────────────┐
+        │ subject_id ┆ code ┆ numeric_value │
+        │ ---        ┆ ---  ┆ ---           │
+        │ i64        ┆ str  ┆ f64           │
+        ╞════════════╪══════╪═══════════════╡
+        │ 1          ┆ A    ┆ null          │
+        │ 2          ┆ B    ┆ 1.5           │
+        └────────────┴──────┴───────────────┘
+    """
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    sink_kwargs = {"storage_options": storage_options} if storage_options else {}
+
+    try:
+        pl.concat(list(event_dfs.values()), how="diagonal_relaxed").sink_parquet(out_fp, **sink_kwargs)
+        return
+    except pl.exceptions.InvalidOperationError as e:
+        logger.warning(f"Could not stream all event blocks to {out_fp} at once ({e}); sinking block-wise.")
+        out_fp.unlink(missing_ok=True)
+
+    parts_dir = out_fp.parent / f".{out_fp.stem}.parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        part_fps = []
+        collected = []
+        for i, (block, event_df) in enumerate(event_dfs.items()):
+            part_fp = parts_dir / f"{i}.parquet"
+            try:
+                event_df.sink_parquet(part_fp, **sink_kwargs)
+            except pl.exceptions.InvalidOperationError as e:
+                logger.info(f"Block {block} is not streamable ({e}); collecting it in memory.")
+                part_fp.unlink(missing_ok=True)
+                write_df(event_df, part_fp)
+                collected.append(block)
+            part_fps.append(part_fp)
+
+        if collected:
+            logger.warning(
+                f"Event blocks {', '.join(collected)} could not be streamed to {out_fp} and were collected "
+                "in memory instead."
             )
-        except Exception as e:
-            raise ValueError(f"Error extracting event {event_name}: {e}") from e
 
-    return pl.concat(event_dfs, how="diagonal_relaxed")
+        parts = [pl.scan_parquet(fp, glob=False, storage_options=storage_options) for fp in part_fps]
+        pl.concat(parts, how="diagonal_relaxed").sink_parquet(out_fp, **sink_kwargs)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+SORTED_BY_METADATA_KEY = "MEDS_extract:sorted_by"
+
+
+def write_sorted_events(
+    events: pl.DataFrame | pl.LazyFrame | dict[str, pl.LazyFrame],
+    out_fp: Path,
+    sort_by: Sequence[str] = ("subject_id", "time"),
+    storage_options: dict | None = None,
+):
+    """Writes events, stably sorted by ``sort_by``, to a parquet file that records that order.
+
+    The sort columns are stored as a JSON list under the ``SORTED_BY_METADATA_KEY`` key of the file's
+    key-value metadata, from which ``merge_to_MEDS_cohort`` can tell that it may merge the presorted files of
+    a shard rather than sort their concatenation. The sort is stable, so events with equal sort keys keep
+    their event block order.
+
+    Args:
+        events: The events to write, either as one frame or as the extracted events of each event block, keyed
+            by block name (see ``convert_to_event_blocks``), which are concatenated in order.
+        out_fp: The parquet file to write.
+        sort_by: The columns to sort by. Columns ``events`` does not have are skipped.
+        storage_options: Cloud storage options, if ``out_fp`` is remote.
+
+    Examples:
+        >>> blocks = {
+        ...     "a": pl.LazyFrame({"subject_id": [2, 1], "time": [1, 5], "code": ["A", "A"]}),
+        ...     "b": pl.LazyFrame({"subject_id": [1, 1], "time": [5, None], "code": ["B", "B"]}),
+        ... }
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "data.parquet"
+        ...     write_sorted_events(blocks, out_fp)
+        ...     print(pl.read_parquet_metadata(out_fp)[SORTED_BY_METADATA_KEY])
+        ...     pl.read_parquet(out_fp)
+        ["subject_id", "time"]
+        shape: (4, 3)
+        ┌────────────┬──────┬──────┐
+        │ subject_id ┆ time ┆ code │
+        │ ---        ┆ ---  ┆ ---  │
+        │ i64        ┆ i64  ┆ str  │
+        ╞════════════╪══════╪══════╡
+        │ 1          ┆ null ┆ B    │
+        │ 1          ┆ 5    ┆ A    │
+        │ 1          ┆ 5    ┆ B    │
+        │ 2          ┆ 1    ┆ A    │
+        └────────────┴──────┴──────┘
+    """
+    if isinstance(events, dict):
+        events = pl.concat(list(events.values()), how="diagonal_relaxed")
+    events = events.lazy()
+
+    columns = set(events.collect_schema().names())
+    sort_by = [col for col in sort_by if col in columns]
+
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    sink_kwargs = {"storage_options": storage_options} if storage_options else {}
+    events.sort(sort_by, maintain_order=True).sink_parquet(
+        out_fp, metadata={SORTED_BY_METADATA_KEY: json.dumps(sort_by)}, **sink_kwargs
+    )
+
+
+CODES_SIDECAR_SUFFIX = ".codes.parquet"
+CODE_SIDECAR_MODES = ("keep_components", "drop_components")
+
+
+def code_sidecar_fp(out_fp: Path) -> Path:
+    """Returns the path of the codes sidecar of an event file.
+
+    Examples:
+        >>> code_sidecar_fp(Path("convert_to_MEDS_events/train/0/labs.parquet"))
+        PosixPath('convert_to_MEDS_events/train/0/labs.codes.parquet')
+    """
+    return out_fp.with_name(f"{out_fp.stem}{CODES_SIDECAR_SUFFIX}")
+
+
+def split_code_components(
+    events: pl.LazyFrame | pl.DataFrame,
+) -> tuple[pl.LazyFrame | pl.DataFrame, pl.LazyFrame | pl.DataFrame]:
+    """Splits the per-row ``code_components`` column off of extracted events into a per-code dictionary.
+
+    Args:
+        events: The extracted events.
+
+    Returns:
+        The events without their ``code_components`` column, and the distinct ``code`` values (with their
+        ``code_components``, if the events have them).
+
+    Examples:
+        >>> events = pl.DataFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "code": ["LAB//A", "LAB//B", "LAB//A"],
+        ...     "code_components": [{"name": "A"}, {"name": "B"}, {"name": "A"}],
+        ... })
+        >>> events, codes = split_code_components(events)
+        >>> events.columns
+        ['subject_id', 'code']
+        >>> codes
+        shape: (2, 2)
+        ┌────────┬─────────────────┐
+        │ code   ┆ code_components │
+        │ ---    ┆ ---             │
+        │ str    ┆ struct[1]       │
+        ╞════════╪═════════════════╡
+        │ LAB//A ┆ {"A"}           │
+        │ LAB//B ┆ {"B"}           │
+        └────────┴─────────────────┘
+
+        Events without ``code_components`` (e.g., those with only literal codes) just yield their codes:
+
+        >>> split_code_components(events)[1]
+        shape: (2, 1)
+        ┌────────┐
+        │ code   │
+        │ ---    │
+        │ str    │
+        ╞════════╡
+        │ LAB//A │
+        │ LAB//B │
+        └────────┘
+    """
+    schema = events.collect_schema()
+    code_cols = ["code", "code_components"] if "code_components" in schema else ["code"]
+    codes = events.select(code_cols).unique(maintain_order=True)
+    return events.drop("code_components", strict=False), codes
+
+
+def write_with_code_sidecar(
+    events: pl.LazyFrame | pl.DataFrame | dict[str, pl.LazyFrame],
+    out_fp: Path,
+    drop_code_components: bool = True,
+    sort_by: Sequence[str] | None = None,
+):
+    """Writes extracted events, plus a sidecar of their distinct codes, from a single query.
+
+    The sidecar (see `code_sidecar_fp`) maps each distinct code in the event file to its components, so that
+    ``extract_code_metadata`` can build its code vocabulary and partial-match metadata from the (small)
+    sidecars rather than from the event data. The events and the sidecar are sunk together by Polars'
+    streaming engine (see ``pl.collect_all``), so the extraction runs once and the events are written once.
+    The events are written to a hidden temporary file that is only moved to ``out_fp`` once both outputs are
+    complete, so that a completed event file always has its sidecar. If the streaming engine cannot execute
+    the query, the events are collected in memory once and both outputs are written from them.
+
+    Args:
+        events: The extracted events, or the events of each event block (see ``convert_to_event_blocks``),
+            which are concatenated in order.
+        out_fp: The event file to write.
+        drop_code_components: Whether the events are written without their ``code_components``. If false,
+            only the sidecar is added.
+        sort_by: If given, the events are stably sorted by these columns (those the events have) and marked
+            as such, as ``write_sorted_events`` does.
+
+    Examples:
+        >>> events = pl.LazyFrame({
+        ...     "subject_id": [2, 1],
+        ...     "code": ["LAB//A", "BIRTH"],
+        ...     "code_components": [{"name": "A"}, None],
+        ... })
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "labs.parquet"
+        ...     write_with_code_sidecar(events, out_fp)
+        ...     print(pl.read_parquet(out_fp).columns)
+        ...     print(pl.read_parquet(code_sidecar_fp(out_fp)).unnest("code_components").rows())
+        ...     print(sorted(fp.name for fp in Path(tmpdir).iterdir()))
+        ['subject_id', 'code']
+        [('LAB//A', 'A'), ('BIRTH', None)]
+        ['labs.codes.parquet', 'labs.parquet']
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "labs.parquet"
+        ...     write_with_code_sidecar(events, out_fp, drop_code_components=False, sort_by=["subject_id"])
+        ...     print(pl.read_parquet(out_fp).rows())
+        ...     print(pl.read_parquet_metadata(out_fp)[SORTED_BY_METADATA_KEY])
+        ...     print(pl.read_parquet(code_sidecar_fp(out_fp))["code"].to_list())
+        [(1, 'BIRTH', None), (2, 'LAB//A', {'name': 'A'})]
+        ["subject_id"]
+        ['LAB//A', 'BIRTH']
+    """
+    if isinstance(events, dict):
+        events = pl.concat(list(events.values()), how="diagonal_relaxed")
+    events = events.lazy()
+
+    events_without_components, codes = split_code_components(events)
+    if drop_code_components:
+        events = events_without_components
+
+    sink_kwargs = {}
+    if sort_by is not None:
+        columns = set(events.collect_schema().names())
+        sort_by = [col for col in sort_by if col in columns]
+        events = events.sort(sort_by, maintain_order=True)
+        sink_kwargs["metadata"] = {SORTED_BY_METADATA_KEY: json.dumps(sort_by)}
+
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    codes_fp = code_sidecar_fp(out_fp)
+    partial_fp = out_fp.with_name(f".{out_fp.name}.partial")
+    try:
+        pl.collect_all(
+            [
+                events.sink_parquet(partial_fp, lazy=True, **sink_kwargs),
+                codes.sink_parquet(codes_fp, lazy=True),
+            ]
+        )
+    except pl.exceptions.InvalidOperationError as e:
+        logger.warning(f"Could not stream the events and codes of {out_fp} ({e}); collecting them in memory.")
+        events_df, codes_df = pl.collect_all([events, codes])
+        codes_df.write_parquet(codes_fp)
+        events_df.write_parquet(partial_fp, **sink_kwargs)
+    partial_fp.replace(out_fp)
+
+
+def extract_prefix_events(
+    df: pl.LazyFrame,
+    prefix_plan: PrefixPlan,
+    input_prefix: str,
+    shard: str,
+    do_dedup_text_and_numeric: bool = False,
+    distinct_eval: str = "never",
+    unique_rows: bool = True,
+    source_blocks: pl.Enum | None = None,
+    as_blocks: bool = False,
+) -> pl.LazyFrame | dict[str, pl.LazyFrame]:
+    """Extracts the events of all event blocks of ``prefix_plan`` from one shard of its input prefix.
+
+    Args:
+        df: The shard's rows of the input prefix.
+        prefix_plan: The compiled plan of the input prefix.
+        input_prefix: The input prefix.
+        shard: The name of the subject shard, used in errors.
+        do_dedup_text_and_numeric: See ``convert_to_event_blocks``.
+        distinct_eval: See ``convert_to_event_blocks``.
+        unique_rows: See ``convert_to_event_blocks``.
+        source_blocks: If given, events are compacted with this ``source_block`` Enum (see
+            ``compact_events``).
+        as_blocks: If true, the event blocks are returned separately, keyed by ``<input prefix>/<block>``
+            (as ``sink_event_blocks`` takes them), rather than concatenated.
+    """
+    df = prefix_plan.prepare(df)
+
+    try:
+        logger.info(f"Extracting events for {input_prefix}")
+        event_dfs = convert_to_event_blocks(
+            df,
+            event_cfgs=prefix_plan.events,
+            do_dedup_text_and_numeric=do_dedup_text_and_numeric,
+            input_prefix=input_prefix,
+            distinct_eval=distinct_eval,
+            unique_rows=unique_rows,
+        )
+        if source_blocks is not None:
+            event_dfs = {k: compact_events(v, source_blocks) for k, v in event_dfs.items()}
+        if as_blocks:
+            return {f"{input_prefix}/{name}": event_df for name, event_df in event_dfs.items()}
+        return pl.concat(list(event_dfs.values()), how="diagonal_relaxed")
+    except Exception as e:  # pragma: no cover
+        raise ValueError(f"Error converting to MEDS for {shard}/{input_prefix}: {e}") from e
 
 
 @Stage.register(is_metadata=False)
@@ -346,12 +1017,44 @@ def main(cfg: DictConfig):
     """Converts the event-sharded raw data into MEDS events and storing them in subject subsharded flat files.
 
     All arguments are specified through the command line into the ``cfg`` object through Hydra.
+
+    Args:
+        do_dedup_text_and_numeric: If true, nullify ``text_value`` when it equals ``numeric_value``.
+        streaming_sink: If true, each output is sunk to disk by Polars' streaming engine rather than collected
+            in memory and then written (see ``sink_event_blocks``). This bounds the peak memory of shards with
+            very many events for a single input prefix.
+        compact_intermediates: If true, events are written in the compact representation of
+            ``compact_events`` (Categorical ``code``, Enum ``source_block``, and Float32 ``numeric_value``),
+            which shrinks the intermediate files and the memory needed to merge them. ``finalize_MEDS_data``
+            restores the MEDS types.
+        code_sidecar: If set, each output file gets a sidecar mapping each of its distinct codes to its
+            components (see ``write_with_code_sidecar``), from which ``extract_code_metadata`` can build its
+            code vocabulary and partial-match metadata rather than by scanning the event data. With
+            ``"keep_components"``, the events keep their per-row ``code_components`` column; with
+            ``"drop_components"``, they are written without it. The events and their sidecar are always
+            streamed to disk together, and only to a local ``output_dir``.
+        sort_outputs: If true, each output is sorted by ``subject_id`` and ``time`` (and then by the columns
+            in ``additional_sort_by``, if any) and marked as such (see ``write_sorted_events``), so that
+            ``merge_to_MEDS_cohort`` can merge a shard's presorted files instead of sorting it in full. Sorted
+            outputs are always streamed to disk. For the merge to use them, ``additional_sort_by`` must match
+            ``merge_to_MEDS_cohort.additional_sort_by``. The merge then retains the first of a set of duplicate
+            rows over a ``unique_by`` subset in sorted, not extraction, order.
+        distinct_eval: How to evaluate the ``code`` and ``time`` expressions of each event: ``"never"`` (once
+            per row), ``"always"`` (once per distinct tuple of the input columns they read, joined back onto
+            the rows), or ``"auto"`` (an opt-in heuristic that collects a sample of each input as its query
+            is built, and evaluates over distinct tuples only where the sample shows few distinct values).
+            See ``with_distinct_columns``.
+
+    Event blocks are made unique as they are extracted unless the pipeline-level ``dedup_strategy`` defers
+    deduplication to ``merge_to_MEDS_cohort`` (see ``MEDS_extract.dedup``).
     """
 
+    pl.enable_string_cache()
+
     input_dir = UPath(cfg.stage_cfg.data_input_dir)
     out_dir = UPath(cfg.stage_cfg.output_dir)
 
-    shards = json.loads(Path(cfg.shards_map_fp).read_text())
+    shards = load_shards_map(Path(cfg.shards_map_fp))
 
     event_conversion_cfg_fp = Path(cfg.event_conversion_config_fp)
     if not event_conversion_cfg_fp.exists():
@@ -360,29 +1063,52 @@ def main(cfg: DictConfig):
     logger.info("Starting event conversion.")
 
     logger.info(f"Reading event conversion config from {event_conversion_cfg_fp}")
-    event_conversion_cfg = OmegaConf.load(event_conversion_cfg_fp)
+    event_conversion_cfg = load_event_conversion_cfg(event_conversion_cfg_fp)
     logger.info(f"Event conversion config:\n{OmegaConf.to_yaml(event_conversion_cfg)}")
 
-    default_subject_id_col = event_conversion_cfg.pop("subject_id_col", "subject_id")
+    plan = get_extraction_plan(cfg, event_conversion_cfg)
+    event_conversion_cfg.pop("subject_id_col", None)
 
     out_dir.mkdir(parents=True, exist_ok=True)
     OmegaConf.save(event_conversion_cfg, out_dir / "event_conversion_config.yaml")
 
-    subject_splits = list(shards.items())
-    random.shuffle(subject_splits)
-
-    event_configs = list(event_conversion_cfg.items())
-    random.shuffle(event_configs)
-
     raw_opts = cfg.get("cloud_io_storage_options", {})
     cloud_io_storage_options = OmegaConf.to_container(raw_opts) if OmegaConf.is_config(raw_opts) else raw_opts
 
     read_fn = partial(pl.scan_parquet, glob=False, storage_options=cloud_io_storage_options)
 
-    all_input_prefixes = {pfx for pfx, _ in event_configs}
+    streaming_sink = cfg.stage_cfg.get("streaming_sink", False)
+    do_dedup_text_and_numeric = cfg.stage_cfg.get("do_dedup_text_and_numeric", False)
+    distinct_eval = cfg.stage_cfg.get("distinct_eval", "never")
+    unique_rows = dedup_per_block(get_dedup_strategy(cfg))
+
+    compact = cfg.stage_cfg.get("compact_intermediates", False)
+    source_blocks = pl.Enum([f"{pfx}/{ev}" for pfx, p in plan.prefixes.items() for ev in p.events])
+    if cfg.stage_cfg.get("sort_outputs", False):
+        sort_by = ["subject_id", "time", *(cfg.stage_cfg.get("additional_sort_by", None) or [])]
+        write_fn = partial(write_sorted_events, sort_by=sort_by, storage_options=cloud_io_storage_options)
+    elif streaming_sink:
+        write_fn = partial(sink_event_blocks, storage_options=cloud_io_storage_options)
+    else:
+        write_fn = write_df
+
+    code_sidecar = cfg.stage_cfg.get("code_sidecar", None)
+    if code_sidecar is not None and code_sidecar not in CODE_SIDECAR_MODES:
+        raise ValueError(f"Invalid code_sidecar '{code_sidecar}'; expected one of {CODE_SIDECAR_MODES}.")
+    if code_sidecar:
+        if out_dir.protocol not in ("", "file"):
+            raise ValueError(f"code_sidecar is only supported for local output directories; got {out_dir}")
+        write_fn = partial(
+            write_with_code_sidecar,
+            drop_code_components=code_sidecar == "drop_components",
+            sort_by=sort_by if cfg.stage_cfg.get("sort_outputs", False) else None,
+        )
+
+    all_input_prefixes = set(plan.prefixes)
 
-    for sp, _ in subject_splits:
-        for input_prefix, event_cfgs in event_configs:
+    tasks = []
+    for sp in shards:
+        for input_prefix, prefix_plan in plan.prefixes.items():
             input_fp = input_dir / sp / f"{input_prefix}.parquet"
 
             if not input_fp.is_file():
@@ -402,58 +1128,31 @@ def main(cfg: DictConfig):
 
             out_fp = out_dir / sp / f"{input_prefix}.parquet"
 
-            event_cfgs = copy.deepcopy(event_cfgs)
-            input_subject_id_column = event_cfgs.pop("subject_id_col", default_subject_id_col)
-            subject_id_expr_str = event_cfgs.pop("subject_id_expr", None)
-            transforms_cfg = event_cfgs.pop("transforms", None)
-            event_cfgs.pop("schema", None)
-
-            def compute_fntr(
-                input_subject_id_column: str,
-                subject_id_expr_str: str | None,
-                transforms_cfg: dict | None,
-                input_prefix: str,
-                event_cfgs: dict,
-                sp: str,
-            ) -> Callable[[pl.LazyFrame], pl.LazyFrame]:
-                def compute_fn(df: pl.LazyFrame) -> pl.LazyFrame:
-                    if subject_id_expr_str is not None:
-                        sid_expr, _ = compile_subject_id_expr(subject_id_expr_str)
-                        df = df.with_columns(subject_id=sid_expr)
-                    elif input_subject_id_column != "subject_id":
-                        df = df.rename({input_subject_id_column: "subject_id"})
-
-                    if transforms_cfg is not None:
-                        transform_exprs = Parser.to_polars(dict(transforms_cfg))
-                        df = df.with_columns(**transform_exprs)
-
-                    try:
-                        logger.info(f"Extracting events for {input_prefix}")
-                        return convert_to_events(
-                            df,
-                            event_cfgs=copy.deepcopy(event_cfgs),
-                            do_dedup_text_and_numeric=cfg.stage_cfg.get("do_dedup_text_and_numeric", False),
+            tasks.append(
+                (
+                    f"{sp}/{input_prefix}",
+                    partial(
+                        rwlock_wrap,
+                        input_fp,
+                        out_fp,
+                        read_fn,
+                        write_fn,
+                        partial(
+                            extract_prefix_events,
+                            prefix_plan=prefix_plan,
                             input_prefix=input_prefix,
-                        )
-                    except Exception as e:  # pragma: no cover
-                        raise ValueError(f"Error converting to MEDS for {sp}/{input_prefix}: {e}") from e
-
-                return compute_fn
-
-            rwlock_wrap(
-                input_fp,
-                out_fp,
-                read_fn,
-                write_df,
-                compute_fntr(
-                    input_subject_id_column,
-                    subject_id_expr_str,
-                    transforms_cfg,
-                    input_prefix,
-                    event_cfgs,
-                    sp,
-                ),
-                do_overwrite=cfg.do_overwrite,
+                            shard=sp,
+                            do_dedup_text_and_numeric=do_dedup_text_and_numeric,
+                            distinct_eval=distinct_eval,
+                            unique_rows=unique_rows,
+                            source_blocks=source_blocks if compact else None,
+                            as_blocks=streaming_sink,
+                        ),
+                        do_overwrite=cfg.do_overwrite,
+                    ),
+                )
             )
 
+    run_tasks(cfg, tasks)
+
     logger.info("Subsharded into converted events.")
@@ -1,10 +1,10 @@
 """Utilities for converting input data structures into MEDS events."""
 
 import copy
-import json
 import logging
 import random
-from collections.abc import Callable, Sequence
+from collections.abc import Sequence
+from functools import partial
 from pathlib import Path
 
 import polars as pl
@@ -13,9 +13,56 @@ from MEDS_transforms.mapreduce.rwlock import rwlock_wrap
 from MEDS_transforms.stages import Stage
 from omegaconf import DictConfig, OmegaConf
 
+from ..shared_state import load_event_conversion_cfg, load_shards_map
+from ..task_queue import run_tasks
+
 logger = logging.getLogger(__name__)
 
-pl.enable_string_cache()
+
+def read_subject_shard(
+    fps: Sequence[Path],
+    subjects: Sequence[int],
+    input_subject_id_column: str,
+    join_df: pl.LazyFrame | None = None,
+    join_cfg: dict | None = None,
+) -> pl.LazyFrame:
+    """Reads the rows of the given subjects from the event shards ``fps``.
+
+    Args:
+        fps: The event shards of a single input prefix.
+        subjects: The IDs of the subjects whose rows to keep.
+        input_subject_id_column: The column holding the subject IDs.
+        join_df: If given, a frame to left-join the event shards to (per ``join_cfg``) before filtering; the
+            subject ID column is then typed as in this frame.
+        join_cfg: The ``join`` block of the input prefix's event conversion config, with ``left_on`` and
+            ``right_on`` keys.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fps = [Path(tmpdir) / f"{i}.parquet" for i in range(2)]
+        ...     pl.DataFrame({"MRN": [1, 2], "visit": [10, 20]}).write_parquet(fps[0])
+        ...     pl.DataFrame({"MRN": [3], "visit": [30]}).write_parquet(fps[1])
+        ...     print(read_subject_shard(fps, [1, 3], "MRN").collect()["visit"].to_list())
+        ...     join_df = pl.LazyFrame({"visit_id": [10, 20, 30], "subject": [1, 2, 3]})
+        ...     join_cfg = {"left_on": "visit", "right_on": "visit_id"}
+        ...     df = read_subject_shard(fps, [2], "subject", join_df=join_df, join_cfg=join_cfg)
+        ...     print(df.collect().rows())
+        [10, 30]
+        [(2, 20, 2)]
+    """
+    df = pl.concat([pl.scan_parquet(fp, glob=False) for fp in fps], how="vertical")
+    if join_df is not None:
+        df = df.join(join_df, left_on=join_cfg["left_on"], right_on=join_cfg["right_on"], how="left")
+        subj_dtype = join_df.collect_schema()[input_subject_id_column]
+    else:
+        subj_dtype = df.collect_schema()[input_subject_id_column]
+
+    typed_subjects = pl.Series(subjects, dtype=subj_dtype)
+    return df.filter(pl.col(input_subject_id_column).is_in(typed_subjects))
+
+
+def _identity(df: pl.LazyFrame) -> pl.LazyFrame:
+    return df
 
 
 @Stage.register(is_metadata=False)
@@ -32,10 +79,12 @@ def main(cfg: DictConfig):
     file.
     """
 
+    pl.enable_string_cache()
+
     input_dir = Path(cfg.stage_cfg.data_input_dir)
     subject_subsharded_dir = Path(cfg.stage_cfg.output_dir)
 
-    shards = json.loads(Path(cfg.shards_map_fp).read_text())
+    shards = load_shards_map(Path(cfg.shards_map_fp))
 
     event_conversion_cfg_fp = Path(cfg.event_conversion_config_fp)
     if not event_conversion_cfg_fp.exists():
@@ -44,21 +93,16 @@ def main(cfg: DictConfig):
     logger.info("Starting subject sharding.")
 
     logger.info(f"Reading event conversion config from {event_conversion_cfg_fp}")
-    event_conversion_cfg = OmegaConf.load(event_conversion_cfg_fp)
+    event_conversion_cfg = load_event_conversion_cfg(event_conversion_cfg_fp)
     logger.info(f"Event conversion config:\n{OmegaConf.to_yaml(event_conversion_cfg)}")
 
     default_subject_id_col = event_conversion_cfg.pop("subject_id_col", "subject_id")
 
     subject_subsharded_dir.mkdir(parents=True, exist_ok=True)
 
-    subject_splits = list(shards.items())
-    random.shuffle(subject_splits)
-
-    event_configs = list(event_conversion_cfg.items())
-    random.shuffle(event_configs)
-
-    for sp, subjects in subject_splits:
-        for input_prefix, event_cfgs in event_configs:
+    tasks = []
+    for sp, subjects in shards.items():
+        for input_prefix, event_cfgs in event_conversion_cfg.items():
             event_shards = list((input_dir / input_prefix).glob("*.parquet"))
             event_cfgs = copy.deepcopy(event_cfgs)
             random.shuffle(event_shards)
@@ -75,46 +119,27 @@ def main(cfg: DictConfig):
                     how="vertical_relaxed",
                 )
 
-            def read_fntr(
-                subjects: Sequence[int],
-                input_subject_id_column: str,
-                _join_df: pl.LazyFrame | None = join_df,
-                _join_cfg: dict | None = join_cfg,
-            ) -> Callable[[Sequence[Path]], pl.LazyFrame]:
-                def read_fn(fps: Sequence[Path]) -> pl.LazyFrame:
-                    df = pl.concat(
-                        [pl.scan_parquet(fp, glob=False) for fp in fps],
-                        how="vertical",
-                    )
-                    if _join_df is not None:
-                        df = df.join(
-                            _join_df,
-                            left_on=_join_cfg["left_on"],
-                            right_on=_join_cfg["right_on"],
-                            how="left",
-                        )
-                        subj_dtype = _join_df.collect_schema()[input_subject_id_column]
-                    else:
-                        subj_dtype = df.collect_schema()[input_subject_id_column]
-
-                    typed_subjects = pl.Series(subjects, dtype=subj_dtype)
-                    filter_expr = pl.col(input_subject_id_column).is_in(typed_subjects)
-                    df = df.filter(filter_expr)
-
-                    return df
-
-                return read_fn
-
-            def compute_fn(df: pl.LazyFrame) -> pl.LazyFrame:
-                return df
-
-            rwlock_wrap(
-                event_shards,
-                out_fp,
-                read_fntr(subjects, input_subject_id_column),
-                write_df,
-                compute_fn,
-                do_overwrite=cfg.do_overwrite,
+            tasks.append(
+                (
+                    f"{sp}/{input_prefix}",
+                    partial(
+                        rwlock_wrap,
+                        event_shards,
+                        out_fp,
+                        partial(
+                            read_subject_shard,
+                            subjects=subjects,
+                            input_subject_id_column=input_subject_id_column,
+                            join_df=join_df,
+                            join_cfg=join_cfg,
+                        ),
+                        write_df,
+                        _identity,
+                        do_overwrite=cfg.do_overwrite,
+                    ),
+                )
             )
 
+    run_tasks(cfg, tasks)
+
     logger.info("Created a subject-sharded view.")
@@ -0,0 +1,89 @@
+"""Pipeline-wide control over where extracted events are deduplicated.
+
+By default, every event block is made unique as it is extracted in ``convert_to_MEDS_events``, and the merged
+shard is made unique again (over ``merge_to_MEDS_cohort.unique_by``) in ``merge_to_MEDS_cohort``. As every
+extracted event carries its ``source_block``, two rows from different blocks are never equal, so the second
+pass can only remove rows the first one already removed; on large shards, paying for both full-width uniques
+is wasteful. The pipeline-level ``dedup_strategy`` option selects which of them to run:
+
+- ``per_block_and_merge`` (the default): both.
+- ``per_block``: only the per-block unique in ``convert_to_MEDS_events``.
+- ``merge_only``: only the ``unique_by`` unique in ``merge_to_MEDS_cohort``.
+- ``hash_fingerprint``: only a unique in ``merge_to_MEDS_cohort`` on a 64-bit hash of each full row (see
+  ``fingerprint_unique``), which is cheaper than comparing the rows themselves.
+- ``none``: no deduplication at all.
+"""
+
+import polars as pl
+from omegaconf import DictConfig
+
+DEDUP_STRATEGIES = ("per_block_and_merge", "per_block", "merge_only", "hash_fingerprint", "none")
+DEFAULT_DEDUP_STRATEGY = "per_block_and_merge"
+
+
+def get_dedup_strategy(cfg: DictConfig) -> str:
+    """Returns the validated ``dedup_strategy`` of the pipeline.
+
+    Examples:
+        >>> get_dedup_strategy(DictConfig({}))
+        'per_block_and_merge'
+        >>> get_dedup_strategy(DictConfig({"dedup_strategy": "hash_fingerprint"}))
+        'hash_fingerprint'
+        >>> get_dedup_strategy(DictConfig({"dedup_strategy": "sometimes"}))
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid dedup_strategy 'sometimes'; expected one of per_block_and_merge, per_block, ...
+    """
+    strategy = cfg.get("dedup_strategy", None) or DEFAULT_DEDUP_STRATEGY
+    if strategy not in DEDUP_STRATEGIES:
+        strategies = ", ".join(DEDUP_STRATEGIES)
+        raise ValueError(f"Invalid dedup_strategy '{strategy}'; expected one of {strategies}.")
+    return strategy
+
+
+def dedup_per_block(strategy: str) -> bool:
+    """Returns whether event blocks are made unique as they are extracted under ``strategy``.
+
+    Examples:
+        >>> [s for s in DEDUP_STRATEGIES if dedup_per_block(s)]
+        ['per_block_and_merge', 'per_block']
+    """
+    return strategy in ("per_block_and_merge", "per_block")
+
+
+def dedup_on_merge(strategy: str) -> bool:
+    """Returns whether the merged shards are made unique over ``unique_by`` under ``strategy``.
+
+    Examples:
+        >>> [s for s in DEDUP_STRATEGIES if dedup_on_merge(s)]
+        ['per_block_and_merge', 'merge_only']
+    """
+    return strategy in ("per_block_and_merge", "merge_only")
+
+
+def fingerprint_unique(df: pl.LazyFrame, seed: int = 0) -> pl.LazyFrame:
+    """Drops all but the first of each set of rows of ``df`` with equal 64-bit row hashes.
+
+    The hash of each row is computed once, over all columns (including nested ones such as
+    ``code_components``), and rows are kept in their input order. Distinct rows whose hashes collide would be
+    dropped, but with 64-bit hashes this is vanishingly unlikely at the scale of a single shard.
+
+    Examples:
+        >>> df = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 2, 1],
+        ...     "code": ["A", "B", "A", "A"],
+        ...     "code_components": [{"x": "A"}, {"x": "B"}, {"x": "A"}, {"x": "A"}],
+        ... })
+        >>> fingerprint_unique(df).collect()
+        shape: (3, 3)
+        ┌────────────┬──────┬─────────────────┐
+        │ subject_id ┆ code ┆ code_components │
+        │ ---        ┆ ---  ┆ ---             │
+        │ i64        ┆ str  ┆ struct[1]       │
+        ╞════════════╪══════╪═════════════════╡
+        │ 1          ┆ A    ┆ {"A"}           │
+        │ 1          ┆ B    ┆ {"B"}           │
+        │ 2          ┆ A    ┆ {"A"}           │
+        └────────────┴──────┴─────────────────┘
+    """
+    return df.filter(pl.struct(pl.all()).hash(seed=seed).is_first_distinct())
@@ -1,24 +1,30 @@
 """Utilities for extracting code metadata about the codes produced for the MEDS events."""
 
 import copy
+import hashlib
 import logging
-import random
-import time
+import os
+import tempfile
+from collections.abc import Callable
 from datetime import UTC, datetime
 from functools import partial
 from pathlib import Path
 
 import polars as pl
+import pyarrow.parquet as pq
 from dftly import Parser
 from meds import CodeMetadataSchema
-from MEDS_transforms.dataframe import write_df
-from MEDS_transforms.mapreduce.rwlock import rwlock_wrap
+from MEDS_transforms.mapreduce.rwlock import default_file_checker, rwlock_wrap
 from MEDS_transforms.parser import cfg_to_expr
 from MEDS_transforms.stages import Stage
 from omegaconf import DictConfig, OmegaConf
 from upath import UPath
 
-from .utils import get_supported_fp
+from ..barrier import mark_done, wait_until_done
+from ..convert_to_MEDS_events.convert_to_MEDS_events import CODES_SIDECAR_SUFFIX
+from ..shared_state import load_event_conversion_cfg
+from ..task_queue import run_tasks
+from .utils import get_supported_fp, read_concat, read_through_cache
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +39,7 @@ MEDS_METADATA_MANDATORY_TYPES = {
 def extract_metadata(
     metadata_df: pl.LazyFrame,
     event_cfg: dict[str, str | None],
-    allowed_codes: list | None = None,
+    allowed_codes: list | pl.LazyFrame | None = None,
 ) -> pl.LazyFrame:
     """Extracts a single metadata dataframe block for an event configuration from the raw metadata.
 
@@ -214,7 +220,9 @@ def extract_metadata(
             code_template=pl.lit(code_template_str),
         )
 
-        if allowed_codes:
+        if isinstance(allowed_codes, pl.LazyFrame):
+            metadata_df = metadata_df.join(allowed_codes.select("code"), on="code", how="semi")
+        elif allowed_codes:
             metadata_df = metadata_df.filter(pl.col("code").is_in(allowed_codes))
 
     metadata_df = metadata_df.filter(~pl.all_horizontal(*[pl.col(c).is_null() for c in final_cols]))
@@ -234,7 +242,7 @@ def extract_metadata(
 
 
 def extract_all_metadata(
-    metadata_df: pl.LazyFrame, event_cfgs: list[dict], allowed_codes: list | None = None
+    metadata_df: pl.LazyFrame, event_cfgs: list[dict], allowed_codes: list | pl.LazyFrame | None = None
 ) -> pl.LazyFrame:
     """Extracts all metadata for a list of event configurations.
 
@@ -243,7 +251,9 @@ def extract_all_metadata(
             configurations.
         event_cfgs: A list of event configuration dictionaries. Each dictionary must contain the code
             and metadata elements.
-        allowed_codes: A list of codes to allow in the output metadata. If None, all codes are allowed.
+        allowed_codes: The codes to allow in the output metadata, as a list or as the ``code`` column of a
+            frame (such as the vocabulary of ``load_code_vocabulary``), which is semi-joined against rather
+            than expanded into an ``is_in`` list. If None, all codes are allowed.
 
     Returns:
         A unified DF containing all metadata for all event configurations.
@@ -276,6 +286,17 @@ def extract_all_metadata(
         │ FOO//A//1 ┆ f"FOO//{$code}//{$code_modifie… ┆ Code A-1 ┆ null  │
         │ BAR//B//2 ┆ f"BAR//{$code}//{$code_modifie… ┆ null     ┆ B-2   │
         └───────────┴─────────────────────────────────┴──────────┴───────┘
+        >>> vocabulary = pl.LazyFrame({"code": ["BAR//B//2", "FOO//C//3"]})
+        >>> extract_all_metadata(raw_metadata.lazy(), event_cfgs, allowed_codes=vocabulary).collect()
+        shape: (2, 4)
+        ┌───────────┬─────────────────────────────────┬──────────┬───────┐
+        │ code      ┆ code_template                   ┆ desc     ┆ desc2 │
+        │ ---       ┆ ---                             ┆ ---      ┆ ---   │
+        │ str       ┆ str                             ┆ str      ┆ str   │
+        ╞═══════════╪═════════════════════════════════╪══════════╪═══════╡
+        │ FOO//C//3 ┆ f"FOO//{$code}//{$code_modifie… ┆ C with 3 ┆ null  │
+        │ BAR//B//2 ┆ f"BAR//{$code}//{$code_modifie… ┆ null     ┆ B-2   │
+        └───────────┴─────────────────────────────────┴──────────┴───────┘
     """
 
     all_metadata = []
@@ -285,6 +306,77 @@ def extract_all_metadata(
     return pl.concat(all_metadata, how="diagonal_relaxed").unique(maintain_order=True)
 
 
+def extract_metadata_per_config(
+    metadata_df: pl.LazyFrame, event_cfgs: list[dict], allowed_codes: list | pl.LazyFrame | None = None
+) -> list[pl.DataFrame]:
+    """Extracts the metadata of each event configuration separately, from a single read of the raw metadata.
+
+    The extractions (see ``extract_all_metadata``) are collected together via ``pl.collect_all``, so the scan
+    of the raw metadata they share runs only once, and in parallel with the others, rather than once per
+    event configuration.
+
+    Examples:
+        >>> raw_metadata = pl.DataFrame({"code": ["A", "B"], "name": ["Code A", "Code B"]})
+        >>> event_cfgs = [
+        ...     {"code": 'f"FOO//{$code}"', "_metadata": {"desc": "name"}},
+        ...     {"code": 'f"BAR//{$code}"', "_metadata": {"desc2": "name"}},
+        ... ]
+        >>> for df in extract_metadata_per_config(raw_metadata.lazy(), event_cfgs, allowed_codes=["BAR//B"]):
+        ...     print(df.columns, df["code"].to_list())
+        ['code', 'code_template', 'desc'] []
+        ['code', 'code_template', 'desc2'] ['BAR//B']
+    """
+    metadata_df = metadata_df.lazy()
+    extractions = [extract_all_metadata(metadata_df, [c], allowed_codes=allowed_codes) for c in event_cfgs]
+    return pl.collect_all(extractions)
+
+
+def referenced_metadata_columns(event_cfgs: list[dict]) -> list[str]:
+    """Returns the raw metadata columns that the codes and ``_metadata`` blocks of ``event_cfgs`` reference.
+
+    Examples:
+        >>> referenced_metadata_columns([
+        ...     {"code": 'f"FOO//{$code}//{$code_modifier}"', "_metadata": {"desc": "name"}},
+        ...     {"code": 'f"BAR//{$code}"', "_metadata": {"desc": ["title", "name"], "_match_on": "code"}},
+        ... ])
+        ['code', 'code_modifier', 'name', 'title']
+    """
+    columns = set()
+    for event_cfg in event_cfgs:
+        metadata_cfg = dict(event_cfg.get("_metadata", None) or {})
+        metadata_cfg.pop("_match_on", None)  # Always a subset of the columns the code references.
+        for in_cfg in metadata_cfg.values():
+            columns.update(cfg_to_expr(in_cfg)[1])
+        columns.update(Parser()(str(event_cfg["code"])).referenced_columns)
+    return sorted(columns)
+
+
+def write_metadata_per_config(dfs: list[pl.DataFrame], out_fp: Path, out_fps: list[Path]):
+    """Writes each of the per-config metadata ``dfs`` to the matching path of ``out_fps``, in order.
+
+    ``out_fp`` is the output guarded by ``rwlock_wrap``, which must be the last of ``out_fps``, so that it
+    only exists once all of them have been written.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fps = [Path(tmpdir) / "labs_0.parquet", Path(tmpdir) / "labs_1.parquet"]
+        ...     dfs = [pl.DataFrame({"code": ["A"]}), pl.DataFrame({"code": ["B"]})]
+        ...     write_metadata_per_config(dfs, out_fps[-1], out_fps)
+        ...     print([pl.read_parquet(fp)["code"].to_list() for fp in out_fps])
+        [['A'], ['B']]
+        >>> write_metadata_per_config(dfs, out_fps[0], out_fps)
+        Traceback (most recent call last):
+            ...
+        ValueError: The guarded output .../labs_0.parquet must be the last of the outputs ...
+    """
+    if out_fp != out_fps[-1]:
+        raise ValueError(f"The guarded output {out_fp} must be the last of the outputs {out_fps}.")
+
+    for df, fp in zip(dfs, out_fps, strict=True):
+        fp.parent.mkdir(parents=True, exist_ok=True)
+        df.write_parquet(fp, use_pyarrow=True)
+
+
 def get_events_and_metadata_by_metadata_fp(
     event_configs: dict | DictConfig,
 ) -> dict[str, dict[str, dict]]:
@@ -369,6 +461,319 @@ def get_events_and_metadata_by_metadata_fp(
     return out
 
 
+CODE_VOCABULARY_FN = ".code_vocabulary.parquet"
+
+
+def load_code_vocabulary(
+    code_fps: list[Path], vocabulary_fp: Path, do_overwrite: bool = False
+) -> pl.LazyFrame:
+    """Returns the distinct codes in the ``code`` columns of ``code_fps``, reducing them only once.
+
+    The distinct codes are written to ``vocabulary_fp`` and, unless ``do_overwrite`` is set, later calls
+    (e.g., from other workers) just read that file. It is written to a temporary file that is then renamed,
+    so a reader never sees a partial vocabulary.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     code_fps = [Path(tmpdir) / "a.parquet", Path(tmpdir) / "b.parquet"]
+        ...     pl.DataFrame({"code": ["A", "B", "A"]}).write_parquet(code_fps[0])
+        ...     pl.DataFrame({"code": ["C", "B"]}, schema={"code": pl.Categorical}).write_parquet(code_fps[1])
+        ...     vocabulary_fp = Path(tmpdir) / CODE_VOCABULARY_FN
+        ...     print(sorted(load_code_vocabulary(code_fps, vocabulary_fp).collect()["code"]))
+        ...     code_fps[1].unlink()
+        ...     print(sorted(load_code_vocabulary(code_fps, vocabulary_fp).collect()["code"]))
+        ['A', 'B', 'C']
+        ['A', 'B', 'C']
+    """
+    if do_overwrite or not vocabulary_fp.is_file():
+        logger.info(f"Reducing the codes of {len(code_fps)} files into {vocabulary_fp}")
+        codes = pl.concat(
+            [
+                pl.LazyFrame(schema={"code": pl.String}),
+                *(pl.scan_parquet(fp, glob=False).select(pl.col("code").cast(pl.String)) for fp in code_fps),
+            ],
+            how="vertical",
+        ).unique()
+        vocabulary_fp.parent.mkdir(parents=True, exist_ok=True)
+        fd, partial_fp = tempfile.mkstemp(dir=vocabulary_fp.parent, prefix=f"{vocabulary_fp.name}.")
+        os.close(fd)
+        codes.collect().write_parquet(partial_fp)
+        Path(partial_fp).replace(vocabulary_fp)
+    return pl.scan_parquet(vocabulary_fp, glob=False)
+
+
+DONE_MARKERS_DIRNAME = ".done"
+REDUCE_PARTITIONS_DIRNAME = ".reduce"
+AGGREGATED_METADATA_KEY = b"MEDS_extract:aggregated"
+
+
+def run_and_mark_done(
+    task_fn: Callable[[], bool], out_fps: list[Path], marker_dir: Path, do_overwrite: bool
+) -> bool:
+    """Runs the ``rwlock_wrap``-ed ``task_fn`` and marks its outputs ``out_fps`` done (see ``barrier``).
+
+    As ``rwlock_wrap`` returns ``False`` both when its output was already complete and when another worker
+    holds its lock, the outputs are marked done only if this call wrote them or they were complete beforehand;
+    in the latter case, the worker holding the lock marks them once they are written.
+
+    Examples:
+        >>> from MEDS_extract.barrier import is_done
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp, marker_dir = Path(tmpdir) / "out.parquet", Path(tmpdir) / ".done"
+        ...     print(run_and_mark_done(lambda: False, [out_fp], marker_dir, do_overwrite=False))
+        ...     print(is_done(out_fp, marker_dir))
+        ...     pl.DataFrame({"code": ["A"]}).write_parquet(out_fp)
+        ...     print(run_and_mark_done(lambda: False, [out_fp], marker_dir, do_overwrite=False))
+        ...     print(is_done(out_fp, marker_dir))
+        False
+        False
+        False
+        True
+    """
+    was_complete = not do_overwrite and all(default_file_checker(fp) for fp in out_fps)
+    computed = task_fn()
+    if computed or was_complete:
+        for fp in out_fps:
+            mark_done(fp, marker_dir)
+    return computed
+
+
+def outputs_digest(fps: list[Path]) -> str:
+    """Returns a short digest of the names, sizes, and modification times of the files ``fps``.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "out.parquet"
+        ...     _ = fp.write_text("data")
+        ...     digest = outputs_digest([fp])
+        ...     print(len(digest), digest == outputs_digest([fp]))
+        ...     _ = fp.write_text("more data")
+        ...     print(digest == outputs_digest([fp]))
+        16 True
+        False
+    """
+    digest = hashlib.sha1()
+    for fp in sorted(fps):
+        stat = fp.stat()
+        digest.update(f"{fp.name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def scan_code_component_map(event_fps: list[Path], sidecar_fps: list[Path]) -> pl.LazyFrame | None:
+    """Returns a lazy frame of the codes and their (unnested) code components, or ``None`` if there are none.
+
+    The events may have heterogeneous schemas (some with ``code_components`` and others without); if none of
+    them have code components, they are read from the code sidecars ``sidecar_fps`` instead. Nothing but the
+    schemas is read here: the frame is not made unique or collected, so each partial-match expansion (see
+    ``collect_code_metadata``) reads only the components it matches on, and the whole map is never held in
+    memory.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     event_fps = [Path(tmpdir) / "a.parquet", Path(tmpdir) / "b.parquet"]
+        ...     components = [{"x": "1"}, {"x": "1"}]
+        ...     pl.DataFrame({"code": ["X", "X"], "code_components": components}).write_parquet(event_fps[0])
+        ...     pl.DataFrame({"code": ["Y"]}).write_parquet(event_fps[1])
+        ...     print(sorted(scan_code_component_map(event_fps, []).unique().collect().rows()))
+        ...     print(scan_code_component_map(event_fps[1:], []))
+        [('X', '1'), ('Y', None)]
+        None
+    """
+    code_data = pl.concat(
+        [pl.scan_parquet(fp, glob=False) for fp in event_fps], how="diagonal_relaxed"
+    ).with_columns(pl.col("code").cast(pl.String))
+    if sidecar_fps and "code_components" not in code_data.collect_schema():
+        logger.info(f"Reading code components from {len(sidecar_fps)} sidecar files")
+        code_data = pl.concat(
+            [pl.scan_parquet(fp, glob=False) for fp in sidecar_fps], how="diagonal_relaxed"
+        ).with_columns(pl.col("code").cast(pl.String))
+
+    if "code_components" not in code_data.collect_schema():
+        return None
+    return code_data.select("code", "code_components").unnest("code_components")
+
+
+def collect_code_metadata(
+    partition: int,
+    n_partitions: int,
+    out_fps: list[Path],
+    match_on_by_fp: dict[Path, list[str]],
+    event_fps: list[Path],
+    sidecar_fps: list[Path],
+) -> pl.LazyFrame:
+    """Returns the distinct rows of the extracted metadata ``out_fps`` whose codes are in ``partition``.
+
+    Partial-match outputs (those without a ``code`` column, whose ``_match_on`` columns are given in
+    ``match_on_by_fp``) are expanded to full codes via the code components of the events (see
+    ``scan_code_component_map``), which are only scanned if there are any such outputs. Codes are assigned
+    to one of ``n_partitions`` partitions by their hash, so all rows of a code fall in the same partition.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     full_fp, partial_fp = Path(tmpdir) / "full.parquet", Path(tmpdir) / "partial.parquet"
+        ...     pl.DataFrame({"code": ["A", "B", "A"], "description": ["a", "b", "a"]}).write_parquet(full_fp)
+        ...     pl.DataFrame({"x": ["1"], "description": ["x1"]}).write_parquet(partial_fp)
+        ...     event_fp = Path(tmpdir) / "events.parquet"
+        ...     pl.DataFrame({"code": ["X//1"], "code_components": [{"x": "1"}]}).write_parquet(event_fp)
+        ...     kwargs = dict(
+        ...         out_fps=[full_fp, partial_fp],
+        ...         match_on_by_fp={partial_fp: ["x"]},
+        ...         event_fps=[event_fp],
+        ...         sidecar_fps=[],
+        ...     )
+        ...     print(collect_code_metadata(0, 1, **kwargs).collect().rows())
+        ...     partitions = [collect_code_metadata(i, 3, **kwargs).collect() for i in range(3)]
+        ...     print(sorted(pl.concat(partitions).rows()))
+        [('A', 'a'), ('B', 'b'), ('X//1', 'x1')]
+        [('A', 'a'), ('B', 'b'), ('X//1', 'x1')]
+    """
+    # Separate partial-match outputs (no "code" column) from full-match outputs
+    full_match_dfs = []
+    partial_match_dfs = []
+    for fp in out_fps:
+        df = pl.scan_parquet(fp, glob=False)
+        if "code" in df.collect_schema():
+            full_match_dfs.append(df)
+        elif fp in match_on_by_fp:
+            partial_match_dfs.append((df, match_on_by_fp[fp]))
+
+    in_partition = pl.col("code").hash(0) % n_partitions == partition
+
+    # Expand partial-match metadata to full codes via code_components. Each expansion reads only the codes and
+    # the components it matches on, and only those of this partition.
+    code_component_map = scan_code_component_map(event_fps, sidecar_fps) if partial_match_dfs else None
+    if partial_match_dfs and code_component_map is not None:
+        for pdf, match_cols in partial_match_dfs:
+            pdf_cols = pdf.collect_schema().names()
+            metadata_cols_partial = [c for c in pdf_cols if c not in match_cols]
+            components = code_component_map.select("code", *match_cols)
+            if n_partitions > 1:
+                components = components.filter(in_partition)
+            expanded = (
+                components.unique()
+                .join(pdf, on=match_cols, how="inner")
+                .select("code", *metadata_cols_partial)
+            )
+            full_match_dfs.append(expanded)
+    elif partial_match_dfs:
+        logger.warning("Partial-match metadata found but no code_components in data. Skipping.")
+
+    if not full_match_dfs:
+        logger.info("No metadata to reduce. Writing empty metadata file.")
+        return pl.DataFrame({"code": []}).cast({"code": pl.String}).lazy()
+
+    metadata = pl.concat(full_match_dfs, how="diagonal_relaxed")
+    if n_partitions > 1:
+        metadata = metadata.filter(in_partition)
+    return metadata.unique(maintain_order=True)
+
+
+def aggregate_code_metadata(
+    metadata: pl.LazyFrame, join_cols: list[str], description_separator: str
+) -> pl.LazyFrame:
+    """Aggregates the metadata rows of each code (and code modifiers) into one.
+
+    Descriptions are joined with ``description_separator``, parent codes are concatenated, the first code
+    template is kept, and all other (non-mandatory) metadata columns are collected into lists.
+
+    Examples:
+        >>> metadata = pl.LazyFrame({
+        ...     "code": ["A", "A", "B"],
+        ...     "description": ["a1", "a2", "b"],
+        ...     "parent_codes": [["P/1"], ["P/2"], None],
+        ...     "units": ["mg", "g", None],
+        ... })
+        >>> aggregate_code_metadata(metadata, ["code"], "; ").sort("code").collect().rows()
+        [('A', ['mg', 'g'], 'a1; a2', ['P/1', 'P/2']), ('B', [None], 'b', [None])]
+    """
+    metadata_cols = [c for c in metadata.collect_schema().names() if c not in join_cols]
+
+    skip_cols = {*MEDS_METADATA_MANDATORY_TYPES, "code_template"}
+    aggs = {c: pl.col(c) for c in metadata_cols if c not in skip_cols}
+    if "description" in metadata_cols:
+        aggs["description"] = pl.col("description").str.join(description_separator)
+    if "parent_codes" in metadata_cols:
+        aggs["parent_codes"] = pl.col("parent_codes").explode()
+    if "code_template" in metadata_cols:
+        aggs["code_template"] = pl.col("code_template").first()
+
+    return metadata.group_by(join_cols).agg(**aggs)
+
+
+def reduce_code_metadata(
+    metadata: pl.LazyFrame, join_cols: list[str], description_separator: str
+) -> tuple[pl.DataFrame, bool]:
+    """Reduces the distinct metadata rows to one per code, returning them and whether they were aggregated.
+
+    The metadata is collected once, by Polars' streaming engine, so that lazy inputs such as the partial-match
+    expansions of ``collect_code_metadata`` are computed in batches rather than materialized whole. If no code
+    (and code modifiers) then has more than one row, the rows are returned as they are; otherwise, they are
+    aggregated via ``aggregate_code_metadata``.
+
+    Examples:
+        >>> metadata = pl.LazyFrame({"code": ["A", "B"], "description": ["a", "b"]})
+        >>> reduced, aggregated = reduce_code_metadata(metadata, ["code"], "; ")
+        >>> reduced.rows(), aggregated
+        ([('A', 'a'), ('B', 'b')], False)
+        >>> metadata = pl.LazyFrame({"code": ["A", "A"], "description": ["a1", "a2"]})
+        >>> reduced, aggregated = reduce_code_metadata(metadata, ["code"], "; ")
+        >>> reduced.rows(), aggregated
+        ([('A', 'a1; a2')], True)
+    """
+    metadata = metadata.collect(engine="streaming")
+    n_unique_obs = metadata.select(pl.n_unique(*join_cols)).item()
+    n_rows = metadata.height
+    logger.info(f"Collected metadata for {n_unique_obs} unique codes among {n_rows} total observations.")
+
+    if n_unique_obs == n_rows:
+        return metadata, False
+    return aggregate_code_metadata(metadata.lazy(), join_cols, description_separator).collect(), True
+
+
+def write_reduced_partition(reduced: tuple[pl.DataFrame, bool], out_fp: Path):
+    """Writes a partition reduced by ``reduce_code_metadata``, recording whether it was aggregated."""
+    df, aggregated = reduced
+    table = df.to_arrow()
+    metadata = {**(table.schema.metadata or {}), AGGREGATED_METADATA_KEY: str(aggregated).lower().encode()}
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    pq.write_table(table.replace_schema_metadata(metadata), out_fp)
+
+
+def combine_reduced_partitions(
+    partition_fps: list[Path], join_cols: list[str], description_separator: str
+) -> pl.DataFrame:
+    """Concatenates the reduced partitions ``partition_fps`` into the reduced metadata of all codes.
+
+    If any partition was aggregated, so that its metadata columns are lists, the others are aggregated too,
+    just as they would have been had all codes been reduced together.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fps = [Path(tmpdir) / "0.parquet", Path(tmpdir) / "1.parquet"]
+        ...     parts = [{"code": ["A", "A"], "units": ["mg", "g"]}, {"code": ["B"], "units": ["ml"]}]
+        ...     for part, fp in zip(parts, fps):
+        ...         write_reduced_partition(reduce_code_metadata(pl.LazyFrame(part), ["code"], "; "), fp)
+        ...     print(combine_reduced_partitions(fps, ["code"], "; ").sort("code").rows())
+        ...     print(combine_reduced_partitions(fps[1:], ["code"], "; ").rows())
+        [('A', ['mg', 'g']), ('B', ['ml'])]
+        [('B', 'ml')]
+    """
+    partitions = []
+    for fp in partition_fps:
+        metadata = pq.read_schema(fp).metadata or {}
+        partitions.append((pl.read_parquet(fp), metadata.get(AGGREGATED_METADATA_KEY) == b"true"))
+
+    if any(aggregated for _, aggregated in partitions):
+        aggregate = partial(
+            aggregate_code_metadata, join_cols=join_cols, description_separator=description_separator
+        )
+        partitions = [df if aggregated else aggregate(df.lazy()).collect() for df, aggregated in partitions]
+    else:
+        partitions = [df for df, _ in partitions]
+
+    return pl.concat(partitions, how="diagonal_relaxed")
+
+
 @Stage.register(is_metadata=True)
 def main(cfg: DictConfig):
     """Extracts any dataset-specific metadata and adds it to any existing code metadata file.
@@ -395,8 +800,31 @@ def main(cfg: DictConfig):
             a row, this string will be used as a separator to join the matches for the sentinel
             `"description"` column into a single string in the output metadata, per compliance with the MEDS
             schema.
+        stage_cfg.code_components_dir: The output directory of ``convert_to_MEDS_events``, if that stage
+            was run with a ``code_sidecar``. The code vocabulary (and, if the events lack them, the code
+            components used to expand partial-match metadata) are then read from its per-file code sidecars
+            rather than from the event data.
+        stage_cfg.reduce_partitions: The number of partitions of the codes to reduce the metadata in. With
+            one (the default), worker 0 reduces all of it once every map output is written. With more, every
+            worker reduces whole partitions (see ``collect_code_metadata``) in parallel, and worker 0 then
+            only concatenates them.
+        stage_cfg.metadata_cache_dir: If set, a directory in which to cache each raw CSV metadata file as
+            Parquet (see ``read_through_cache``), projected to the columns its event configurations reference
+            (see ``referenced_metadata_columns``). The first read of a file converts it, and all later reads,
+            by any worker or later run using the same directory, scan the cache rather than parsing it again.
+
+    Workers mark each output done once it is written (see ``barrier``), and reducers wait on these markers,
+    waking as soon as the last one lands (or, where that cannot be watched for, re-checking with a backoff of
+    up to ``polling_time`` seconds).
+
+    The distinct codes of the dataset are reduced once into a vocabulary file in the stage's output directory
+    (see ``load_code_vocabulary``), against which each metadata table is semi-joined. Each metadata source is
+    read in a single task, which extracts the metadata of all event configurations that reference it (see
+    ``extract_metadata_per_config``) and writes one output per configuration.
     """
 
+    pl.enable_string_cache()
+
     stage_input_dir = Path(cfg.stage_cfg.data_input_dir)
     partial_metadata_dir = Path(cfg.stage_cfg.output_dir)
     raw_input_dir = UPath(cfg.input_dir)
@@ -406,7 +834,7 @@ def main(cfg: DictConfig):
         raise FileNotFoundError(f"Event conversion config file not found: {event_conversion_cfg_fp}")
 
     logger.info(f"Reading event conversion config from {event_conversion_cfg_fp}")
-    event_conversion_cfg = OmegaConf.load(event_conversion_cfg_fp)
+    event_conversion_cfg = load_event_conversion_cfg(event_conversion_cfg_fp)
     logger.info(f"Event conversion config:\n{OmegaConf.to_yaml(event_conversion_cfg)}")
 
     partial_metadata_dir.mkdir(parents=True, exist_ok=True)
@@ -418,27 +846,31 @@ def main(cfg: DictConfig):
         return
 
     event_metadata_configs = list(events_and_metadata_by_metadata_fp.items())
-    random.shuffle(event_metadata_configs)
-
-    # Load all codes and code_components from extracted data, handling heterogeneous schemas
-    # (some event files have code_components and others don't).
-    event_parquet_files = list(Path(stage_input_dir).rglob("*.parquet"))
-    all_event_dfs = [pl.scan_parquet(fp, glob=False) for fp in event_parquet_files]
-    all_data = pl.concat(all_event_dfs, how="diagonal_relaxed")
-    all_codes = all_data.select(pl.col("code").unique()).collect().get_column("code").to_list()
-
-    # Build code_components mapping for partial metadata joins
-    data_schema = all_data.collect_schema()
-    if "code_components" in data_schema:
-        code_component_map = (
-            all_data.select("code", "code_components").unique().collect().unnest("code_components")
-        )
-    else:
-        code_component_map = None
+
+    # Codes and code_components are read from the per-file code sidecars of convert_to_MEDS_events if there
+    # are any, as they are much smaller than the event data.
+    event_fps = sorted(Path(stage_input_dir).rglob("*.parquet"))
+    sidecar_fps = []
+    code_components_dir = cfg.stage_cfg.get("code_components_dir", None)
+    if code_components_dir:
+        sidecar_fps = sorted(Path(code_components_dir).rglob(f"*{CODES_SIDECAR_SUFFIX}"))
+        if not sidecar_fps:
+            logger.warning(f"No code sidecar files found in {code_components_dir}; using the event data.")
+
+    # The distinct codes are reduced once into a vocabulary file, which each metadata table is semi-joined to.
+    vocabulary = load_code_vocabulary(
+        sidecar_fps or event_fps, partial_metadata_dir / CODE_VOCABULARY_FN, do_overwrite=cfg.do_overwrite
+    )
+
+    # Each map and reduce output is marked done in this directory once written, for the reducers to wait on.
+    marker_dir = partial_metadata_dir / DONE_MARKERS_DIRNAME
+
+    metadata_cache_dir = cfg.stage_cfg.get("metadata_cache_dir", None)
 
     all_out_fps = []
     # Collect _match_on columns per output file for use during reduction
     match_on_by_fp: dict[Path, list[str]] = {}
+    tasks = []
     for input_prefix, event_metadata_cfgs in event_metadata_configs:
         event_metadata_cfgs = copy.deepcopy(event_metadata_cfgs)
 
@@ -449,40 +881,55 @@ def main(cfg: DictConfig):
 
         if metadata_fps[0].suffix != ".parquet":
             read_fn = partial(read_fn, infer_schema=False)
+            if metadata_cache_dir:
+                read_fn = partial(
+                    read_through_cache,
+                    read_fn=read_fn,
+                    cache_dir=Path(metadata_cache_dir),
+                    columns=referenced_metadata_columns(event_metadata_cfgs),
+                )
 
         if len(metadata_fps) > 1:
-            read_fn_raw = read_fn
-
-            def read_fn(fps):
-                return pl.concat([read_fn_raw(fp) for fp in fps], how="vertical")  # noqa: B023
-
+            read_fn = partial(read_concat, read_fn=read_fn)
             metadata_fp = metadata_fps
         else:
             metadata_fp = metadata_fps[0]
 
         # Write one output file per individual event config so each is unambiguously
         # full-match or partial-match. A single metadata prefix can be referenced by
-        # multiple event configs with different match modes.
-        for cfg_idx, event_cfg in enumerate(event_metadata_cfgs):
-            out_fp = partial_metadata_dir / f"{input_prefix}_{cfg_idx}.parquet"
-            logger.info(f"Extracting metadata from {metadata_fp} and saving to {out_fp}")
-
-            compute_fn = partial(
-                extract_all_metadata,
-                event_cfgs=[event_cfg],
-                allowed_codes=all_codes,
-            )
+        # multiple event configs with different match modes. All of them are extracted in
+        # one task, from one read of the metadata source.
+        out_fps = [
+            partial_metadata_dir / f"{input_prefix}_{cfg_idx}.parquet"
+            for cfg_idx in range(len(event_metadata_cfgs))
+        ]
+        logger.info(f"Extracting metadata from {metadata_fp} for {len(out_fps)} event configs")
+
+        compute_fn = partial(
+            extract_metadata_per_config,
+            event_cfgs=event_metadata_cfgs,
+            allowed_codes=vocabulary,
+        )
 
-            rwlock_wrap(
-                metadata_fp,
-                out_fp,
-                read_fn,
-                write_df,
-                compute_fn,
-                do_overwrite=cfg.do_overwrite,
+        # The outputs are written in order, so the last one existing means the task is complete.
+        task_fn = partial(
+            rwlock_wrap,
+            metadata_fp,
+            out_fps[-1],
+            read_fn,
+            partial(write_metadata_per_config, out_fps=out_fps),
+            compute_fn,
+            do_overwrite=cfg.do_overwrite,
+        )
+        tasks.append(
+            (
+                input_prefix,
+                partial(run_and_mark_done, task_fn, out_fps, marker_dir, cfg.do_overwrite),
             )
-            all_out_fps.append(out_fp)
+        )
+        all_out_fps.extend(out_fps)
 
+        for out_fp, event_cfg in zip(out_fps, event_metadata_cfgs, strict=True):
             # Record _match_on columns for this shard so the reducer can use them explicitly
             match_on = event_cfg.get("_metadata", {}).get("_match_on")
             if match_on is not None:
@@ -490,74 +937,73 @@ def main(cfg: DictConfig):
                     match_on = [match_on]
                 match_on_by_fp[out_fp] = list(match_on)
 
+    run_tasks(cfg, tasks)
+
     logger.info("Extracted metadata for all events. Merging.")
 
-    if cfg.worker != 0:  # pragma: no cover
+    n_partitions = cfg.stage_cfg.get("reduce_partitions", None) or 1
+    if cfg.worker != 0 and n_partitions == 1:  # pragma: no cover
         logger.info("Code metadata extraction completed. Exiting")
         return
 
-    logger.info("Starting reduction process")
-
-    while not all(fp.exists() for fp in all_out_fps):  # pragma: no cover
-        missing_files_str = "\n".join(f"  - {fp.resolve()!s}" for fp in all_out_fps if not fp.exists())
-        logger.info(f"Waiting to begin reduction for all files to be written...\n{missing_files_str}")
-        time.sleep(cfg.polling_time)
+    logger.info("Waiting to begin reduction for all map outputs to be written")
+    wait_until_done(all_out_fps, marker_dir, max_interval=cfg.polling_time)
 
     start = datetime.now(tz=UTC)
     logger.info("All map shards complete! Starting code metadata reduction computation.")
 
-    # Separate partial-match outputs (no "code" column) from full-match outputs
-    full_match_dfs = []
-    partial_match_dfs = []
-    for fp in all_out_fps:
-        df = pl.scan_parquet(fp, glob=False)
-        if "code" in df.collect_schema():
-            full_match_dfs.append(df)
-        elif fp in match_on_by_fp:
-            partial_match_dfs.append((df, match_on_by_fp[fp]))
-
-    # Expand partial-match metadata to full codes via code_components
-    if partial_match_dfs and code_component_map is not None:
-        for pdf, match_cols in partial_match_dfs:
-            pdf_cols = pdf.collect_schema().names()
-            metadata_cols_partial = [c for c in pdf_cols if c not in match_cols]
-            expanded = (
-                code_component_map.lazy()
-                .join(pdf, on=match_cols, how="inner")
-                .select("code", *metadata_cols_partial)
-            )
-            full_match_dfs.append(expanded)
-    elif partial_match_dfs:
-        logger.warning("Partial-match metadata found but no code_components in data. Skipping.")
-
-    if not full_match_dfs:
-        logger.info("No metadata to reduce. Writing empty metadata file.")
-        reduced = pl.DataFrame({"code": []}).cast({"code": pl.String}).lazy()
-    else:
-        reduced = pl.concat(full_match_dfs, how="diagonal_relaxed").unique(maintain_order=True)
-
     join_cols = ["code", *cfg.get("code_modifier_cols", [])]
-    reduced_cols = reduced.collect_schema().names()
-    metadata_cols = [c for c in reduced_cols if c not in join_cols]
-
-    n_unique_obs = reduced.select(pl.n_unique(*join_cols)).collect().item()
-    n_rows = reduced.select(pl.len()).collect().item()
-    logger.info(f"Collected metadata for {n_unique_obs} unique codes among {n_rows} total observations.")
-
-    if n_unique_obs != n_rows:
-        skip_cols = {*MEDS_METADATA_MANDATORY_TYPES, "code_template"}
-        aggs = {c: pl.col(c) for c in metadata_cols if c not in skip_cols}
-        if "description" in metadata_cols:
-            separator = cfg.stage_cfg.description_separator
-            aggs["description"] = pl.col("description").str.join(separator)
-        if "parent_codes" in metadata_cols:
-            aggs["parent_codes"] = pl.col("parent_codes").explode()
-        if "code_template" in metadata_cols:
-            aggs["code_template"] = pl.col("code_template").first()
+    read_metadata = partial(
+        collect_code_metadata,
+        out_fps=all_out_fps,
+        match_on_by_fp=match_on_by_fp,
+        event_fps=event_fps,
+        sidecar_fps=sidecar_fps,
+        n_partitions=n_partitions,
+    )
+    reduce_fn = partial(
+        reduce_code_metadata,
+        join_cols=join_cols,
+        description_separator=cfg.stage_cfg.description_separator,
+    )
+
+    if n_partitions == 1:
+        reduced, _ = reduce_fn(read_metadata(0))
+    else:
+        # Each worker reduces whole partitions of the codes; the partitions of a run are kept in a directory
+        # named for the map outputs they reduce, so partitions of a previous run are never mistaken for them.
+        run_id = outputs_digest(all_out_fps)
+        partition_fps = [
+            partial_metadata_dir / REDUCE_PARTITIONS_DIRNAME / run_id / f"{i}.parquet"
+            for i in range(n_partitions)
+        ]
+        reduce_tasks = []
+        for i, partition_fp in enumerate(partition_fps):
+            task_fn = partial(
+                rwlock_wrap,
+                i,
+                partition_fp,
+                read_metadata,
+                write_reduced_partition,
+                reduce_fn,
+                do_overwrite=cfg.do_overwrite,
+            )
+            reduce_tasks.append(
+                (
+                    f"{REDUCE_PARTITIONS_DIRNAME}/{run_id}/{i}",
+                    partial(run_and_mark_done, task_fn, [partition_fp], marker_dir, cfg.do_overwrite),
+                )
+            )
+        run_tasks(cfg, reduce_tasks)
 
-        reduced = reduced.group_by(join_cols).agg(**aggs)
+        if cfg.worker != 0:  # pragma: no cover
+            logger.info("Code metadata reduction completed. Exiting")
+            return
 
-    reduced = reduced.collect()
+        wait_until_done(partition_fps, marker_dir, max_interval=cfg.polling_time)
+        reduced = combine_reduced_partitions(
+            partition_fps, join_cols=join_cols, description_separator=cfg.stage_cfg.description_separator
+        )
 
     metadata_input_dir = Path(cfg.stage_cfg.metadata_input_dir)
     old_metadata_fp = metadata_input_dir / "codes.parquet"
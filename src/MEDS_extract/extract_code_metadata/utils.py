@@ -1,7 +1,10 @@
 import gzip
+import hashlib
 import logging
+import os
+import tempfile
 import warnings
-from collections.abc import Callable
+from collections.abc import Callable, Sequence
 from enum import StrEnum
 from pathlib import Path
 from typing import TypeVar
@@ -133,3 +136,99 @@ def get_supported_fp(root_dir: Path, file_prefix: str | Path) -> tuple[Path, Cal
         f"No files found with prefix: {file_prefix} and allowed suffixes "
         f"{[x.value for x in SupportedFileFormats]} in root dir {root_dir.resolve()!s}"
     )
+
+
+def read_concat(fps: Sequence[Path], read_fn: Callable[[Path], pl.LazyFrame]) -> pl.LazyFrame:
+    """Reads each of ``fps`` with ``read_fn`` and concatenates them vertically.
+
+    Examples:
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     fps = [Path(tmpdir) / f"{i}.csv" for i in range(2)]
+        ...     for i, fp in enumerate(fps):
+        ...         pl.DataFrame({"code": [f"A{i}"]}).write_csv(fp)
+        ...     print(read_concat(fps, pl.scan_csv).collect()["code"].to_list())
+        ['A0', 'A1']
+    """
+    return pl.concat([read_fn(fp) for fp in fps], how="vertical")
+
+
+def metadata_cache_fp(fp: Path, cache_dir: Path, columns: Sequence[str] | None = None) -> Path:
+    """Returns the path of the columnar cache of the raw metadata file ``fp`` in ``cache_dir``.
+
+    The cache is keyed by the path, size, and modification time of ``fp``, so a file that is changed or
+    replaced gets a new cache entry rather than a stale one, and by the ``columns`` it is projected to, if
+    any, so readers of different columns of the same file do not share a cache.
+
+    Examples:
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "concept.csv"
+        ...     pl.DataFrame({"a": [1], "b": [2]}).write_csv(fp)
+        ...     cache_fp = metadata_cache_fp(fp, Path(tmpdir) / "cache")
+        ...     print(cache_fp.parent.name, cache_fp.name.startswith("concept.csv."), cache_fp.suffix)
+        ...     print(cache_fp == metadata_cache_fp(fp, Path(tmpdir) / "cache"))
+        ...     print(cache_fp == metadata_cache_fp(fp, Path(tmpdir) / "cache", columns=["a"]))
+        ...     pl.DataFrame({"a": [1, 3], "b": [2, 4]}).write_csv(fp)
+        ...     print(cache_fp == metadata_cache_fp(fp, Path(tmpdir) / "cache"))
+        cache True .parquet
+        True
+        False
+        False
+    """
+    stat = fp.stat()
+    key = f"{fp}:{stat.st_size}:{stat.st_mtime}"
+    if columns is not None:
+        key = f"{key}:{','.join(columns)}"
+    return cache_dir / f"{fp.name}.{hashlib.sha1(key.encode()).hexdigest()[:16]}.parquet"
+
+
+def read_through_cache(
+    fp: Path,
+    read_fn: Callable[[Path], pl.LazyFrame],
+    cache_dir: Path,
+    columns: Sequence[str] | None = None,
+) -> pl.LazyFrame:
+    """Reads the raw metadata file ``fp`` from its Parquet cache in ``cache_dir``, converting it if needed.
+
+    The first read of a file converts it with ``read_fn`` and writes it to its cache (see
+    ``metadata_cache_fp``); that and all later reads, including those of other workers and later runs that use
+    the same ``cache_dir``, then scan the cache, which only reads the columns and rows they use, rather than
+    parsing the file again. If ``columns`` is given, only those of them that are in the file are converted, so
+    the cache of a wide file holds just the columns its readers need. The cache is written to a temporary
+    file that is then renamed, so a reader never sees a partial cache; if workers convert the same file at
+    once, the last of them to finish wins.
+
+    Examples:
+        >>> from functools import partial
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "concept.csv"
+        ...     pl.DataFrame({"concept_id": [1, 2], "name": ["Heart Rate", "Pulse"]}).write_csv(fp)
+        ...     cache_dir = Path(tmpdir) / "cache"
+        ...     read_fn = partial(pl.scan_csv, infer_schema=False)
+        ...     print(read_through_cache(fp, read_fn, cache_dir).collect().rows())
+        ...     print(len(list(cache_dir.glob("concept.csv.*.parquet"))))
+        ...     print(read_through_cache(fp, lambda fp: 1 / 0, cache_dir).select("name").collect().rows())
+        ...     print(read_through_cache(fp, read_fn, cache_dir, columns=["name", "vocab"]).collect().rows())
+        [('1', 'Heart Rate'), ('2', 'Pulse')]
+        1
+        [('Heart Rate',), ('Pulse',)]
+        [('Heart Rate',), ('Pulse',)]
+    """
+    cache_fp = metadata_cache_fp(fp, cache_dir, columns)
+    if not cache_fp.is_file():
+        logger.info(f"Converting {fp} to a columnar cache at {cache_fp}")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        fd, partial_fp = tempfile.mkstemp(dir=cache_dir, prefix=f".{cache_fp.name}.")
+        os.close(fd)
+        try:
+            df = read_fn(fp)
+            if columns is not None:
+                # Columns missing from the file are left for the reader to report, as with an uncached read.
+                df = df.select([c for c in df.collect_schema().names() if c in set(columns)])
+            df.sink_parquet(partial_fp)
+            Path(partial_fp).replace(cache_fp)
+        finally:
+            Path(partial_fp).unlink(missing_ok=True)
+    return pl.scan_parquet(cache_fp, glob=False)
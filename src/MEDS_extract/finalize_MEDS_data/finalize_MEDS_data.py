@@ -1,14 +1,474 @@
 """Sets the MEDS data files to the right schema."""
 
+import logging
+import os
+import shutil
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
 import polars as pl
 import pyarrow as pa
 import pyarrow.parquet as pq
+from flexible_schema import SchemaValidationError
 from meds import DataSchema
 from MEDS_transforms.stages import Stage
+from omegaconf import DictConfig
+
+logger = logging.getLogger(__name__)
+
+SUBJECT_INDEX_SUFFIX = ".subject_index.arrow"
+
+# The parquet footer key marking a shard as already schema-aligned MEDS data.
+FINALIZED_METADATA_KEY = b"MEDS_extract:finalized"
+
+# The number of rows after which a row group is closed at the next subject boundary.
+ROW_GROUP_TARGET_ROWS = 2**17
+
+# The number of rows after which a batch of a shard being finalized is cut at the last subject boundary.
+FINALIZE_BATCH_ROWS = 2**20
+
+
+def subject_index_fp(data_fp: Path) -> Path:
+    """Returns the path of the subject index of the MEDS data shard at ``data_fp``.
+
+    The index is not a parquet file, so it is never mistaken for a data shard.
+
+    Examples:
+        >>> subject_index_fp(Path("data/train/0.parquet"))
+        PosixPath('data/train/0.subject_index.arrow')
+    """
+    return data_fp.with_name(f"{data_fp.stem}{SUBJECT_INDEX_SUFFIX}")
+
+
+def build_subject_index(
+    table: pa.Table, row_group_target_rows: int = ROW_GROUP_TARGET_ROWS
+) -> pl.DataFrame | None:
+    """Lays out the subjects of a MEDS data table in row groups and indexes where each subject's events are.
+
+    Row groups are filled with whole subjects, in order, and closed at the first subject boundary once they
+    hold at least ``row_group_target_rows`` rows, so no subject spans two row groups.
+
+    Args:
+        table: The MEDS data, in which the events of each subject are contiguous.
+        row_group_target_rows: The number of rows after which a row group is closed.
+
+    Returns:
+        For each subject, in order, its ``row_offset`` and ``n_rows`` in the table, its ``row_group``, and the
+        ``min_time`` and ``max_time`` of its events; or ``None`` if some subject's events are not contiguous.
+
+    Examples:
+        >>> table = pa.table({
+        ...     "subject_id": [1, 1, 1, 2, 3, 3],
+        ...     "time": [None, datetime(2021, 1, 1), datetime(2021, 1, 3), None, datetime(2020, 5, 1), None],
+        ... })
+        >>> build_subject_index(table, row_group_target_rows=2)
+        shape: (3, 6)
+        ┌────────────┬────────────┬────────┬───────────┬─────────────────────┬─────────────────────┐
+        │ subject_id ┆ row_offset ┆ n_rows ┆ row_group ┆ min_time            ┆ max_time            │
+        │ ---        ┆ ---        ┆ ---    ┆ ---       ┆ ---                 ┆ ---                 │
+        │ i64        ┆ i64        ┆ i64    ┆ i64       ┆ datetime[μs]        ┆ datetime[μs]        │
+        ╞════════════╪════════════╪════════╪═══════════╪═════════════════════╪═════════════════════╡
+        │ 1          ┆ 0          ┆ 3      ┆ 0         ┆ 2021-01-01 00:00:00 ┆ 2021-01-03 00:00:00 │
+        │ 2          ┆ 3          ┆ 1      ┆ 1         ┆ null                ┆ null                │
+        │ 3          ┆ 4          ┆ 2      ┆ 1         ┆ 2020-05-01 00:00:00 ┆ 2020-05-01 00:00:00 │
+        └────────────┴────────────┴────────┴───────────┴─────────────────────┴─────────────────────┘
+        >>> print(build_subject_index(pa.table({"subject_id": [1, 2, 1], "time": [None, None, None]})))
+        None
+    """
+    df = pl.from_arrow(table.select(["subject_id", "time"])).with_row_index("row")
+    index = df.group_by("subject_id", maintain_order=True).agg(
+        pl.col("row").first().cast(pl.Int64).alias("row_offset"),
+        pl.len().cast(pl.Int64).alias("n_rows"),
+        pl.col("row").last().cast(pl.Int64).alias("last_row"),
+        pl.col("time").min().alias("min_time"),
+        pl.col("time").max().alias("max_time"),
+    )
+    if (index["last_row"] - index["row_offset"] + 1 != index["n_rows"]).any():
+        return None
+
+    row_groups = []
+    row_group = 0
+    group_rows = 0
+    for n_rows in index["n_rows"]:
+        if group_rows >= row_group_target_rows:
+            row_group += 1
+            group_rows = 0
+        row_groups.append(row_group)
+        group_rows += n_rows
+
+    return index.select(
+        "subject_id",
+        "row_offset",
+        "n_rows",
+        pl.Series("row_group", row_groups, dtype=pl.Int64),
+        "min_time",
+        "max_time",
+    )
+
+
+def is_MEDS_sorted(table: pa.Table) -> bool:
+    """Returns whether ``table`` is sorted by ``subject_id`` and then ``time``, with null times first.
+
+    Examples:
+        >>> is_MEDS_sorted(pa.table({
+        ...     "subject_id": [1, 1, 1, 2],
+        ...     "time": [None, datetime(2021, 1, 1), datetime(2021, 1, 1), datetime(2020, 1, 1)],
+        ... }))
+        True
+        >>> is_MEDS_sorted(pa.table({"subject_id": [1, 1], "time": [datetime(2021, 1, 1), None]}))
+        False
+        >>> is_MEDS_sorted(pa.table({"subject_id": [2, 1], "time": [None, None]}))
+        False
+    """
+    subject_id, next_subject_id = pl.col("subject_id"), pl.col("subject_id").shift(-1)
+    time, next_time = pl.col("time"), pl.col("time").shift(-1)
+    time_in_order = time.is_null() | (next_time.is_not_null() & (next_time >= time))
+    # Only the last row, which has no next row, is null.
+    in_order = (next_subject_id > subject_id) | ((next_subject_id == subject_id) & time_in_order)
+    return pl.from_arrow(table.select(["subject_id", "time"])).select(in_order.fill_null(True).all()).item()
+
+
+def MEDS_writer_options(table: pa.Table) -> dict:
+    """Returns the options of the ``ParquetWriter`` of a final MEDS data shard whose first table is ``table``.
+
+    The final shards are laid out for reading subsets of them. Along with their subject-aligned row groups,
+    they have column statistics and a page index, so readers can skip row groups and pages by subject, time,
+    or code; and the sort order of their row groups, if ``table`` is sorted (see ``is_MEDS_sorted``).
+
+    Examples:
+        >>> table = pa.table({"subject_id": [1, 1, 2], "time": [None] * 3, "code": ["A", "B", "A"]})
+        >>> options = MEDS_writer_options(table)
+        >>> options["write_page_index"], options["sorting_columns"]
+        (True, (SortingColumn(column_index=0, descending=False, nulls_first=True),
+                SortingColumn(column_index=1, descending=False, nulls_first=True)))
+        >>> MEDS_writer_options(table.take([2, 0, 1]))["sorting_columns"] is None
+        True
+    """
+    options = {"write_statistics": True, "write_page_index": True, "sorting_columns": None}
+    if is_MEDS_sorted(table):
+        options["sorting_columns"] = pq.SortingColumn.from_ordering(
+            table.schema, [("subject_id", "ascending"), ("time", "ascending")], null_placement="at_start"
+        )
+    return options
+
+
+def write_MEDS_tables(tables: Iterable[pa.Table], out_fp: Path):
+    """Writes schema-aligned MEDS data tables, in order, as a single shard with subject-aligned row groups.
+
+    Each table is laid out in row groups per ``build_subject_index`` and the index of the shard is written to
+    ``subject_index_fp(out_fp)`` as an Arrow IPC file. The tables must hold disjoint sets of subjects, as the
+    subject ranges of a merged shard and the batches of ``align_MEDS_batches`` do; if the events of some
+    subject are not contiguous, the shard is written without an index.
+
+    The shard is written to a hidden temporary file which is only moved to ``out_fp`` once the index has been
+    written, so every completed shard has its index. Its footer is marked with ``FINALIZED_METADATA_KEY``, so
+    that ``finalize_MEDS_data`` need not rewrite it (see ``is_finalized_shard``).
+
+    Examples:
+        >>> tables = [
+        ...     pa.table({"subject_id": [1, 1, 2], "time": [None] * 3, "code": ["A", "B", "C"]}),
+        ...     pa.table({"subject_id": [3, 4], "time": [None] * 2, "code": ["D", "E"]}),
+        ... ]
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "train" / "0.parquet"
+        ...     write_MEDS_tables(tables, out_fp)
+        ...     print(sorted(fp.name for fp in out_fp.parent.iterdir()))
+        ...     index = pl.read_ipc(subject_index_fp(out_fp))
+        ...     print(index.select("subject_id", "row_offset", "row_group").rows())
+        ...     print(read_subject(out_fp, 3).to_pylist())
+        ['0.parquet', '0.subject_index.arrow']
+        [(1, 0, 0), (2, 2, 0), (3, 3, 1), (4, 4, 1)]
+        [{'subject_id': 3, 'time': None, 'code': 'D'}]
+    """
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    partial_fp = out_fp.with_name(f".{out_fp.name}.partial")
+
+    indices = []
+    n_rows = 0
+    n_row_groups = 0
+    writer = None
+    try:
+        for table in tables:
+            if writer is None:
+                metadata = {**(table.schema.metadata or {}), FINALIZED_METADATA_KEY: b"true"}
+                options = MEDS_writer_options(table)
+                writer = pq.ParquetWriter(partial_fp, table.schema.with_metadata(metadata), **options)
+            elif options["sorting_columns"] and not is_MEDS_sorted(table):
+                # The sort order is declared per row group, so it must hold within each table.
+                logger.warning(f"Sorting a batch of {out_fp} that is not sorted by subject and time.")
+                order = (
+                    pl.from_arrow(table.select(["subject_id", "time"]))
+                    .with_row_index()
+                    .sort("subject_id", "time", nulls_last=False, maintain_order=True)
+                )
+                table = table.take(order["index"].to_arrow())
+
+            index = build_subject_index(table) if indices is not None else None
+            if index is None:
+                if indices is not None:
+                    logger.warning(
+                        f"Events of some subjects in {out_fp} are not contiguous; writing no subject index."
+                    )
+                indices = None
+                writer.write_table(table)
+                continue
+
+            row_group_sizes = index.group_by("row_group", maintain_order=True).agg(pl.col("n_rows").sum())
+            offset = 0
+            for group_rows in row_group_sizes["n_rows"]:
+                writer.write_table(table.slice(offset, group_rows), row_group_size=group_rows)
+                offset += group_rows
+
+            indices.append(
+                index.with_columns(pl.col("row_offset") + n_rows, pl.col("row_group") + n_row_groups)
+            )
+            n_rows += table.num_rows
+            n_row_groups += len(row_group_sizes)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        raise ValueError(f"No tables to write to {out_fp}")
+
+    if indices is not None:
+        index = pl.concat(indices)
+        if index["subject_id"].is_duplicated().any():
+            logger.warning(f"Some subjects in {out_fp} span several tables; writing no subject index.")
+        else:
+            index.write_ipc(subject_index_fp(out_fp))
+    partial_fp.replace(out_fp)
+
+
+def write_MEDS_shard(table: pa.Table | Iterable[pa.Table], out_fp: Path):
+    """Writes a MEDS data shard in subject-aligned row groups, alongside an index of its subjects.
+
+    The index (see ``build_subject_index``) is written to ``subject_index_fp(out_fp)`` as an Arrow IPC file;
+    with it, a loader can read a single subject's events by reading just the one row group that holds them
+    (see ``read_subject``). ``table`` may also be an iterable of tables holding disjoint sets of subjects,
+    which are written in turn (see ``write_MEDS_tables``), or an already finalized shard (see
+    ``FinalizedShard``), which is linked to (or, failing that, copied to) ``out_fp`` with its index.
+
+    Examples:
+        >>> table = pa.table({"subject_id": [1, 1, 2, 3], "time": [None] * 4, "code": ["A", "B", "C", "D"]})
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "train" / "0.parquet"
+        ...     write_MEDS_shard(table, out_fp)
+        ...     print(pl.read_ipc(subject_index_fp(out_fp)).select("subject_id", "row_group").rows())
+        ...     print(read_subject(out_fp, 2).to_pylist())
+        ...     print(pq.read_table(out_fp).equals(table))
+        ...     copy_fp = Path(tmpdir) / "final" / "0.parquet"
+        ...     write_MEDS_shard(FinalizedShard(out_fp), copy_fp)
+        ...     print(copy_fp.stat().st_ino == out_fp.stat().st_ino, subject_index_fp(copy_fp).is_file())
+        [(1, 0), (2, 0), (3, 0)]
+        [{'subject_id': 2, 'time': None, 'code': 'C'}]
+        True
+        True True
+    """
+    if isinstance(table, pa.Table):
+        write_MEDS_tables([table], out_fp)
+        return
+    if not isinstance(table, FinalizedShard):
+        write_MEDS_tables(table, out_fp)
+        return
+
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    # The index goes first, so the shard is never complete without it.
+    for src_fp, dst_fp in ((subject_index_fp(table.fp), subject_index_fp(out_fp)), (table.fp, out_fp)):
+        if not src_fp.is_file():
+            continue
+        dst_fp.unlink(missing_ok=True)
+        try:
+            os.link(src_fp, dst_fp)
+        except OSError:
+            shutil.copyfile(src_fp, dst_fp)
+
+
+def is_finalized_shard(fp: Path) -> bool:
+    """Returns whether the parquet file at ``fp`` is a finalized MEDS data shard, reading only its footer.
+
+    A shard is finalized if it was written by ``write_MEDS_tables`` (as ``merge_to_MEDS_cohort`` does with
+    ``finalize_output``) and its schema is valid MEDS.
+
+    Examples:
+        >>> table = pa.table({
+        ...     "subject_id": pa.array([1], pa.int64()),
+        ...     "time": pa.array([None], pa.timestamp("us")),
+        ...     "code": ["A"],
+        ...     "numeric_value": pa.array([None], pa.float32()),
+        ... })
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     plain_fp, finalized_fp, invalid_fp = (Path(tmpdir) / f"{n}.parquet" for n in range(3))
+        ...     pq.write_table(table, plain_fp)
+        ...     write_MEDS_tables([table], finalized_fp)
+        ...     write_MEDS_tables([table.drop_columns("code")], invalid_fp)
+        ...     print([is_finalized_shard(fp) for fp in (plain_fp, finalized_fp, invalid_fp)])
+        [False, True, False]
+    """
+    schema = pq.read_schema(fp)
+    if (schema.metadata or {}).get(FINALIZED_METADATA_KEY) != b"true":
+        return False
+    try:
+        DataSchema.validate(schema)
+    except SchemaValidationError as e:
+        logger.warning(f"{fp} is marked as finalized, but its schema is not valid MEDS: {e}")
+        return False
+    return True
+
+
+class FinalizedShard(Iterator[pa.Table]):
+    """A shard that is already finalized (see ``is_finalized_shard``), as returned by ``read_MEDS_shard``.
+
+    It iterates over the tables of the shard's row groups, so ``finalize_MEDS_data`` can pass it on as the
+    shard's aligned batches, but ``write_MEDS_shard`` links to its file rather than rewriting it.
+
+    Examples:
+        >>> table = pa.table({"subject_id": [1, 1, 2], "time": [None] * 3, "code": ["A", "B", "C"]})
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "0.parquet"
+        ...     pq.write_table(table, fp, row_group_size=2)
+        ...     print([t.num_rows for t in FinalizedShard(fp)])
+        [2, 1]
+    """
 
+    def __init__(self, fp: Path):
+        self.fp = fp
+        self._row_groups = None
+
+    def __repr__(self) -> str:
+        return f"FinalizedShard({self.fp!r})"
+
+    def __next__(self) -> pa.Table:
+        if self._row_groups is None:
+            parquet_file = pq.ParquetFile(self.fp)
+            self._row_groups = (parquet_file.read_row_group(i) for i in range(parquet_file.num_row_groups))
+        return next(self._row_groups)
+
+
+def read_MEDS_shard(in_fp: Path) -> pl.LazyFrame | FinalizedShard:
+    """Reads a shard to finalize, or marks it as a ``FinalizedShard`` if it is already finalized.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "0.parquet"
+        ...     pl.DataFrame({"subject_id": [1]}).write_parquet(fp)
+        ...     print(type(read_MEDS_shard(fp)).__name__)
+        LazyFrame
+    """
+    if is_finalized_shard(in_fp):
+        logger.info(f"{in_fp} is already finalized; linking it to the output.")
+        return FinalizedShard(in_fp)
+    return pl.scan_parquet(in_fp, glob=False)
+
+
+def read_subject(data_fp: Path, subject_id: int) -> pa.Table:
+    """Reads the events of a single subject from a MEDS data shard written by ``write_MEDS_shard``.
+
+    Only the row group holding the subject's events is read, as located by the shard's subject index. See
+    ``write_MEDS_shard`` for an example.
+
+    Raises:
+        KeyError: If the subject is not in the shard.
+    """
+    index = pl.read_ipc(subject_index_fp(data_fp)).filter(pl.col("subject_id") == subject_id)
+    if index.is_empty():
+        raise KeyError(f"Subject {subject_id} not found in {data_fp}")
 
-@Stage.register(write_fn=pq.write_table)
-def finalize_MEDS_data(df: pl.LazyFrame) -> pa.Table:
+    row_offset, n_rows, row_group = index.select("row_offset", "n_rows", "row_group").row(0)
+    data = pq.ParquetFile(data_fp)
+    row_group_offset = sum(data.metadata.row_group(i).num_rows for i in range(row_group))
+    return data.read_row_group(row_group).slice(row_offset - row_group_offset, n_rows)
+
+
+def _decode_categoricals(df: pl.LazyFrame | pl.DataFrame) -> pl.LazyFrame | pl.DataFrame:
+    """Casts any Categorical or Enum columns of ``df`` back to strings."""
+    schema = df.collect_schema()
+    encoded = [c for c, dtype in schema.items() if isinstance(dtype, pl.Categorical | pl.Enum)]
+    if encoded:
+        df = df.with_columns(pl.col(encoded).cast(pl.String))
+    return df
+
+
+def align_MEDS_table(df: pl.LazyFrame) -> pa.Table:
+    """Collects MEDS data into an Arrow table with the MEDS schema; see ``finalize_MEDS_data``."""
+    return DataSchema.align(_decode_categoricals(df).collect().to_arrow())
+
+
+def subject_batches(df: pl.LazyFrame, batch_rows: int = FINALIZE_BATCH_ROWS) -> Iterator[pl.DataFrame]:
+    """Collects ``df`` in consecutive batches of about ``batch_rows`` rows that never split a subject.
+
+    ``df`` is streamed once, in chunks of ``batch_rows`` rows. Each batch is cut at the last subject boundary
+    within its first ``batch_rows`` rows, and the rows past that cut are carried over to the next batch; a
+    subject with more rows than that is collected whole, as a batch of its own. An empty ``df`` yields one
+    empty batch, so its schema is still known.
+
+    Examples:
+        >>> df = pl.LazyFrame({"subject_id": [1, 1, 2, 3, 3, 3, 3, 4, 5], "code": list("ABCDEFGHI")})
+        >>> [batch["subject_id"].to_list() for batch in subject_batches(df, batch_rows=3)]
+        [[1, 1, 2], [3, 3, 3, 3], [4, 5]]
+        >>> [batch.shape for batch in subject_batches(df.clear(), batch_rows=3)]
+        [(0, 2)]
+    """
+    run_id = pl.col("subject_id").rle_id()
+
+    buffer = pl.DataFrame(schema=df.collect_schema())
+    n_yielded = 0
+    for chunk in df.collect_batches(chunk_size=batch_rows):
+        buffer = pl.concat([buffer, chunk], rechunk=False)
+        while buffer.height > batch_rows:
+            # One row more than the batch shows whether the batch's last subject continues past it.
+            window = buffer.head(batch_rows + 1)
+            cut = window.height - window.select((run_id == run_id.last()).sum()).item()
+            if cut == 0:
+                cut = buffer.select((run_id == 0).sum()).item()
+                if cut == buffer.height:
+                    break  # The first subject may continue into the next chunk.
+
+            yield buffer.head(cut)
+            n_yielded += 1
+            buffer = buffer.slice(cut)
+
+    if buffer.height or not n_yielded:
+        yield buffer
+
+
+def align_MEDS_batches(df: pl.LazyFrame, batch_rows: int = FINALIZE_BATCH_ROWS) -> Iterator[pa.Table]:
+    """Aligns MEDS data to the MEDS schema one batch of whole subjects at a time (see ``subject_batches``).
+
+    Only the first batch is aligned with ``DataSchema.align``; every later batch is cast to the schema that
+    produced, which is much cheaper than re-validating each batch.
+
+    Examples:
+        >>> df = pl.LazyFrame({
+        ...     "subject_id": [1, 1, 2],
+        ...     "time": [datetime(2021, 1, 1), None, None],
+        ...     "code": ["A", "B", "C"],
+        ...     "numeric_value": [1.5, None, 2.5],
+        ... }).with_columns(pl.col("code").cast(pl.Categorical))
+        >>> batches = list(align_MEDS_batches(df, batch_rows=2))
+        >>> [batch.num_rows for batch in batches]
+        [2, 1]
+        >>> batches[1].schema
+        subject_id: int64
+        time: timestamp[us]
+        code: string
+        numeric_value: float
+    """
+    target_schema = None
+    for batch in subject_batches(_decode_categoricals(df), batch_rows):
+        table = batch.to_arrow()
+        if target_schema is None:
+            table = DataSchema.align(table)
+            target_schema = table.schema
+        else:
+            table = table.select(target_schema.names).cast(target_schema)
+        yield table
+
+
+@Stage.register(read_fn=read_MEDS_shard, write_fn=write_MEDS_shard)
+def finalize_MEDS_data(
+    df: pl.LazyFrame | FinalizedShard, stage_cfg: DictConfig | None = None
+) -> Iterator[pa.Table]:
     """Writes out schema compliant MEDS data files for the extracted dataset.
 
     In particular, this script ensures that all shard files are MEDS compliant with the mandatory columns
@@ -17,6 +477,43 @@ def finalize_MEDS_data(df: pl.LazyFrame) -> pa.Table:
       - `code` (String)
       - `numeric_value` (Float32)
 
+    Any Categorical or Enum columns (e.g., from the `compact_intermediates` option of
+    `convert_to_MEDS_events`) are decoded back to strings.
+
+    Shards are collected, aligned, and written in batches of whole subjects (see ``align_MEDS_batches``) of
+    about ``stage_cfg.batch_rows`` rows (``FINALIZE_BATCH_ROWS`` by default), so the memory this needs is
+    bounded by the batch size rather than the shard size. Each shard is written in
+    row groups that never split a subject's events, alongside an index of where
+    each subject's events are (see ``write_MEDS_shard``). Shards already finalized by `merge_to_MEDS_cohort`
+    (with its `finalize_output` option) are only validated from their footers (see ``read_MEDS_shard``) and
+    passed on as is, to be linked to the output.
+
     This stage *_should almost always be the last data stage in an extraction pipeline._*
+
+    Examples:
+        >>> df = pl.LazyFrame({
+        ...     "subject_id": [1],
+        ...     "time": [datetime(2021, 1, 1)],
+        ...     "code": ["A"],
+        ...     "numeric_value": [1.5],
+        ...     "source_block": ["data/a"],
+        ... }).with_columns(
+        ...     pl.col("code").cast(pl.Categorical),
+        ...     pl.col("source_block").cast(pl.Enum(["data/a"])),
+        ... )
+        >>> next(finalize_MEDS_data(df)).schema
+        subject_id: int64
+        time: timestamp[us]
+        code: string
+        numeric_value: float
+        source_block: large_string
+        >>> df = pl.LazyFrame({"subject_id": [1, 2, 2], "time": [None] * 3, "code": ["A", "B", "C"]})
+        >>> [batch.num_rows for batch in finalize_MEDS_data(df, DictConfig({"batch_rows": 1}))]
+        [1, 2]
+        >>> finalize_MEDS_data(FinalizedShard(Path("data/train/0.parquet")))
+        FinalizedShard(PosixPath('data/train/0.parquet'))
     """
-    return DataSchema.align(df.collect().to_arrow())
+    if isinstance(df, FinalizedShard):
+        return df
+    batch_rows = (stage_cfg or {}).get("batch_rows", None) or FINALIZE_BATCH_ROWS
+    return align_MEDS_batches(df, batch_rows)
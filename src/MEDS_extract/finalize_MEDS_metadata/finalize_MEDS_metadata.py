@@ -21,9 +21,38 @@ from meds import __version__ as MEDS_VERSION
 from MEDS_transforms.stages import Stage
 from omegaconf import DictConfig
 
+from ..shared_state import load_shards_map
+
 logger = logging.getLogger(__name__)
 
 
+def build_subject_splits(shards_map: dict[str, list[int]]) -> pa.Table:
+    """Builds the subject splits table from a shards map, columnarly.
+
+    The split of each shard is its name up to the last ``/``. Each shard contributes its subject IDs as one
+    Arrow array and its split as one repeated Arrow array, so no Python object is made per subject.
+
+    Examples:
+        >>> build_subject_splits({"train/0": [1, 2], "train/1": [3], "held_out/0": [4, 5]}).to_pydict()
+        {'subject_id': [1, 2, 3, 4, 5], 'split': ['train', 'train', 'train', 'held_out', 'held_out']}
+        >>> build_subject_splits({}).num_rows
+        0
+    """
+    schema = SubjectSplitSchema.schema()
+    subject_id_type = schema.field(SubjectSplitSchema.subject_id_name).type
+    split_type = schema.field("split").type
+
+    columns = {SubjectSplitSchema.subject_id_name: [], "split": []}
+    for shard, subject_ids in shards_map.items():
+        split = "/".join(shard.split("/")[:-1])
+        columns[SubjectSplitSchema.subject_id_name].append(pa.array(subject_ids, type=subject_id_type))
+        columns["split"].append(pa.repeat(pa.scalar(split, type=split_type), len(subject_ids)))
+
+    return pa.Table.from_arrays(
+        [pa.chunked_array(columns[field.name], type=field.type) for field in schema], schema=schema
+    )
+
+
 @Stage.register(is_metadata=True)
 def main(cfg: DictConfig):
     """Writes out schema compliant MEDS metadata files for the extracted dataset.
@@ -105,24 +134,19 @@ def main(cfg: DictConfig):
     # Split creation
     shards_map_fp = Path(cfg.shards_map_fp)
     logger.info(f"Creating subject splits from {shards_map_fp.resolve()!s}")
-    shards_map = json.loads(shards_map_fp.read_text())
-    subject_splits = []
+    shards_map = load_shards_map(shards_map_fp)
     seen_splits = defaultdict(int)
     for shard, subject_ids in shards_map.items():
         split = "/".join(shard.split("/")[:-1])
 
         seen_splits[split] += len(subject_ids)
 
-        subject_splits.extend(
-            [{SubjectSplitSchema.subject_id_name: pid, "split": split} for pid in subject_ids]
-        )
-
     for split, cnt in seen_splits.items():
         if cnt:
             logger.info(f"Split {split} has {cnt} subjects")
         else:  # pragma: no cover
             logger.warning(f"Split {split} not found in shards map")
 
-    subject_splits_tbl = pa.Table.from_pylist(subject_splits, schema=SubjectSplitSchema.schema())
+    subject_splits_tbl = build_subject_splits(shards_map)
     logger.info(f"Writing finalized subject splits to {subject_splits_fp.resolve()!s}")
     pq.write_table(subject_splits_tbl, subject_splits_fp)
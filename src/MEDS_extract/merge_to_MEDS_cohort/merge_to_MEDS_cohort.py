@@ -4,11 +4,18 @@ from functools import partial
 from pathlib import Path
 
 import polars as pl
+import pyarrow.parquet as pq
 from MEDS_transforms.compute_modes.compute_fn import identity_fn
+from MEDS_transforms.dataframe import write_df
 from MEDS_transforms.mapreduce import map_stage
 from MEDS_transforms.mapreduce.shard_iteration import shuffle_shards
 from MEDS_transforms.stages import Stage
-from omegaconf import DictConfig, OmegaConf
+from omegaconf import DictConfig
+
+from ..convert_to_MEDS_events.convert_to_MEDS_events import SORTED_BY_METADATA_KEY
+from ..dedup import dedup_on_merge, fingerprint_unique, get_dedup_strategy
+from ..finalize_MEDS_data.finalize_MEDS_data import align_MEDS_table, write_MEDS_tables
+from ..shared_state import load_event_conversion_cfg, load_shards_map
 
 logger = logging.getLogger(__name__)
 
@@ -79,7 +86,7 @@ def shard_iterator_by_shard_map(cfg: DictConfig) -> tuple[list[str], bool]:
     if not shard_map_fp.exists():
         raise FileNotFoundError(f"Shard map file not found at {shard_map_fp.resolve()!s}")
 
-    shards = list(json.loads(shard_map_fp.read_text()).keys())
+    shards = list(load_shards_map(shard_map_fp).keys())
 
     input_dir = Path(cfg.stage_cfg.data_input_dir)
     output_dir = Path(cfg.stage_cfg.output_dir)
@@ -97,11 +104,90 @@ def shard_iterator_by_shard_map(cfg: DictConfig) -> tuple[list[str], bool]:
     return out, False
 
 
+def is_presorted(fp: Path, sort_by: list[str]) -> bool:
+    """Returns whether the parquet file at ``fp`` is recorded as (stably) sorted by the columns ``sort_by``.
+
+    Files record their sort order in their key-value metadata (see
+    `MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events.write_sorted_events`). Columns of ``sort_by``
+    the file does not have are constant (null) over it once it is merged with files that do, so they are
+    ignored.
+
+    Examples:
+        >>> from tempfile import TemporaryDirectory
+        >>> from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import write_sorted_events
+        >>> df = pl.DataFrame({"subject_id": [1, 2], "time": [1, 1], "code": ["A", "B"]})
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     sorted_fp = Path(tmpdir) / "sorted.parquet"
+        ...     write_sorted_events(df, sorted_fp)
+        ...     unmarked_fp = Path(tmpdir) / "unmarked.parquet"
+        ...     df.write_parquet(unmarked_fp)
+        ...     print(is_presorted(sorted_fp, ["subject_id", "time"]))
+        ...     print(is_presorted(sorted_fp, ["subject_id", "time", "numeric_value"]))
+        ...     print(is_presorted(sorted_fp, ["subject_id", "time", "code"]))
+        ...     print(is_presorted(unmarked_fp, ["subject_id", "time"]))
+        True
+        True
+        False
+        False
+    """
+    recorded = pl.read_parquet_metadata(fp).get(SORTED_BY_METADATA_KEY, None)
+    if recorded is None:
+        return False
+
+    columns = set(pl.scan_parquet(fp, glob=False).collect_schema().names())
+    needed = [col for col in sort_by if col in columns]
+    return json.loads(recorded)[: len(needed)] == needed
+
+
+def merge_presorted(dfs: list[pl.LazyFrame], sort_by: list[str]) -> pl.LazyFrame:
+    """Merges frames that are each sorted by ``sort_by`` into one frame sorted by ``sort_by``.
+
+    The frames are aligned to the schema of their diagonal concatenation and then merged pairwise, in order,
+    with Polars' streaming `merge_sorted` on a struct of the sort columns. Rows with equal sort keys keep the
+    order of the frames they come from, so the result matches a stable sort of the concatenated frames.
+
+    Examples:
+        >>> dfs = [
+        ...     pl.LazyFrame({"subject_id": [1, 1, 2], "time": [None, 5, 1], "code": ["A", "B", "C"]}),
+        ...     pl.LazyFrame({"subject_id": [1, 2], "time": [5, 1], "numeric_value": [1.0, 2.0]}),
+        ... ]
+        >>> merge_presorted(dfs, ["subject_id", "time"]).collect()
+        shape: (5, 4)
+        ┌────────────┬──────┬──────┬───────────────┐
+        │ subject_id ┆ time ┆ code ┆ numeric_value │
+        │ ---        ┆ ---  ┆ ---  ┆ ---           │
+        │ i64        ┆ i64  ┆ str  ┆ f64           │
+        ╞════════════╪══════╪══════╪═══════════════╡
+        │ 1          ┆ null ┆ A    ┆ null          │
+        │ 1          ┆ 5    ┆ B    ┆ null          │
+        │ 1          ┆ 5    ┆ null ┆ 1.0           │
+        │ 2          ┆ 1    ┆ C    ┆ null          │
+        │ 2          ┆ 1    ┆ null ┆ 2.0           │
+        └────────────┴──────┴──────┴───────────────┘
+    """
+    schema = pl.concat(dfs, how="diagonal_relaxed").collect_schema()
+    key = "__MEDS_extract_merge_key"
+
+    merged = None
+    for df in dfs:
+        columns = set(df.collect_schema().names())
+        df = df.select(
+            pl.col(col).cast(dtype) if col in columns else pl.lit(None, dtype=dtype).alias(col)
+            for col, dtype in schema.items()
+        ).with_columns(pl.struct(sort_by).alias(key))
+        merged = df if merged is None else merged.merge_sorted(df, key=key)
+
+    return merged.drop(key)
+
+
 def merge_subdirs_and_sort(
     sp_dir: Path,
     event_subsets: list[str],
     unique_by: list[str] | str | None,
     additional_sort_by: list[str] | None = None,
+    unique_by_fingerprint: bool = False,
+    multithreaded_sort: bool = False,
+    subject_range: tuple[int, int] | None = None,
 ) -> pl.LazyFrame:
     """This function reads all parquet files in subdirs of `sp_dir` and merges them into a single dataframe.
 
@@ -112,15 +198,30 @@ def merge_subdirs_and_sort(
         unique_by: The list of columns that should be ensured to be unique after the dataframes are merged. If
             `None`, this is ignored. If `*`, all columns are used. If a list of strings, only the columns in
             the list are used. If a column is not found in the dataframe, it is omitted from the unique-by, a
-            warning is logged, but an error is *not* raised. Which rows are retained if the uniqeu-by columns
-            are not all columns is not guaranteed, but is also *not* random, so this may have statistical
-            implications.
+            warning is logged, but an error is *not* raised. If the unique-by columns are not all columns, the
+            first row of each set of duplicates is retained: the first in the order of `event_subsets` and of
+            the rows within each file, or, if the files are presorted (see below), the first in the sorted
+            output order, with ties kept in the order of `event_subsets`. This is *not* random, so it may have
+            statistical implications.
         additional_sort_by: Additional columns to sort by, in addition to the default sorting by subject ID
             and time. If `None`, only subject ID and time are used. If a list of strings, these
             columns are used in addition to the default sorting. If a column is not found in the dataframe, it
             is omitted from the sort-by, a warning is logged, but an error is *not* raised. This functionality
             is useful both for deterministic testing and in cases where a data owner wants to impose
             intra-event measurement ordering in the data, though this is not recommended in general.
+        unique_by_fingerprint: If true, the merged dataframe is additionally made unique over a 64-bit hash of
+            all of its columns, keeping the first of each set of equal rows (see
+            `MEDS_extract.dedup.fingerprint_unique`).
+        multithreaded_sort: If true, the merged dataframe is sorted with all available threads. To keep the
+            output identical to that of the default, single-threaded stable sort, the position of each row in
+            the concatenated input is added as a final sort key, so that no two rows compare equal.
+        subject_range: If given, only the rows whose subject IDs lie in this (inclusive) range are read from
+            each file (see `merge_in_subject_ranges`).
+
+    If every file is marked as sorted by subject ID, time, and `additional_sort_by` (see
+    `is_presorted`), the files are merged in a streaming fashion (see `merge_presorted`) rather than
+    concatenated and sorted. The output order is the same either way; only which of a set of rows that are
+    duplicates over a `unique_by` subset is retained can differ, as described above.
 
     Returns:
         A single dataframe containing all the data from the parquet files in the subdirs of `sp_dir`. These
@@ -248,6 +349,36 @@ def merge_subdirs_and_sort(
         Traceback (most recent call last):
             ...
         ValueError: Invalid unique_by value: 352.2
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     sp_dir = Path(tmpdir)
+        ...     df1.write_parquet(sp_dir / "file1.parquet")
+        ...     df2.write_parquet(sp_dir / "file2.parquet")
+        ...     df3.write_parquet(sp_dir / "df.parquet")
+        ...     kwargs = {"event_subsets": ["file1", "file2", "df"], "unique_by": None}
+        ...     merge_subdirs_and_sort(sp_dir, multithreaded_sort=True, **kwargs).collect().equals(
+        ...         merge_subdirs_and_sort(sp_dir, **kwargs).collect()
+        ...     )
+        True
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     sp_dir = Path(tmpdir)
+        ...     df2.write_parquet(sp_dir / "file2.parquet")
+        ...     df2.write_parquet(sp_dir / "df.parquet")
+        ...     merge_subdirs_and_sort(
+        ...         sp_dir,
+        ...         event_subsets=["file2", "df"],
+        ...         unique_by=None,
+        ...         unique_by_fingerprint=True,
+        ...     ).collect()
+        shape: (3, 4)
+        ┌────────────┬──────┬──────┬───────────────┐
+        │ subject_id ┆ time ┆ code ┆ numeric_value │
+        │ ---        ┆ ---  ┆ ---  ┆ ---           │
+        │ i64        ┆ i64  ┆ str  ┆ f64           │
+        ╞════════════╪══════╪══════╪═══════════════╡
+        │ 1          ┆ 1    ┆ D    ┆ 2.0           │
+        │ 1          ┆ 2    ┆ C    ┆ null          │
+        │ 3          ┆ 8    ┆ E    ┆ null          │
+        └────────────┴──────┴──────┴───────────────┘
     """
     files_to_read = [(sp_dir / f"{es}.parquet") for es in event_subsets]
     if not files_to_read:
@@ -257,10 +388,25 @@ def merge_subdirs_and_sort(
     logger.info(f"Reading {len(files_to_read)} files:\n{file_strs}")
 
     dfs = [pl.scan_parquet(fp, glob=False) for fp in files_to_read]
+    if subject_range is not None:
+        dfs = [df.filter(pl.col("subject_id").is_between(*subject_range)) for df in dfs]
     df = pl.concat(dfs, how="diagonal_relaxed")
 
     df_columns = set(df.collect_schema().names())
 
+    sort_by = ["subject_id", "time"]
+    if additional_sort_by is not None:
+        for s in additional_sort_by:
+            if s in df_columns:
+                sort_by.append(s)
+            else:
+                logger.warning(f"Column {s} not found in dataframe. Omitting from sort-by list.")
+
+    presorted = all(is_presorted(fp, sort_by) for fp in files_to_read)
+    if presorted:
+        logger.info(f"Merging {len(files_to_read)} files presorted by {', '.join(sort_by)}")
+        df = merge_presorted(dfs, sort_by)
+
     match unique_by:
         case None:
             pass
@@ -277,17 +423,205 @@ def merge_subdirs_and_sort(
         case _:
             raise ValueError(f"Invalid unique_by value: {unique_by}")
 
-    sort_by = ["subject_id", "time"]
-    if additional_sort_by is not None:
-        for s in additional_sort_by:
-            if s in df_columns:
-                sort_by.append(s)
-            else:
-                logger.warning(f"Column {s} not found in dataframe. Omitting from sort-by list.")
+    if unique_by_fingerprint:
+        df = fingerprint_unique(df)
 
+    if presorted:
+        return df
+    if multithreaded_sort:
+        ordinal = "__MEDS_extract_row_ordinal"
+        return df.with_row_index(ordinal).sort(by=[*sort_by, ordinal], multithreaded=True).drop(ordinal)
     return df.sort(by=sort_by, maintain_order=True, multithreaded=False)
 
 
+# The peak memory of uniquing and sorting a range of events, relative to the in-memory size of those events.
+MERGE_MEMORY_MULTIPLIER = 3
+
+
+def subject_ranges(fps: list[Path], memory_budget_mb: float) -> list[tuple[int, int]]:
+    """Splits the subjects of a shard into ranges whose events can be merged within a memory budget.
+
+    The in-memory size of each event is estimated from the uncompressed sizes recorded in the parquet
+    metadata of `fps`, and only the `subject_id` column of each file is read. Each range holds at least one
+    subject, so a single subject with more events than the budget allows gets a range of its own.
+
+    Args:
+        fps: The parquet files holding the shard's events.
+        memory_budget_mb: The memory, in megabytes, the merge of a single range may use.
+
+    Returns:
+        The inclusive `(first, last)` subject ID ranges, in ascending order, covering all subjects in `fps`.
+
+    Examples:
+        >>> from tempfile import TemporaryDirectory
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     fps = [Path(tmpdir) / "a.parquet", Path(tmpdir) / "b.parquet"]
+        ...     pl.DataFrame({"subject_id": [1, 1, 2, 4] * 1000, "code": ["A"] * 4000}).write_parquet(fps[0])
+        ...     pl.DataFrame({"subject_id": [3, 4] * 1000, "code": ["B"] * 2000}).write_parquet(fps[1])
+        ...     print(subject_ranges(fps, memory_budget_mb=1000))
+        ...     print(subject_ranges(fps, memory_budget_mb=0))
+        [(1, 4)]
+        [(1, 1), (2, 2), (3, 3), (4, 4)]
+
+    A shard without events has no ranges:
+
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "a.parquet"
+        ...     pl.DataFrame(schema={"subject_id": pl.Int64, "code": pl.String}).write_parquet(fp)
+        ...     print(subject_ranges([fp], memory_budget_mb=0))
+        []
+    """
+    n_rows = 0
+    n_bytes = 0
+    for fp in fps:
+        metadata = pq.ParquetFile(fp).metadata
+        n_rows += metadata.num_rows
+        n_bytes += sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+
+    subject_ids = pl.concat([pl.scan_parquet(fp, glob=False).select("subject_id") for fp in fps])
+    counts = subject_ids.group_by("subject_id").len().sort("subject_id").collect()
+
+    bytes_per_row = MERGE_MEMORY_MULTIPLIER * n_bytes / max(n_rows, 1)
+    max_rows = max(int(memory_budget_mb * 2**20 / max(bytes_per_row, 1)), 1)
+
+    ranges = []
+    first = last = None
+    range_rows = 0
+    for subject_id, n in counts.iter_rows():
+        if first is not None and range_rows + n > max_rows:
+            ranges.append((first, last))
+            first = None
+        if first is None:
+            first = subject_id
+            range_rows = 0
+        last = subject_id
+        range_rows += n
+    if first is not None:
+        ranges.append((first, last))
+    return ranges
+
+
+def merge_in_subject_ranges(
+    sp_dir: Path,
+    event_subsets: list[str],
+    memory_budget_mb: float | None = None,
+    **merge_kwargs,
+) -> pl.LazyFrame | dict[tuple[int, int], pl.LazyFrame]:
+    """Merges the events of a shard, split into subject ranges that each fit in the given memory budget.
+
+    Events are deduplicated and sorted by subject ID first, so merging each range of subjects separately (see
+    `subject_ranges`) and concatenating the results in range order yields the same output as merging the
+    shard as a whole, while only one range needs to be held in memory at a time. The exception is a
+    `unique_by` subset without `subject_id`, which may match rows of different subjects; in that case, the
+    shard is merged as a whole.
+
+    Args:
+        sp_dir: The directory containing the shard's event files.
+        event_subsets: The event file names, in merge order (see `merge_subdirs_and_sort`).
+        memory_budget_mb: The memory, in megabytes, the merge of a single range may use. If `None`, the shard
+            is merged as a whole.
+        **merge_kwargs: Further keyword arguments for `merge_subdirs_and_sort`.
+
+    Returns:
+        The merged shard, or, if it is split into ranges, the merged events of each subject range, keyed by
+        range, in order (see `write_subject_ranges`).
+
+    Examples:
+        >>> from tempfile import TemporaryDirectory
+        >>> df1 = pl.DataFrame({"subject_id": [2, 1, 3], "time": [1, 1, 1], "code": ["A", "A", "A"]})
+        >>> df2 = pl.DataFrame({"subject_id": [1, 3], "time": [0, 2], "code": ["B", "B"]})
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     sp_dir = Path(tmpdir)
+        ...     df1.write_parquet(sp_dir / "df1.parquet")
+        ...     df2.write_parquet(sp_dir / "df2.parquet")
+        ...     kwargs = {"event_subsets": ["df1", "df2"], "unique_by": "*"}
+        ...     merged = merge_in_subject_ranges(sp_dir, memory_budget_mb=0, **kwargs)
+        ...     for subject_range, df in merged.items():
+        ...         print(subject_range, df.collect().rows())
+        ...     print(merge_in_subject_ranges(sp_dir, **kwargs).collect().rows())
+        (1, 1) [(1, 0, 'B'), (1, 1, 'A')]
+        (2, 2) [(2, 1, 'A')]
+        (3, 3) [(3, 1, 'A'), (3, 2, 'B')]
+        [(1, 0, 'B'), (1, 1, 'A'), (2, 1, 'A'), (3, 1, 'A'), (3, 2, 'B')]
+    """
+    unique_by = merge_kwargs.get("unique_by")
+    if isinstance(unique_by, list) and "subject_id" not in unique_by and memory_budget_mb is not None:
+        logger.warning("unique_by does not include subject_id; merging the shard as a whole.")
+        memory_budget_mb = None
+
+    if memory_budget_mb is None:
+        return merge_subdirs_and_sort(sp_dir, event_subsets, **merge_kwargs)
+
+    fps = [sp_dir / f"{es}.parquet" for es in event_subsets]
+    ranges = subject_ranges(fps, memory_budget_mb)
+    if len(ranges) <= 1:
+        return merge_subdirs_and_sort(sp_dir, event_subsets, **merge_kwargs)
+
+    logger.info(f"Merging {sp_dir} in {len(ranges)} subject ranges")
+    return {r: merge_subdirs_and_sort(sp_dir, event_subsets, subject_range=r, **merge_kwargs) for r in ranges}
+
+
+def write_subject_ranges(
+    df: pl.LazyFrame | dict[tuple[int, int], pl.LazyFrame], out_fp: Path, finalize_output: bool = False
+):
+    """Writes a merged shard, collecting and writing one subject range at a time if it is split into ranges.
+
+    Each range is written as its own row group(s) of the single output file, so the output is the same as if
+    the concatenation of the ranges had been written at once. With ``finalize_output``, each range is instead
+    aligned to the MEDS schema and the shard is written as ``finalize_MEDS_data`` would write it (see
+    ``write_MEDS_tables``), so that stage need not rewrite it.
+
+    Examples:
+        >>> from tempfile import TemporaryDirectory
+        >>> ranges = {
+        ...     (1, 1): pl.LazyFrame({"subject_id": [1, 1], "code": ["A", "B"]}),
+        ...     (2, 3): pl.LazyFrame({"subject_id": [2, 3], "code": ["C", "D"]}),
+        ... }
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "train" / "0.parquet"
+        ...     write_subject_ranges(ranges, out_fp)
+        ...     print(pq.ParquetFile(out_fp).metadata.num_row_groups)
+        ...     print(pl.read_parquet(out_fp).rows())
+        2
+        [(1, 'A'), (1, 'B'), (2, 'C'), (3, 'D')]
+        >>> events = pl.LazyFrame({
+        ...     "subject_id": [1, 2],
+        ...     "time": [datetime(2021, 1, 1), None],
+        ...     "code": ["A", "C"],
+        ...     "numeric_value": [1.5, None],
+        ... })
+        >>> ranges = {(1, 1): events.filter(pl.col("subject_id") == 1), (2, 3): events.slice(1)}
+        >>> with TemporaryDirectory() as tmpdir:
+        ...     out_fp = Path(tmpdir) / "train" / "0.parquet"
+        ...     write_subject_ranges(ranges, out_fp, finalize_output=True)
+        ...     print(sorted(fp.name for fp in out_fp.parent.iterdir()))
+        ...     print(pq.read_schema(out_fp).field("numeric_value").type)
+        ['0.parquet', '0.subject_index.arrow']
+        float
+    """
+    if finalize_output:
+        ranges = df.values() if isinstance(df, dict) else [df]
+        write_MEDS_tables((align_MEDS_table(range_df) for range_df in ranges), out_fp)
+        return
+
+    if not isinstance(df, dict):
+        write_df(df, out_fp)
+        return
+
+    out_fp.parent.mkdir(parents=True, exist_ok=True)
+    writer = None
+    try:
+        for subject_range, range_df in df.items():
+            logger.debug(f"Writing subjects {subject_range[0]}-{subject_range[1]} to {out_fp}")
+            table = range_df.collect().to_arrow()
+            if writer is None:
+                writer = pq.ParquetWriter(out_fp, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
 @Stage.register(is_metadata=False)
 def main(cfg: DictConfig):
     """Merges the subject sub-sharded events into a single parquet file per subject shard.
@@ -308,23 +642,45 @@ def main(cfg: DictConfig):
         additional_sort_by: Additional columns to sort by, in addition to
             the default sorting by subject ID and time. Defaults to `None`, which means only subject ID
             and time are used.
+        multithreaded_sort: If true, shards are sorted with all available threads, with the same output as
+            the default single-threaded sort. Defaults to `False`.
+        memory_budget_mb: If set, each shard is merged in subject ranges whose merge is estimated to use at
+            most this many megabytes, one range at a time (see `merge_in_subject_ranges`). Defaults to `None`,
+            which means each shard is merged as a whole.
+        finalize_output: If true, the merged shards are written as schema-aligned MEDS data, with
+            subject-aligned row groups and a subject index, so `finalize_MEDS_data` only validates their
+            footers and links them to its output instead of rewriting them. Defaults to `False`.
+
+    Whether the merged dataframes are made unique over `unique_by`, over a hash of each row, or not at all is
+    governed by the pipeline-level `dedup_strategy` (see `MEDS_extract.dedup`).
 
     Returns:
         Writes the merged dataframes to the shard-specific output filepath in the `cfg.stage_cfg.output_dir`.
     """
-    event_conversion_cfg = OmegaConf.load(cfg.event_conversion_config_fp)
+    # Compacted intermediates (see `compact_events`) hold Categorical codes, which the global string cache
+    # lets us combine across files without re-encoding them.
+    pl.enable_string_cache()
+
+    event_conversion_cfg = load_event_conversion_cfg(Path(cfg.event_conversion_config_fp))
     event_conversion_cfg.pop("subject_id_col", None)
 
+    dedup_strategy = get_dedup_strategy(cfg)
+    logger.info(f"Deduplicating merged events with strategy {dedup_strategy}")
+
     read_fn = partial(
-        merge_subdirs_and_sort,
+        merge_in_subject_ranges,
         event_subsets=list(event_conversion_cfg.keys()),
-        unique_by=cfg.stage_cfg.get("unique_by", None),
+        memory_budget_mb=cfg.stage_cfg.get("memory_budget_mb", None),
+        unique_by=cfg.stage_cfg.get("unique_by", None) if dedup_on_merge(dedup_strategy) else None,
         additional_sort_by=cfg.stage_cfg.get("additional_sort_by", None),
+        unique_by_fingerprint=dedup_strategy == "hash_fingerprint",
+        multithreaded_sort=cfg.stage_cfg.get("multithreaded_sort", False),
     )
 
     map_stage(
         cfg,
         map_fn=identity_fn,
         read_fn=read_fn,
+        write_fn=partial(write_subject_ranges, finalize_output=cfg.stage_cfg.get("finalize_output", False)),
         shard_iterator_fntr=shard_iterator_by_shard_map,
     )
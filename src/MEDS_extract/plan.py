@@ -0,0 +1,643 @@
+"""A compiled, validated form of the MESSY event conversion config.
+
+Compiling a MESSY config means parsing every dftly expression it contains (``subject_id_expr``,
+``transforms``, and every event field) into Polars expressions and recording which input columns each
+input prefix references. The result is an `ExtractionPlan` that is built once per pipeline run (in
+``shard_events``, so that config errors surface before any data is read), serialized next to the shards
+map, and loaded by every worker of the later stages instead of re-parsing the config for every shard.
+
+The serialized plan is keyed by a hash of the config it was compiled from and by the versions of the
+libraries whose expression formats it depends on; a plan that does not match is recompiled.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from importlib.metadata import version
+from pathlib import Path
+
+import polars as pl
+from dftly import Parser
+from omegaconf import DictConfig, OmegaConf
+
+from .dftly_bridge import EVENT_META_KEYS, compile_subject_id_expr
+from .shared_state import cached_load
+
+logger = logging.getLogger(__name__)
+
+PLAN_FORMAT_VERSION = 1
+EXTRACTION_PLAN_FN = ".extraction_plan.pkl"
+
+
+def _null_safe_code_expr(code_node) -> pl.Expr:
+    """Compile a composite ``code`` so each null component renders as the literal ``"UNK"``.
+
+    dftly string interpolation null-propagates, so a null in any referenced component would make
+    the whole ``code`` null (which MEDS forbids). This rebuilds the interpolation from the dftly
+    node's ordered pieces, casting each to a string and filling nulls with ``"UNK"`` — restoring
+    the pre-dftly ``pl.col(c).cast(pl.Utf8).fill_null("UNK")`` behaviour (including non-string
+    columns, which are cast to their string form). It is scoped to the code expression, so
+    ``code_components`` keeps the raw, typed values. See issue #109.
+    """
+    if type(code_node).__name__ == "StringInterpolate":
+        template = code_node.args[0].args[0]  # e.g. "LAB//{}//{}"
+        pieces = [arg.polars_expr for arg in code_node.args[1:]]
+        if isinstance(template, str) and template.count("{}") == len(pieces):
+            filled = [p.cast(pl.Utf8, strict=False).fill_null(pl.lit("UNK")) for p in pieces]
+            return pl.format(template, *filled)
+    # Unexpected node shape: at least guarantee the whole code is never null.
+    return code_node.polars_expr.cast(pl.Utf8, strict=False).fill_null(pl.lit("UNK"))
+
+
+@dataclass(frozen=True)
+class UnpivotSpec:
+    """How a wide event block is unpivoted into one row per (input row, value column).
+
+    Attributes:
+        columns: The input columns holding the values to unpivot.
+        variable_name: The name under which the block's expressions can reference the source column name.
+        value_name: The name under which the block's expressions can reference the source column value.
+        drop_nulls: Whether to drop unpivoted rows whose value is null.
+    """
+
+    columns: tuple[str, ...]
+    variable_name: str = "variable"
+    value_name: str = "value"
+    drop_nulls: bool = True
+
+    @classmethod
+    def from_cfg(cls, unpivot_cfg: dict | list) -> "UnpivotSpec":
+        """Builds the spec from the ``_unpivot`` key of an event block.
+
+        Examples:
+            >>> UnpivotSpec.from_cfg(["HR", "SBP"])
+            UnpivotSpec(columns=('HR', 'SBP'), variable_name='variable', value_name='value', drop_nulls=True)
+            >>> UnpivotSpec.from_cfg({"columns": "HR", "variable_name": "vital", "drop_nulls": False})
+            UnpivotSpec(columns=('HR',), variable_name='vital', value_name='value', drop_nulls=False)
+            >>> UnpivotSpec.from_cfg({"columns": []})
+            Traceback (most recent call last):
+                ...
+            ValueError: _unpivot.columns must be a non-empty list of column names. Got [].
+            >>> UnpivotSpec.from_cfg({"columns": ["HR"], "value": "v"})
+            Traceback (most recent call last):
+                ...
+            ValueError: Unrecognized _unpivot keys: value. Allowed keys are columns, drop_nulls, value_name,
+            variable_name.
+        """
+        if OmegaConf.is_config(unpivot_cfg):
+            unpivot_cfg = OmegaConf.to_container(unpivot_cfg, resolve=True)
+        if not isinstance(unpivot_cfg, dict):
+            unpivot_cfg = {"columns": unpivot_cfg}
+        unpivot_cfg = dict(unpivot_cfg)
+
+        allowed = {"columns", "variable_name", "value_name", "drop_nulls"}
+        if extra := set(unpivot_cfg) - allowed:
+            raise ValueError(
+                f"Unrecognized _unpivot keys: {', '.join(sorted(extra))}. "
+                f"Allowed keys are {', '.join(sorted(allowed))}."
+            )
+
+        columns = unpivot_cfg.pop("columns", None)
+        if isinstance(columns, str):
+            columns = [columns]
+        if not columns or not all(isinstance(c, str) for c in columns):
+            raise ValueError(f"_unpivot.columns must be a non-empty list of column names. Got {columns}.")
+        return cls(columns=tuple(columns), **unpivot_cfg)
+
+    def apply(self, df: pl.LazyFrame, index: Sequence[str]) -> pl.LazyFrame:
+        """Unpivots the value columns of ``df``, keeping the ``index`` columns on every output row.
+
+        Examples:
+            >>> df = pl.LazyFrame({"subject_id": [1, 2], "HR": [80.0, None], "SBP": [120.0, 110.0]})
+            >>> UnpivotSpec(("HR", "SBP")).apply(df, ["subject_id"]).collect()
+            shape: (3, 3)
+            ┌────────────┬──────────┬───────┐
+            │ subject_id ┆ variable ┆ value │
+            │ ---        ┆ ---      ┆ ---   │
+            │ i64        ┆ str      ┆ f64   │
+            ╞════════════╪══════════╪═══════╡
+            │ 1          ┆ HR       ┆ 80.0  │
+            │ 1          ┆ SBP      ┆ 120.0 │
+            │ 2          ┆ SBP      ┆ 110.0 │
+            └────────────┴──────────┴───────┘
+        """
+        out = df.unpivot(
+            on=list(self.columns),
+            index=list(index),
+            variable_name=self.variable_name,
+            value_name=self.value_name,
+        )
+        if self.drop_nulls:
+            out = out.filter(pl.col(self.value_name).is_not_null())
+        return out
+
+
+@dataclass(frozen=True)
+class EventPlan:
+    """The compiled form of a single MESSY event block.
+
+    Attributes:
+        exprs: The output column expressions, in output order, keyed by output column name. Always contains
+            ``subject_id``, ``code``, and ``time``.
+        columns: The input columns referenced by the event.
+        code_null_filter: A row filter dropping rows whose bare-column ``code`` is null, if the code is a
+            bare column reference.
+        time_source_columns: The input columns referenced by the ``time`` expression, or ``None`` if the
+            event is static (``time: null``). An empty tuple means ``time`` references no columns, in which
+            case rows are filtered on the ``time`` expression itself.
+        unpivot: If set, the block is extracted from the unpivoted input (see `UnpivotSpec`).
+        index_columns: For unpivoted blocks, the non-unpivoted columns the block's expressions reference.
+    """
+
+    exprs: dict[str, pl.Expr]
+    columns: frozenset[str]
+    code_null_filter: pl.Expr | None = None
+    time_source_columns: tuple[str, ...] | None = None
+    unpivot: UnpivotSpec | None = None
+    index_columns: tuple[str, ...] = ()
+
+    def source_frame(self, df: pl.LazyFrame) -> pl.LazyFrame:
+        """Returns the frame the event's expressions are evaluated on: ``df``, unpivoted if configured."""
+        if self.unpivot is None:
+            return df
+        return self.unpivot.apply(df, self.index_columns)
+
+    @property
+    def needs_schema(self) -> bool:
+        """Whether `row_filters` depends on the input schema."""
+        return bool(self.time_source_columns)
+
+    def row_filters(self, schema: pl.Schema | None = None) -> list[pl.Expr]:
+        """Returns the filters that drop rows that cannot produce a valid event.
+
+        Rows whose ``time`` source columns are null (or, for string columns, empty) are dropped. The filter
+        is on the source columns rather than on the parsed ``time`` expression to avoid a polars
+        predicate-pushdown bug where ``strptime(strict=True)`` is evaluated during parquet scanning before
+        nulls are filtered. The empty-string sentinel only applies to string (or unknown) columns, as the
+        ``!= ""`` comparison would crash on a numeric column (issue #120).
+
+        Args:
+            schema: The schema of the input frame. Only needed if `needs_schema` is true.
+
+        Examples:
+            >>> plan = compile_event({"code": "$code", "time": '$ts::"%Y-%m-%d"'})
+            >>> plan.needs_schema
+            True
+            >>> df = pl.DataFrame({
+            ...     "code": ["A", None, "C", "D"],
+            ...     "ts": ["2021-01-01", "2021-01-02", "", None],
+            ... })
+            >>> df.filter(plan.row_filters(df.schema))
+            shape: (1, 2)
+            ┌──────┬────────────┐
+            │ code ┆ ts         │
+            │ ---  ┆ ---        │
+            │ str  ┆ str        │
+            ╞══════╪════════════╡
+            │ A    ┆ 2021-01-01 │
+            └──────┴────────────┘
+            >>> df = pl.DataFrame({"code": ["A", "B"], "ts": [1, None]})
+            >>> df.filter(plan.row_filters(df.schema)).height
+            1
+            >>> compile_event({"code": "X", "time": None}).row_filters()
+            []
+        """
+        filters = []
+        if self.code_null_filter is not None:
+            filters.append(self.code_null_filter)
+
+        if self.time_source_columns is None:
+            return filters
+        if not self.time_source_columns:
+            filters.append(self.exprs["time"].is_not_null())
+            return filters
+
+        schema = schema or {}
+        ts_filters = []
+        for c in self.time_source_columns:
+            col_filter = pl.col(c).is_not_null()
+            if schema.get(c) == pl.String or schema.get(c) is None:
+                col_filter = col_filter & (pl.col(c) != pl.lit(""))
+            ts_filters.append(col_filter)
+        filters.append(pl.all_horizontal(*ts_filters))
+        return filters
+
+
+@dataclass(frozen=True)
+class PrefixPlan:
+    """The compiled form of all MESSY event blocks for one input prefix.
+
+    Attributes:
+        subject_id_col: The input column holding the subject ID. Ignored if `subject_id_expr` is set.
+        subject_id_expr: An expression computing the subject ID from the input columns, if configured.
+        transforms: Derived columns to add to the input before extracting events, if configured.
+        events: The compiled event blocks, keyed by event name.
+        columns: The sorted input columns referenced by this prefix (excluding columns that are only
+            produced by `transforms`).
+    """
+
+    subject_id_col: str
+    subject_id_expr: pl.Expr | None
+    transforms: dict[str, pl.Expr] | None
+    events: dict[str, EventPlan]
+    columns: tuple[str, ...]
+
+    def prepare(self, df: pl.LazyFrame) -> pl.LazyFrame:
+        """Adds the ``subject_id`` column and any transformed columns to the raw input frame.
+
+        Examples:
+            >>> plan = compile_prefix({"subject_id_col": "MRN", "transforms": {"y": "$x + 1"}})
+            >>> plan.prepare(pl.LazyFrame({"MRN": [1], "x": [2]})).collect()
+            shape: (1, 3)
+            ┌────────────┬─────┬─────┐
+            │ subject_id ┆ x   ┆ y   │
+            │ ---        ┆ --- ┆ --- │
+            │ i64        ┆ i64 ┆ i64 │
+            ╞════════════╪═════╪═════╡
+            │ 1          ┆ 2   ┆ 3   │
+            └────────────┴─────┴─────┘
+        """
+        if self.subject_id_expr is not None:
+            df = df.with_columns(subject_id=self.subject_id_expr)
+        elif self.subject_id_col != "subject_id":
+            df = df.rename({self.subject_id_col: "subject_id"})
+
+        if self.transforms is not None:
+            df = df.with_columns(**self.transforms)
+        return df
+
+
+@dataclass(frozen=True)
+class ExtractionPlan:
+    """The compiled form of a full MESSY config.
+
+    Attributes:
+        prefixes: The compiled per-prefix plans, keyed by input prefix.
+        config_hash: The `config_hash` of the MESSY config this plan was compiled from.
+        library_versions: The plan format and the polars and dftly versions the expressions were built
+            with; serialized expressions are only valid for the same versions.
+    """
+
+    prefixes: dict[str, PrefixPlan]
+    config_hash: str
+    library_versions: dict[str, str] = field(default_factory=dict)
+
+
+def compile_event(event_cfg: dict[str, str | None]) -> EventPlan:
+    """Compiles a single MESSY event block.
+
+    Args:
+        event_cfg: Event configuration dict. Must contain ``"code"`` and ``"time"`` keys. See
+            ``extract_event`` for the semantics of each key.
+
+    Returns:
+        The compiled `EventPlan`.
+
+    Raises:
+        KeyError: If ``code`` or ``time`` is missing.
+        ValueError: If an additional output column is not given as a string expression.
+
+    Examples:
+        >>> plan = compile_event(
+        ...     {"code": 'f"LAB//{$name}"', "time": '$ts::"%Y-%m-%d"', "numeric_value": "$v"}
+        ... )
+        >>> list(plan.exprs), sorted(plan.columns), plan.time_source_columns
+        (['subject_id', 'code', 'code_components', 'time', 'numeric_value'], ['name', 'ts', 'v'], ('ts',))
+        >>> compile_event({"time": None})
+        Traceback (most recent call last):
+            ...
+        KeyError: "Event configuration dictionary must contain 'code' key. Got: [time]."
+        >>> compile_event({"code": "X", "time": None, "numeric_value": 1})
+        Traceback (most recent call last):
+            ...
+        ValueError: For event column numeric_value, value 1 must be a string. Got <class 'int'>.
+    """
+    event_cfg = dict(event_cfg)
+    event_exprs = {"subject_id": pl.col("subject_id")}
+
+    unpivot_cfg = event_cfg.pop("_unpivot", None)
+    unpivot = UnpivotSpec.from_cfg(unpivot_cfg) if unpivot_cfg is not None else None
+
+    if "code" not in event_cfg:
+        raise KeyError(
+            f"Event configuration dictionary must contain 'code' key. Got: [{', '.join(event_cfg.keys())}]."
+        )
+    if "time" not in event_cfg:
+        raise KeyError(
+            f"Event configuration dictionary must contain 'time' key. Got: [{', '.join(event_cfg.keys())}]."
+        )
+
+    code_node = Parser()(str(event_cfg.pop("code")))
+    code_cols = code_node.referenced_columns
+    columns = set(code_cols)
+
+    # Null handling, restoring the pre-dftly behavior the dftly migration regressed (dftly string
+    # interpolation null-propagates, yielding a null ``code`` which MEDS forbids). See issue #109.
+    # A bare-column code (``code: $col``) is a bare identifier: drop the row when null. A composite
+    # code renders each null component as the literal "UNK" so a missing part (e.g. a unit) doesn't
+    # discard the whole event.
+    code_null_filter = None
+    if code_cols and type(code_node).__name__ == "Column":
+        (only_col,) = code_cols
+        code_null_filter = pl.col(only_col).is_not_null()
+        event_exprs["code"] = code_node.polars_expr
+    elif code_cols:
+        event_exprs["code"] = _null_safe_code_expr(code_node)
+    else:
+        event_exprs["code"] = code_node.polars_expr
+
+    # Store the individual (raw, typed) column values that compose the code as a struct.
+    if code_cols:
+        event_exprs["code_components"] = pl.struct(**{col: pl.col(col) for col in sorted(code_cols)})
+
+    ts_value = event_cfg.pop("time")
+    if ts_value is None:
+        event_exprs["time"] = pl.lit(None, dtype=pl.Datetime)
+        time_source_columns = None
+    else:
+        ts_node = Parser()(str(ts_value))
+        event_exprs["time"] = ts_node.polars_expr
+        time_source_columns = tuple(sorted(ts_node.referenced_columns))
+        columns.update(time_source_columns)
+
+    for k, v in event_cfg.items():
+        if k in EVENT_META_KEYS:
+            continue
+        if not isinstance(v, str):
+            raise ValueError(f"For event column {k}, value {v} must be a string. Got {type(v)}.")
+        node = Parser()(v)
+        event_exprs[k] = node.polars_expr
+        columns.update(node.referenced_columns)
+
+    index_columns = ()
+    if unpivot is not None:
+        if direct := columns & set(unpivot.columns):
+            raise ValueError(
+                f"Unpivoted columns can only be referenced via ${unpivot.variable_name} and "
+                f"${unpivot.value_name}; got direct references to {', '.join(sorted(direct))}."
+            )
+        index_columns = tuple(
+            sorted((columns - {unpivot.variable_name, unpivot.value_name}) | {"subject_id"})
+        )
+        columns = set(index_columns) | set(unpivot.columns)
+
+    return EventPlan(
+        exprs=event_exprs,
+        columns=frozenset(columns),
+        code_null_filter=code_null_filter,
+        time_source_columns=time_source_columns,
+        unpivot=unpivot,
+        index_columns=index_columns,
+    )
+
+
+def compile_prefix(event_cfgs: dict, default_subject_id_col: str = "subject_id") -> PrefixPlan:
+    """Compiles all MESSY event blocks for one input prefix.
+
+    Args:
+        event_cfgs: The MESSY config block for the prefix, including any ``subject_id_col``,
+            ``subject_id_expr``, ``transforms``, ``join``, or ``schema`` keys.
+        default_subject_id_col: The subject ID column to use if the block does not override it.
+
+    Returns:
+        The compiled `PrefixPlan`.
+
+    Raises:
+        ValueError: If any event block fails to compile, naming the offending event.
+
+    Examples:
+        >>> plan = compile_prefix({
+        ...     "subject_id_expr": "hash($mrn)",
+        ...     "transforms": {"full_time": 'f"{$date_col} {$time_col}"'},
+        ...     "dob": {"code": "BIRTH", "time": "$full_time"},
+        ... })
+        >>> list(plan.events), plan.columns
+        (['dob'], ('date_col', 'mrn', 'time_col'))
+        >>> compile_prefix({"subject_id_col": "MRN", "eye": {"code": "EYE"}}).columns
+        Traceback (most recent call last):
+            ...
+        ValueError: Error compiling event eye: "Event configuration dictionary must contain 'time' key. Got:
+        [code]."
+    """
+    if OmegaConf.is_config(event_cfgs):
+        event_cfgs = OmegaConf.to_container(event_cfgs, resolve=True)
+    event_cfgs = copy.deepcopy(dict(event_cfgs))
+
+    subject_id_col = event_cfgs.pop("subject_id_col", default_subject_id_col)
+    subject_id_expr_str = event_cfgs.pop("subject_id_expr", None)
+    transforms_cfg = event_cfgs.pop("transforms", None)
+
+    columns = set()
+    if subject_id_expr_str is not None:
+        subject_id_expr, sid_cols = compile_subject_id_expr(subject_id_expr_str)
+        columns.update(sid_cols)
+    else:
+        subject_id_expr = None
+        columns.add(subject_id_col)
+
+    transforms = None
+    transform_cols = set()
+    if transforms_cfg is not None:
+        transforms = Parser.to_polars(dict(transforms_cfg))
+        for v in transforms_cfg.values():
+            if isinstance(v, str):
+                transform_cols.update(Parser()(v).referenced_columns)
+
+    events = {}
+    for event_name, event_cfg in event_cfgs.items():
+        if event_name in EVENT_META_KEYS:
+            continue
+        try:
+            events[event_name] = compile_event(event_cfg)
+        except Exception as e:
+            raise ValueError(f"Error compiling event {event_name}: {e}") from e
+        columns.update(events[event_name].columns)
+
+    # `subject_id` and transformed columns are produced by `PrefixPlan.prepare`, not read from the input.
+    columns -= {"subject_id", *(transforms or {})}
+    columns |= transform_cols
+    if subject_id_expr is None:
+        columns.add(subject_id_col)
+
+    return PrefixPlan(
+        subject_id_col=subject_id_col,
+        subject_id_expr=subject_id_expr,
+        transforms=transforms,
+        events=events,
+        columns=tuple(sorted(columns)),
+    )
+
+
+def config_hash(event_conversion_cfg: DictConfig | dict) -> str:
+    """Returns a stable hash of the content of a MESSY config.
+
+    Examples:
+        >>> config_hash({"a": {"b": 1}, "c": 2}) == config_hash(DictConfig({"c": 2, "a": {"b": 1}}))
+        True
+        >>> config_hash({"a": 1}) == config_hash({"a": 2})
+        False
+    """
+    if OmegaConf.is_config(event_conversion_cfg):
+        event_conversion_cfg = OmegaConf.to_container(event_conversion_cfg, resolve=True)
+    payload = json.dumps(event_conversion_cfg, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _library_versions() -> dict[str, str]:
+    return {
+        "format": str(PLAN_FORMAT_VERSION),
+        "polars": pl.__version__,
+        "dftly": version("dftly"),
+    }
+
+
+def compile_plan(event_conversion_cfg: DictConfig | dict) -> ExtractionPlan:
+    """Compiles a full MESSY config.
+
+    Args:
+        event_conversion_cfg: The MESSY config, including the optional global ``subject_id_col``.
+
+    Returns:
+        The compiled `ExtractionPlan`.
+
+    Raises:
+        ValueError: If any prefix fails to compile, naming the offending prefix and event.
+
+    Examples:
+        >>> plan = compile_plan(DictConfig({
+        ...     "subject_id_col": "MRN",
+        ...     "patients": {"eye": {"code": "EYE", "time": None, "color": "$eye_color"}},
+        ...     "labs": {"subject_id_col": "pid", "lab": {"code": "$name", "time": "$ts"}},
+        ... }))
+        >>> {k: v.columns for k, v in plan.prefixes.items()}
+        {'patients': ('MRN', 'eye_color'), 'labs': ('name', 'pid', 'ts')}
+        >>> compile_plan({"labs": {"lab": {"code": "$name", "time": "$ts", "v": 3}}})
+        Traceback (most recent call last):
+            ...
+        ValueError: Error compiling MESSY config for labs: Error compiling event lab: For event column v,
+        value 3 must be a string. Got <class 'int'>.
+    """
+    if OmegaConf.is_config(event_conversion_cfg):
+        event_conversion_cfg = OmegaConf.to_container(event_conversion_cfg, resolve=True)
+    cfg_hash = config_hash(event_conversion_cfg)
+
+    event_conversion_cfg = copy.deepcopy(event_conversion_cfg)
+    default_subject_id_col = event_conversion_cfg.pop("subject_id_col", "subject_id")
+
+    prefixes = {}
+    for input_prefix, event_cfgs in event_conversion_cfg.items():
+        try:
+            prefixes[input_prefix] = compile_prefix(event_cfgs, default_subject_id_col)
+        except Exception as e:
+            raise ValueError(f"Error compiling MESSY config for {input_prefix}: {e}") from e
+
+    return ExtractionPlan(prefixes=prefixes, config_hash=cfg_hash, library_versions=_library_versions())
+
+
+def get_plan_fp(cfg: DictConfig) -> Path | None:
+    """Returns where the compiled plan for this pipeline is stored, if anywhere.
+
+    This is the pipeline-level ``extraction_plan_fp`` if set, otherwise a file in the pipeline's output
+    directory (or, failing that, next to the shards map). It is never written into the final dataset's
+    ``metadata`` directory by default.
+
+    Examples:
+        >>> get_plan_fp(DictConfig({"output_dir": "/out", "shards_map_fp": "/out/metadata/.shards.json"}))
+        PosixPath('/out/.extraction_plan.pkl')
+        >>> get_plan_fp(DictConfig({"shards_map_fp": "/shards/.shards.json"}))
+        PosixPath('/shards/.extraction_plan.pkl')
+        >>> get_plan_fp(DictConfig({"extraction_plan_fp": "/plan.pkl", "shards_map_fp": "/x.json"}))
+        PosixPath('/plan.pkl')
+        >>> print(get_plan_fp(DictConfig({})))
+        None
+    """
+    if cfg.get("extraction_plan_fp", None):
+        return Path(cfg.extraction_plan_fp)
+    if cfg.get("output_dir", None):
+        return Path(cfg.output_dir) / EXTRACTION_PLAN_FN
+    if cfg.get("shards_map_fp", None):
+        return Path(cfg.shards_map_fp).parent / EXTRACTION_PLAN_FN
+    return None
+
+
+def _unpickle(fp: Path) -> object:
+    with fp.open("rb") as f:
+        return pickle.load(f)
+
+
+def load_plan(plan_fp: Path, event_conversion_cfg: DictConfig | dict) -> ExtractionPlan | None:
+    """Loads a serialized plan, if one exists and was compiled from this config with these libraries.
+
+    The loaded plan is cached in-process (see ``MEDS_extract.shared_state``), so stages run in one process
+    share it; as plans are immutable, this is safe.
+    """
+    if not plan_fp.is_file():
+        return None
+
+    try:
+        plan = cached_load(plan_fp, _unpickle)
+    except Exception as e:  # pragma: no cover
+        logger.warning(f"Ignoring unreadable extraction plan at {plan_fp}: {e}")
+        return None
+
+    if not isinstance(plan, ExtractionPlan):  # pragma: no cover
+        logger.warning(f"Ignoring extraction plan at {plan_fp} of unexpected type {type(plan)}")
+        return None
+    if plan.library_versions != _library_versions():
+        logger.info(f"Extraction plan at {plan_fp} was compiled with {plan.library_versions}; recompiling.")
+        return None
+    if plan.config_hash != config_hash(event_conversion_cfg):
+        logger.info(f"Extraction plan at {plan_fp} was compiled from a different config; recompiling.")
+        return None
+    return plan
+
+
+def save_plan(plan: ExtractionPlan, plan_fp: Path):
+    """Atomically writes a compiled plan, so concurrent workers never read a partially-written plan."""
+    plan_fp.parent.mkdir(parents=True, exist_ok=True)
+    tmp_fp = plan_fp.with_name(f"{plan_fp.name}.{os.getpid()}.tmp")
+    with tmp_fp.open("wb") as f:
+        pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fp, plan_fp)
+
+
+def get_extraction_plan(cfg: DictConfig, event_conversion_cfg: DictConfig | dict) -> ExtractionPlan:
+    """Loads the compiled plan for this pipeline run, compiling and storing it first if needed.
+
+    Args:
+        cfg: The stage configuration; used to locate the stored plan via `get_plan_fp`.
+        event_conversion_cfg: The MESSY config the plan must correspond to.
+
+    Returns:
+        The compiled `ExtractionPlan`.
+
+    Examples:
+        >>> messy = {"data": {"ev": {"code": "$code", "time": None}}}
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     cfg = DictConfig({"output_dir": tmpdir})
+        ...     plan = get_extraction_plan(cfg, messy)
+        ...     print(sorted(p.name for p in Path(tmpdir).iterdir()))
+        ...     print(get_extraction_plan(cfg, messy).prefixes["data"].columns)
+        ...     messy["data"]["ev"]["time"] = "$ts"
+        ...     print(get_extraction_plan(cfg, messy).prefixes["data"].columns)
+        ['.extraction_plan.pkl']
+        ('code', 'subject_id')
+        ('code', 'subject_id', 'ts')
+    """
+    plan_fp = get_plan_fp(cfg)
+    if plan_fp is not None:
+        plan = load_plan(plan_fp, event_conversion_cfg)
+        if plan is not None:
+            logger.info(f"Loaded compiled extraction plan from {plan_fp}")
+            return plan
+
+    plan = compile_plan(event_conversion_cfg)
+    if plan_fp is not None:
+        save_plan(plan, plan_fp)
+        logger.info(f"Compiled extraction plan and saved it to {plan_fp}")
+    return plan
@@ -0,0 +1,131 @@
+"""Runs the stages of an extraction pipeline in a single process.
+
+``MEDS_transform-pipeline`` runs every stage as its own ``MEDS_transform-stage`` process, each of which pays
+for interpreter, Polars, pyarrow, and Hydra startup and loads the event conversion config, the shards map,
+and the compiled extraction plan anew. For single-node runs, ``run_pipeline`` (or the
+``MEDS_extract-pipeline`` command) instead composes each stage's configuration just as
+``MEDS_transform-stage`` would and calls the stage directly, so all stages share one interpreter, the
+Polars and pyarrow thread pools, and the loads cached by ``MEDS_extract.shared_state``.
+
+The outputs, including the ``<output_dir>/.logs/<stage>.done`` markers of ``MEDS_transform-pipeline``, are
+the same, so either runner can resume a run started by the other. Each stage runs as a single worker
+(``worker=0``); stage-runner parallelization configs are not used.
+"""
+
+import argparse
+import logging
+from collections.abc import Sequence
+from datetime import UTC, datetime
+from pathlib import Path
+
+import MEDS_transforms
+from hydra import compose, initialize
+from hydra.core.config_store import ConfigStore
+from MEDS_transforms.__main__ import MAIN_CFG_PATH
+from MEDS_transforms.configs import PipelineConfig
+from MEDS_transforms.stages import Stage
+from omegaconf import DictConfig, OmegaConf
+
+logger = logging.getLogger(__name__)
+
+ALL_STAGES_DONE_FN = "_all_stages.done"
+
+
+def compose_stage_cfg(
+    pipeline_cfg: PipelineConfig, stage_name: str, overrides: Sequence[str] = ()
+) -> tuple[Stage, DictConfig]:
+    """Returns the stage ``stage_name`` and the configuration ``MEDS_transform-stage`` would run it with.
+
+    Args:
+        pipeline_cfg: The pipeline configuration.
+        stage_name: The name of the stage (in the pipeline) to compose the configuration of.
+        overrides: Hydra overrides to apply, as given on the command line.
+    """
+    stage = pipeline_cfg.register_for(stage_name)
+
+    ConfigStore.instance().store(name="_main", node=OmegaConf.load(MAIN_CFG_PATH))
+
+    resolvers = {
+        "get_package_version": lambda: MEDS_transforms.__version__,
+        "get_package_name": lambda: MEDS_transforms.__package_name__,
+        "stage_name": lambda: stage_name,
+        "stage_docstring": lambda: stage.stage_docstring.replace("$", "$$"),
+    }
+    for name, resolver in resolvers.items():
+        OmegaConf.register_new_resolver(name, resolver, replace=True)
+
+    with initialize(version_base=None):
+        cfg = compose(config_name="_main", overrides=[f"stage={stage_name}", *overrides])
+    return stage, cfg
+
+
+def run_pipeline(
+    pipeline_config_fp: str | Path, overrides: Sequence[str] = (), stages: Sequence[str] | None = None
+):
+    """Runs the stages of the pipeline at ``pipeline_config_fp`` in this process.
+
+    Stages whose ``.done`` marker exists in ``<output_dir>/.logs`` are skipped, as are all stages if the
+    pipeline's ``_all_stages.done`` marker exists (unless ``stages`` is given).
+
+    Args:
+        pipeline_config_fp: The path to the pipeline configuration file, either as a raw path or with the
+            ``pkg://`` syntax.
+        overrides: Overrides of the pipeline configuration, as given to ``MEDS_transform-pipeline``.
+        stages: The stages to run, in order. Defaults to all stages of the pipeline.
+
+    Raises:
+        ValueError: If neither the pipeline configuration nor the overrides specify an ``output_dir``, or if
+            there are no stages to run.
+    """
+    pipeline_cfg = PipelineConfig.from_arg(pipeline_config_fp, list(overrides))
+    if pipeline_cfg.additional_params is None or "output_dir" not in pipeline_cfg.additional_params:
+        raise ValueError("Pipeline configuration or override must specify an 'output_dir'")
+
+    log_dir = Path(pipeline_cfg.additional_params["output_dir"]) / ".logs"
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    all_done_fp = log_dir / ALL_STAGES_DONE_FN
+    if stages is None and all_done_fp.exists():
+        logger.info("All stages are already complete. Exiting.")
+        return
+
+    stage_names = list(stages) if stages is not None else [s.name for s in pipeline_cfg.parsed_stages]
+    if not stage_names:
+        raise ValueError("Pipeline configuration must specify at least one stage.")
+
+    for stage_name in stage_names:
+        done_fp = log_dir / f"{stage_name}.done"
+        if done_fp.exists():
+            logger.info(f"Skipping stage {stage_name} as it is already complete.")
+            continue
+
+        logger.info(f"Running stage: {stage_name}")
+        start = datetime.now(tz=UTC)
+        stage, cfg = compose_stage_cfg(pipeline_cfg, stage_name, overrides)
+        stage.main(cfg)
+        done_fp.touch()
+        logger.info(f"Finished stage {stage_name} in {datetime.now(tz=UTC) - start}")
+
+    if stages is None:
+        all_done_fp.touch()
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Runs an entire pipeline in this process based on command line arguments."""
+
+    parser = argparse.ArgumentParser(description="MEDS-Extract single-process pipeline runner")
+    parser.add_argument(
+        "pipeline_config_fp",
+        help="Path to the pipeline configuration file, either as a raw path or with pkg:// syntax.",
+    )
+    parser.add_argument(
+        "--stages", nargs="+", default=None, help="The stages to run, in order. Defaults to all stages."
+    )
+    parser.add_argument(
+        "--overrides", nargs="*", default=[], help="Additional overrides for the pipeline configuration."
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    run_pipeline(args.pipeline_config_fp, args.overrides, stages=args.stages)
+    return 0
@@ -18,6 +18,9 @@ from omegaconf import DictConfig, OmegaConf
 from upath import UPath
 
 from ..dftly_bridge import EVENT_META_KEYS
+from ..plan import UnpivotSpec, get_extraction_plan
+from ..shared_state import load_event_conversion_cfg
+from ..task_queue import run_tasks
 
 logger = logging.getLogger(__name__)
 
@@ -223,6 +226,21 @@ def retrieve_columns(event_conversion_cfg: DictConfig) -> dict[str, list[str]]:
         ... })
         >>> retrieve_columns(cfg)
         {'patients': ['date_col', 'full_time', 'mrn', 'time_col']}
+
+        Unpivoted event blocks read their value columns, not the names they unpivot them into:
+
+        >>> cfg = DictConfig({
+        ...     "vitals": {
+        ...         "vital": {
+        ...             "_unpivot": {"columns": ["HR", "SBP"], "variable_name": "vital"},
+        ...             "code": 'f"VITAL//{$vital}"',
+        ...             "time": "$charttime",
+        ...             "numeric_value": "$value",
+        ...         },
+        ...     },
+        ... })
+        >>> retrieve_columns(cfg)
+        {'vitals': ['HR', 'SBP', 'charttime', 'subject_id']}
     """
 
     event_conversion_cfg = copy.deepcopy(event_conversion_cfg)
@@ -258,13 +276,23 @@ def retrieve_columns(event_conversion_cfg: DictConfig) -> dict[str, list[str]]:
         for event_name, event_cfg in event_cfgs.items():
             if event_name in EVENT_META_KEYS:
                 continue
+            event_columns = set()
             for key, value in event_cfg.items():
                 if key in EVENT_META_KEYS:
                     continue
                 if value is None:
                     continue
                 if isinstance(value, str):
-                    prefix_to_columns[input_prefix].update(extract_columns(value))
+                    event_columns.update(extract_columns(value))
+
+            unpivot_cfg = event_cfg.get("_unpivot")
+            if unpivot_cfg is not None:
+                # The unpivoted column name and value are produced by the unpivot, not read from the input.
+                unpivot = UnpivotSpec.from_cfg(unpivot_cfg)
+                event_columns -= {unpivot.variable_name, unpivot.value_name}
+                event_columns.update(unpivot.columns)
+
+            prefix_to_columns[input_prefix].update(event_columns)
 
     return {k: sorted(v) for k, v in prefix_to_columns.items()}
 
@@ -342,7 +370,11 @@ def main(cfg: DictConfig):
     if not event_conversion_cfg_fp.exists():
         raise FileNotFoundError(f"Event conversion config file not found: {event_conversion_cfg_fp}")
     logger.info(f"Reading event conversion config from {event_conversion_cfg_fp} to identify needed columns.")
-    event_conversion_cfg = OmegaConf.load(event_conversion_cfg_fp)
+    event_conversion_cfg = load_event_conversion_cfg(event_conversion_cfg_fp)
+
+    # Compile the extraction plan (and store it for the later stages) before touching any data, so that
+    # errors in the event conversion config surface immediately rather than in the event conversion stage.
+    get_extraction_plan(cfg, event_conversion_cfg)
 
     prefix_to_columns = retrieve_columns(event_conversion_cfg)
 
@@ -380,6 +412,7 @@ def main(cfg: DictConfig):
     cloud_io_storage_options = OmegaConf.to_container(raw_opts) if OmegaConf.is_config(raw_opts) else raw_opts
 
     start = datetime.now(tz=UTC)
+    tasks = []
     for input_file in input_files_to_subshard:
         columns = prefix_to_columns[get_shard_prefix(raw_cohort_dir, input_file)]
 
@@ -415,24 +448,29 @@ def main(cfg: DictConfig):
         logger.info(f"Read {row_count} rows from {input_file.resolve()!s}.")
 
         row_shards = list(range(0, row_count, row_chunksize))
-        random.shuffle(row_shards)
         logger.info(f"Splitting {input_file} into {len(row_shards)} row-chunks of size {row_chunksize}.")
 
-        for i, st in enumerate(row_shards):
+        for st in row_shards:
             end = min(st + row_chunksize, row_count)
             out_fp = out_dir / f"[{st}-{end}).parquet"
 
             compute_fn = partial(filter_to_row_chunk, start=st, end=end)
-            logger.info(
-                f"Writing file {i + 1}/{len(row_shards)}: {input_file} row-chunk [{st}-{end}) to {out_fp}."
-            )
-            rwlock_wrap(
-                input_file,
-                out_fp,
-                partial(scan_with_row_idx, **scan_kwargs),
-                write_df,
-                compute_fn,
-                do_overwrite=cfg.do_overwrite,
+            task_key = f"{get_shard_prefix(raw_cohort_dir, input_file)}/[{st}-{end})"
+            tasks.append(
+                (
+                    task_key,
+                    partial(
+                        rwlock_wrap,
+                        input_file,
+                        out_fp,
+                        partial(scan_with_row_idx, **scan_kwargs),
+                        write_df,
+                        compute_fn,
+                        do_overwrite=cfg.do_overwrite,
+                    ),
+                )
             )
-    end = datetime.now(tz=UTC)
+
+    logger.info(f"Writing {len(tasks)} row-chunks across {len(input_files_to_subshard)} files.")
+    run_tasks(cfg, tasks)
     logger.info(f"Sub-sharding completed in {datetime.now(tz=UTC) - start}")
@@ -0,0 +1,100 @@
+"""Process-level caches of the files that many stages of a pipeline load.
+
+Most stages read the event conversion config, several read the shards map, and the event-processing stages
+load the compiled extraction plan. When each stage runs as its own process, each loads these once; when the
+stages run in a single process (see ``MEDS_extract.runner``), these caches let them share one load instead.
+
+Entries are keyed by each file's resolved path, size, and modification time, so a file that is rewritten
+(e.g., the shards map, by ``split_and_shard_subjects``) is loaded anew; only the latest load of each file is
+kept.
+"""
+
+import copy
+import json
+import logging
+import threading
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from omegaconf import DictConfig, OmegaConf
+
+logger = logging.getLogger(__name__)
+
+_CACHE: dict[tuple[Callable, str], tuple[tuple[int, int], Any]] = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def cached_load[T](fp: Path, loader: Callable[[Path], T]) -> T:
+    """Returns ``loader(fp)``, reusing the result of an earlier call if ``fp`` has not changed since.
+
+    Callers must not modify the returned object, as it is shared with every later call.
+
+    Examples:
+        >>> calls = []
+        >>> def loader(fp):
+        ...     calls.append(fp.name)
+        ...     return fp.read_text()
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "data.txt"
+        ...     _ = fp.write_text("a")
+        ...     print(cached_load(fp, loader), cached_load(fp, loader), len(calls))
+        ...     _ = fp.write_text("bb")
+        ...     print(cached_load(fp, loader), len(calls))
+        a a 1
+        bb 2
+    """
+    fp = Path(fp)
+    stat = fp.stat()
+    key = (loader, str(fp.resolve()))
+    version = (stat.st_size, stat.st_mtime_ns)
+
+    with _CACHE_LOCK:
+        cached = _CACHE.get(key)
+    if cached is not None and cached[0] == version:
+        logger.debug(f"Reusing the loaded {fp}")
+        return cached[1]
+
+    value = loader(fp)
+    with _CACHE_LOCK:
+        _CACHE[key] = (version, value)
+    return value
+
+
+def clear_cache():
+    """Drops all cached loads."""
+    with _CACHE_LOCK:
+        _CACHE.clear()
+
+
+def _read_json(fp: Path) -> Any:
+    return json.loads(fp.read_text())
+
+
+def load_event_conversion_cfg(fp: Path) -> DictConfig:
+    """Returns a (freely modifiable) copy of the event conversion config at ``fp``.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / "event_cfgs.yaml"
+        ...     _ = fp.write_text("subject_id_col: MRN\\ndata:\\n  ev:\\n    code: $code\\n")
+        ...     cfg = load_event_conversion_cfg(fp)
+        ...     print(cfg.pop("subject_id_col"), list(cfg))
+        ...     print(list(load_event_conversion_cfg(fp)))
+        MRN ['data']
+        ['subject_id_col', 'data']
+    """
+    return copy.deepcopy(cached_load(fp, OmegaConf.load))
+
+
+def load_shards_map(fp: Path) -> dict[str, list]:
+    """Returns the shards map (from shard names to subject IDs) at ``fp``; the subject lists are shared.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     fp = Path(tmpdir) / ".shards.json"
+        ...     _ = fp.write_text(json.dumps({"train/0": [1, 2], "held_out/0": [3]}))
+        ...     print(load_shards_map(fp))
+        {'train/0': [1, 2], 'held_out/0': [3]}
+    """
+    return dict(cached_load(fp, _read_json))
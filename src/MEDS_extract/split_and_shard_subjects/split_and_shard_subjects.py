@@ -9,6 +9,8 @@ import polars as pl
 from MEDS_transforms.stages import Stage
 from omegaconf import DictConfig, OmegaConf
 
+from ..shared_state import load_event_conversion_cfg
+
 logger = logging.getLogger(__name__)
 
 
@@ -227,7 +229,7 @@ def main(cfg: DictConfig):
     logger.info(
         f"Reading event conversion config from {event_conversion_cfg_fp} (needed for subject ID columns)"
     )
-    event_conversion_cfg = OmegaConf.load(event_conversion_cfg_fp)
+    event_conversion_cfg = load_event_conversion_cfg(event_conversion_cfg_fp)
     logger.info(f"Event conversion config:\n{OmegaConf.to_yaml(event_conversion_cfg)}")
 
     dfs = []
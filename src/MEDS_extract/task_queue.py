@@ -0,0 +1,522 @@
+"""A shared-filesystem task queue for distributing a stage's tasks over parallel workers.
+
+By default, every worker of a stage iterates over every task in a random order and relies on
+``rwlock_wrap`` to skip tasks another worker currently holds. This module provides an alternative that needs
+no external service: tasks are files in a queue directory on the (shared) filesystem, and workers claim them
+via an atomic ``rename`` from ``pending/`` into ``claimed/``. Exactly one worker can win that rename, so no
+work is duplicated and no worker wastes time probing held locks. Claimed tasks are kept alive by a
+heartbeat; tasks whose heartbeat goes stale (e.g., because their worker crashed) are moved back into
+``pending/`` for another worker to pick up. Completed tasks leave a JSON marker in ``done/`` recording which
+worker ran them and how long they took.
+
+On a single machine, a stage can instead be run by a single worker that dispatches its tasks over a pool of
+local processes (``executor: local_pool``; see ``run_local_pool``), which needs neither a launcher for the
+parallel workers nor any coordination between them.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import threading
+import time
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from typing import Any
+from urllib.parse import quote, unquote
+
+import polars as pl
+from omegaconf import DictConfig
+
+logger = logging.getLogger(__name__)
+
+TASK_QUEUE_DIRNAME = ".task_queue"
+
+EXECUTORS = ("serial", "local_pool")
+DEFAULT_EXECUTOR = "serial"
+
+
+class TaskQueue:
+    """A task queue backed by a directory on a (possibly shared) filesystem.
+
+    Args:
+        root: The directory holding the queue state. It will be created if it does not exist.
+        worker: An identifier for the worker using this queue object; recorded in claim and done markers.
+        heartbeat_interval: How often (in seconds) a worker refreshes the claim markers of its running tasks.
+            Idle workers also poll at this interval while waiting on tasks claimed by others.
+        stale_after: How long (in seconds) a claim marker may go without a heartbeat before its task is
+            considered abandoned and is re-queued.
+
+    Examples:
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     queue = TaskQueue(Path(tmpdir), worker=0)
+        ...     print(queue.enqueue(["train/0/patients", "train/0/labs"]))
+        ...     print(queue.enqueue(["train/0/patients", "held_out/0/labs"]))
+        ...     print(sorted(queue.pending()))
+        ...     claims = [queue.claim() for _ in range(4)]
+        ...     print(sorted(claims[:3]), claims[3])
+        ...     print(sorted(queue.claimed()))
+        ...     queue.complete("train/0/labs", start=datetime(2024, 1, 1, tzinfo=UTC), computed=True)
+        ...     queue.release("held_out/0/labs")
+        ...     print(queue.enqueue(["train/0/labs"]), queue.pending(), sorted(queue.claimed()))
+        ...     print(queue.is_done("train/0/labs"), queue.timings()["train/0/labs"]["worker"])
+        2
+        1
+        ['held_out/0/labs', 'train/0/labs', 'train/0/patients']
+        ['held_out/0/labs', 'train/0/labs', 'train/0/patients'] None
+        ['held_out/0/labs', 'train/0/labs', 'train/0/patients']
+        0 ['held_out/0/labs'] ['train/0/patients']
+        True 0
+
+    Claimed tasks whose heartbeat has gone stale (e.g., because their worker crashed) are re-queued:
+
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     queue = TaskQueue(Path(tmpdir), worker=1, stale_after=0.01)
+        ...     _ = queue.enqueue(["a"])
+        ...     print(queue.claim(), queue.pending())
+        ...     time.sleep(0.05)
+        ...     print(queue.requeue_stale(), queue.pending(), queue.claimed())
+        a []
+        ['a'] ['a'] []
+
+    Tasks can be processed by a single call to `run`, which claims tasks until none remain and returns how
+    long each took. A task that raises is released back to the queue so another worker can retry it:
+
+        >>> ran = []
+        >>> def bad_task():
+        ...     raise ValueError("Oops")
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     queue = TaskQueue(Path(tmpdir), worker=0)
+        ...     queue.run({"a": lambda: ran.append("a"), "b": lambda: ran.append("b")})
+        ...     print(sorted(ran), sorted(queue.timings()))
+        ...     queue.run({"c": bad_task})
+        Traceback (most recent call last):
+            ...
+        ValueError: Oops
+        >>> print(sorted(ran))
+        ['a', 'b']
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        worker: int | str = 0,
+        heartbeat_interval: float = 30,
+        stale_after: float = 300,
+    ):
+        self.root = Path(root)
+        self.worker = str(worker)
+        self.heartbeat_interval = heartbeat_interval
+        self.stale_after = stale_after
+
+        self.pending_dir = self.root / "pending"
+        self.claimed_dir = self.root / "claimed"
+        self.done_dir = self.root / "done"
+        for d in (self.pending_dir, self.claimed_dir, self.done_dir):
+            d.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _fn(key: str) -> str:
+        return quote(key, safe="")
+
+    @staticmethod
+    def _key(fn: str) -> str:
+        return unquote(fn)
+
+    def _keys_in(self, d: Path) -> list[str]:
+        return [self._key(fp.name) for fp in d.iterdir() if not fp.name.startswith(".")]
+
+    def pending(self) -> list[str]:
+        """Returns the keys of all tasks that are waiting to be claimed."""
+        return self._keys_in(self.pending_dir)
+
+    def claimed(self) -> list[str]:
+        """Returns the keys of all tasks that are currently claimed by some worker."""
+        return self._keys_in(self.claimed_dir)
+
+    def is_done(self, key: str) -> bool:
+        return (self.done_dir / self._fn(key)).is_file()
+
+    def enqueue(self, keys: Sequence[str]) -> int:
+        """Adds the given task keys to the queue, skipping any that are already pending, claimed, or done.
+
+        Every worker can (and should) call this with the full task list; tasks only ever enter the queue once.
+        The status directories are checked in the order tasks move through them, so a task that advances
+        concurrently with this check is still seen.
+
+        Returns:
+            The number of tasks newly added to the queue.
+        """
+        n_added = 0
+        for key in keys:
+            fn = self._fn(key)
+            if any((d / fn).exists() for d in (self.pending_dir, self.claimed_dir, self.done_dir)):
+                continue
+            try:
+                with open(self.pending_dir / fn, mode="x"):
+                    pass
+            except FileExistsError:
+                continue
+            n_added += 1
+        return n_added
+
+    def claim(self) -> str | None:
+        """Atomically claims a pending task, returning its key, or `None` if no task is pending.
+
+        A rename keeps the file's modification time, which `requeue_stale` reads as the claim's last
+        heartbeat; the pending file is therefore touched before it is renamed, so it never shows up in
+        `claimed/` looking stale.
+        """
+        candidates = [fp for fp in self.pending_dir.iterdir() if not fp.name.startswith(".")]
+        random.shuffle(candidates)
+        for fp in candidates:
+            claimed_fp = self.claimed_dir / fp.name
+            try:
+                os.utime(fp)
+                os.rename(fp, claimed_fp)
+            except FileNotFoundError:
+                continue  # Another worker claimed it first.
+
+            key = self._key(fp.name)
+            if self.is_done(key):
+                claimed_fp.unlink(missing_ok=True)
+                continue
+
+            claimed_fp.write_text(
+                json.dumps(
+                    {
+                        "worker": self.worker,
+                        "host": socket.gethostname(),
+                        "pid": os.getpid(),
+                        "claimed_at": datetime.now(tz=UTC).isoformat(),
+                    }
+                )
+            )
+            return key
+        return None
+
+    def release(self, key: str):
+        """Returns a claimed task to the pending state (e.g., after it failed)."""
+        try:
+            os.rename(self.claimed_dir / self._fn(key), self.pending_dir / self._fn(key))
+        except FileNotFoundError:  # pragma: no cover
+            logger.warning(f"Task {key} was no longer claimed when released.")
+
+    def complete(self, key: str, start: datetime, computed: bool | None = None):
+        """Marks a claimed task as done, recording its timing in the done marker."""
+        end = datetime.now(tz=UTC)
+        marker = {
+            "worker": self.worker,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "duration_s": (end - start).total_seconds(),
+            "computed": computed,
+        }
+        tmp_fp = self.done_dir / f".{self._fn(key)}.{self.worker}.tmp"
+        tmp_fp.write_text(json.dumps(marker))
+        os.replace(tmp_fp, self.done_dir / self._fn(key))
+        (self.claimed_dir / self._fn(key)).unlink(missing_ok=True)
+
+    def requeue_stale(self) -> list[str]:
+        """Moves tasks whose claim heartbeat is older than `stale_after` seconds back to the pending state."""
+        requeued = []
+        now = time.time()
+        for fp in list(self.claimed_dir.iterdir()):
+            try:
+                age = now - fp.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if age <= self.stale_after:
+                continue
+            try:
+                os.rename(fp, self.pending_dir / fp.name)
+            except FileNotFoundError:
+                continue
+            key = self._key(fp.name)
+            logger.warning(f"Re-queuing task {key}; its claim has had no heartbeat for {age:.0f}s.")
+            requeued.append(key)
+        return requeued
+
+    @contextmanager
+    def _heartbeat(self, key: str) -> Iterator[None]:
+        """Periodically touches the claim marker of `key` while the context is active."""
+        stop = threading.Event()
+        claimed_fp = self.claimed_dir / self._fn(key)
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                try:
+                    os.utime(claimed_fp)
+                except FileNotFoundError:  # pragma: no cover
+                    return
+
+        thread = threading.Thread(target=beat, name=f"heartbeat-{key}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def run(self, task_fns: dict[str, Callable[[], Any]]) -> dict[str, timedelta]:
+        """Enqueues the given tasks and processes them until no task is pending or claimed.
+
+        Args:
+            task_fns: A mapping from task key to a zero-argument function executing that task. The return
+                value of the function, if a boolean, is recorded as whether the task was computed (as opposed
+                to being skipped because its output already existed).
+
+        Returns:
+            A mapping from the key of each task run by this worker to how long it took.
+        """
+        n_added = self.enqueue(list(task_fns))
+        logger.info(f"Added {n_added}/{len(task_fns)} tasks to the queue at {self.root.resolve()!s}")
+
+        durations = {}
+        while True:
+            key = self.claim()
+            if key is None:
+                if self.requeue_stale():
+                    continue
+                if not self.claimed():
+                    break
+                logger.debug(f"Waiting on {len(self.claimed())} tasks claimed by other workers.")
+                time.sleep(self.heartbeat_interval)
+                continue
+
+            if key not in task_fns:  # pragma: no cover
+                logger.warning(f"Releasing claimed task {key}, which is unknown to this worker.")
+                self.release(key)
+                time.sleep(self.heartbeat_interval)
+                continue
+
+            start = datetime.now(tz=UTC)
+            logger.info(f"Worker {self.worker} claimed task {key}")
+            try:
+                with self._heartbeat(key):
+                    out = task_fns[key]()
+            except BaseException:
+                self.release(key)
+                raise
+            self.complete(key, start=start, computed=out if isinstance(out, bool) else None)
+            durations[key] = datetime.now(tz=UTC) - start
+
+        return durations
+
+    def timings(self) -> dict[str, dict]:
+        """Returns the done marker (worker, start, end, and duration) of every completed task."""
+        out = {}
+        for fp in self.done_dir.iterdir():
+            if fp.name.startswith("."):
+                continue
+            out[self._key(fp.name)] = json.loads(fp.read_text())
+        return out
+
+
+def _init_pool_worker(log_level: int, string_cache: bool):
+    logging.basicConfig(level=log_level, format="%(asctime)s %(processName)s %(levelname)s: %(message)s")
+    if string_cache:
+        pl.enable_string_cache()
+
+
+@contextmanager
+def _polars_threads_per_worker(n_workers: int) -> Iterator[None]:
+    """Gives each of ``n_workers`` processes started in this context an equal share of the CPUs for Polars.
+
+    If ``POLARS_MAX_THREADS`` is already set, it is left as it is.
+    """
+    if "POLARS_MAX_THREADS" in os.environ:
+        yield
+        return
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // n_workers))
+    try:
+        yield
+    finally:
+        del os.environ["POLARS_MAX_THREADS"]
+
+
+def run_local_pool(
+    tasks: Sequence[tuple[str, Callable[[], Any]]], n_workers: int | None = None
+) -> dict[str, Any]:
+    """Runs the given tasks over a pool of ``n_workers`` local processes and returns their results.
+
+    Every task is dispatched, in the given order, to exactly one process; each process takes the next task as
+    soon as it finishes its last, so the tasks are spread over the processes without any of them competing
+    for the same work. The processes are started fresh (with the ``spawn`` method) rather than forked, as a
+    process forked after Polars has started its thread pool can deadlock; hence, the task functions must be
+    picklable (e.g., ``functools.partial`` objects of module-level functions). The processes use the global
+    string cache if this one does, and unless ``POLARS_MAX_THREADS`` is set, each process's Polars thread pool
+    gets an equal share of the CPUs.
+
+    A task that raises does not stop the others: all tasks are run, the error of each failed task is logged,
+    and then the error of the first failed task (in the given order) is raised.
+
+    Args:
+        tasks: A sequence of `(key, fn)` pairs, where `key` is a unique identifier for the task and `fn` is a
+            picklable, zero-argument function that executes it.
+        n_workers: The number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        A mapping from the key of each task to the value its function returned.
+
+    Examples:
+        >>> from functools import partial
+        >>> tasks = [(str(x), partial(pow, x, 2)) for x in range(5)]
+        >>> run_local_pool(tasks, n_workers=2)
+        {'0': 0, '1': 1, '2': 4, '3': 9, '4': 16}
+        >>> run_local_pool([("a", partial(pow, 2, 3)), ("b", partial(int, "x")), ("c", partial(abs, -1))])
+        Traceback (most recent call last):
+            ...
+        ValueError: invalid literal for int() with base 10: 'x'
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    keys = [key for key, _ in tasks]
+    if len(set(keys)) != len(keys):
+        raise ValueError("Task keys must be unique.")
+
+    results = {}
+    errors = {}
+    ctx = multiprocessing.get_context("spawn")
+    initargs = (logging.getLogger().getEffectiveLevel(), pl.using_string_cache())
+    with (
+        _polars_threads_per_worker(n_workers),
+        ProcessPoolExecutor(
+            max_workers=n_workers, mp_context=ctx, initializer=_init_pool_worker, initargs=initargs
+        ) as pool,
+    ):
+        futures = {pool.submit(fn): key for key, fn in tasks}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                logger.error(f"Task {key} failed: {e!r}")
+                errors[key] = e
+            else:
+                logger.info(f"Finished task {key} ({len(results) + len(errors)}/{len(futures)})")
+
+    if errors:
+        first_failed = next(key for key in keys if key in errors)
+        logger.error(f"{len(errors)}/{len(keys)} tasks failed; raising the error of task {first_failed}.")
+        raise errors[first_failed]
+
+    return {key: results[key] for key in keys}
+
+
+def run_tasks(cfg: DictConfig, tasks: Sequence[tuple[str, Callable[[], Any]]]):
+    """Runs the given stage tasks under the executor and scheduling mode configured in `cfg`.
+
+    With the `local_pool` executor, the tasks are dispatched over a pool of `cfg.n_workers` local processes
+    (see `run_local_pool`). Otherwise, if the task queue is not enabled, the tasks are run in a random order
+    and the caller's tasks are expected to guard themselves against competing workers (e.g., via
+    `rwlock_wrap`). If it is enabled, the tasks are claimed from a `TaskQueue` rooted at
+    `{cfg.stage_cfg.output_dir}/.task_queue`, or at `{cfg.stage_cfg.output_dir}/.task_queue/{run_id}` if
+    `cfg.task_queue.run_id` is set.
+
+    No worker ever clears a queue that others may already be using. Instead, a fresh start (as needed with
+    `do_overwrite`, as the tasks completed by earlier runs would otherwise be skipped) is made by giving all
+    the workers of a launch a new, shared `run_id`; workers restarted with the same `run_id` resume that
+    queue. Running with the task queue and `do_overwrite` but without a `run_id` is an error.
+
+    Args:
+        cfg: The stage configuration. The `executor` key, if present, may be `serial` (the default) or
+            `local_pool`, with `n_workers` processes. The `task_queue` key, if present, may set `enabled`,
+            `run_id`, `heartbeat_interval`, and `stale_after`.
+        tasks: A sequence of `(key, fn)` pairs, where `key` is a unique, stable identifier for the task and
+            `fn` is a zero-argument function that executes it.
+
+    Examples:
+        >>> ran = []
+        >>> tasks = [(k, lambda k=k: ran.append(k)) for k in ["a", "b", "c"]]
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     cfg = DictConfig({"stage_cfg": {"output_dir": tmpdir}, "do_overwrite": False})
+        ...     run_tasks(cfg, tasks)
+        ...     print(sorted(ran), Path(tmpdir, TASK_QUEUE_DIRNAME).exists())
+        ...     cfg.task_queue = {"enabled": True}
+        ...     run_tasks(cfg, tasks)
+        ...     print(sorted(ran), sorted(TaskQueue(Path(tmpdir, TASK_QUEUE_DIRNAME)).timings()))
+        ...     run_tasks(cfg, tasks)  # All tasks are already done, so nothing is re-run.
+        ...     print(len(ran))
+        ['a', 'b', 'c'] False
+        ['a', 'a', 'b', 'b', 'c', 'c'] ['a', 'b', 'c']
+        6
+
+    With `do_overwrite`, each launch shares a queue of its own:
+
+        >>> with tempfile.TemporaryDirectory() as tmpdir:
+        ...     cfg = DictConfig({"stage_cfg": {"output_dir": tmpdir}, "do_overwrite": True})
+        ...     cfg.task_queue = {"enabled": True, "run_id": "run_1"}
+        ...     run_tasks(cfg, tasks)
+        ...     cfg.task_queue.run_id = "run_2"
+        ...     run_tasks(cfg, tasks)
+        ...     print(len(ran), sorted(p.name for p in Path(tmpdir, TASK_QUEUE_DIRNAME).iterdir()))
+        12 ['run_1', 'run_2']
+        >>> cfg.task_queue.run_id = None
+        >>> run_tasks(cfg, tasks)
+        Traceback (most recent call last):
+            ...
+        ValueError: The task queue needs a task_queue.run_id shared by all workers when do_overwrite is set.
+        >>> run_tasks(DictConfig({"executor": "threads"}), tasks)
+        Traceback (most recent call last):
+            ...
+        ValueError: Invalid executor 'threads'; expected one of serial, local_pool.
+    """
+    queue_cfg = cfg.get("task_queue", None) or {}
+
+    executor = cfg.get("executor", None) or DEFAULT_EXECUTOR
+    if executor not in EXECUTORS:
+        raise ValueError(f"Invalid executor '{executor}'; expected one of {', '.join(EXECUTORS)}.")
+
+    if executor == "local_pool":
+        if queue_cfg.get("enabled", False):
+            raise ValueError("The task queue cannot be used with the local_pool executor.")
+        start = datetime.now(tz=UTC)
+        results = run_local_pool(tasks, n_workers=cfg.get("n_workers", None))
+        n_computed = sum(1 for out in results.values() if out is True)
+        logger.info(
+            f"Ran {len(results)} tasks ({n_computed} computed) over a local pool in "
+            f"{datetime.now(tz=UTC) - start}"
+        )
+        return
+
+    if not queue_cfg.get("enabled", False):
+        tasks = list(tasks)
+        random.shuffle(tasks)
+        for _, fn in tasks:
+            fn()
+        return
+
+    run_id = queue_cfg.get("run_id", None)
+    if run_id is None and cfg.get("do_overwrite", False):
+        raise ValueError(
+            "The task queue needs a task_queue.run_id shared by all workers when do_overwrite is set."
+        )
+
+    root = Path(cfg.stage_cfg.output_dir) / TASK_QUEUE_DIRNAME
+    if run_id is not None:
+        root = root / str(run_id)
+
+    worker = cfg.get("worker", 0)
+    queue = TaskQueue(
+        root,
+        worker=worker,
+        heartbeat_interval=queue_cfg.get("heartbeat_interval", 30),
+        stale_after=queue_cfg.get("stale_after", 300),
+    )
+
+    durations = queue.run(dict(tasks))
+
+    if durations:
+        total = sum(durations.values(), timedelta())
+        slowest = max(durations, key=durations.get)
+        logger.info(
+            f"Worker {worker} ran {len(durations)} tasks in {total} (mean {total / len(durations)}; "
+            f"slowest {slowest} at {durations[slowest]})."
+        )
+    else:
+        logger.info(f"Worker {worker} ran no tasks; all were completed by other workers.")
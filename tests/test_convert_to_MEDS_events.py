@@ -390,6 +390,69 @@ def test_convert_to_MEDS_events():
         },
     )
 
+    single_stage_tester(
+        script=CONVERT_TO_MEDS_EVENTS_SCRIPT,
+        stage_name="convert_to_MEDS_events",
+        stage_kwargs={"do_dedup_text_and_numeric": True, "compact_intermediates": True},
+        input_files={
+            **INPUTS,
+            "event_cfgs.yaml": EVENT_CFGS_YAML,
+            "metadata/.shards.json": SHARDS_JSON,
+        },
+        event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+        shards_map_fp="{input_dir}/metadata/.shards.json",
+        want_outputs=WANT_OUTPUTS,
+        test_name="Stage tester: convert_to_MEDS_events ; with dedup ; compact intermediates",
+        df_check_kwargs={
+            "check_row_order": False,
+            "check_column_order": False,
+            "check_dtypes": False,
+            "allow_extra_columns": True,
+        },
+    )
+
+    single_stage_tester(
+        script=CONVERT_TO_MEDS_EVENTS_SCRIPT,
+        stage_name="convert_to_MEDS_events",
+        stage_kwargs={"do_dedup_text_and_numeric": True, "distinct_eval": "always"},
+        input_files={
+            **INPUTS,
+            "event_cfgs.yaml": EVENT_CFGS_YAML,
+            "metadata/.shards.json": SHARDS_JSON,
+        },
+        event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+        shards_map_fp="{input_dir}/metadata/.shards.json",
+        want_outputs=WANT_OUTPUTS,
+        test_name="Stage tester: convert_to_MEDS_events ; with dedup ; distinct-value evaluation",
+        df_check_kwargs={
+            "check_row_order": False,
+            "check_column_order": False,
+            "check_dtypes": False,
+            "allow_extra_columns": True,
+        },
+    )
+
+    single_stage_tester(
+        script=CONVERT_TO_MEDS_EVENTS_SCRIPT,
+        stage_name="convert_to_MEDS_events",
+        stage_kwargs={"do_dedup_text_and_numeric": True, "sort_outputs": True},
+        input_files={
+            **INPUTS,
+            "event_cfgs.yaml": EVENT_CFGS_YAML,
+            "metadata/.shards.json": SHARDS_JSON,
+        },
+        event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+        shards_map_fp="{input_dir}/metadata/.shards.json",
+        want_outputs=WANT_OUTPUTS,
+        test_name="Stage tester: convert_to_MEDS_events ; with dedup ; sorted outputs",
+        df_check_kwargs={
+            "check_row_order": False,
+            "check_column_order": False,
+            "check_dtypes": False,
+            "allow_extra_columns": True,
+        },
+    )
+
     # If we don't provide the event_cfgs.yaml file, the script should error.
     single_stage_tester(
         script=CONVERT_TO_MEDS_EVENTS_SCRIPT,
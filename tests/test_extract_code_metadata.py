@@ -4,6 +4,9 @@ Set the bash env variable `DO_USE_LOCAL_SCRIPTS=1` to use the local py files, ra
 scripts.
 """
 
+import tempfile
+from pathlib import Path
+
 import polars as pl
 
 from tests import EXTRACT_CODE_METADATA_SCRIPT
@@ -216,3 +219,39 @@ def test_extract_code_metadata():
         shards_map_fp="{input_dir}/metadata/.shards.json",
         should_error=True,
     )
+
+
+def test_extract_code_metadata_through_cache():
+    # Reads of the raw metadata go through a Parquet cache holding only the columns the event configs use.
+    with tempfile.TemporaryDirectory() as cache_dir:
+        single_stage_tester(
+            script=EXTRACT_CODE_METADATA_SCRIPT,
+            stage_name="extract_code_metadata",
+            stage_kwargs={"metadata_cache_dir": cache_dir},
+            input_files={
+                **INPUT_SHARDS,
+                "demo_metadata.csv": DEMO_METADATA_FILE,
+                "input_metadata.csv": INPUT_METADATA_FILE.replace("loinc\n", "loinc,notes\n"),
+                "event_cfgs.yaml": EVENT_CFGS_YAML,
+                "metadata/.shards.json": SHARDS_JSON,
+            },
+            event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+            shards_map_fp="{input_dir}/metadata/.shards.json",
+            want_outputs=WANT_OUTPUTS,
+            df_check_kwargs={
+                "check_row_order": False,
+                "check_column_order": False,
+                "check_dtypes": True,
+                "allow_extra_columns": True,
+            },
+            assert_no_other_outputs=False,
+        )
+
+        cached_columns = {
+            fp.name.split(".")[0]: sorted(pl.read_parquet_schema(fp))
+            for fp in Path(cache_dir).glob("*.parquet")
+        }
+        assert cached_columns == {
+            "demo_metadata": ["description", "eye_color"],
+            "input_metadata": ["lab_code", "loinc", "title", "valueuom"],
+        }
@@ -4,8 +4,28 @@ Set the bash env variable `DO_USE_LOCAL_SCRIPTS=1` to use the local py files, ra
 scripts.
 """
 
+import shutil
+import tempfile
+from itertools import pairwise
+from pathlib import Path
+
 import polars as pl
+import pyarrow.parquet as pq
+import pytest
+from polars.testing import assert_frame_equal
 
+from MEDS_extract.finalize_MEDS_data.finalize_MEDS_data import (
+    FinalizedShard,
+    align_MEDS_batches,
+    align_MEDS_table,
+    finalize_MEDS_data,
+    read_MEDS_shard,
+    read_subject,
+    subject_batches,
+    subject_index_fp,
+    write_MEDS_shard,
+    write_MEDS_tables,
+)
 from tests import FINALIZE_DATA_SCRIPT
 from tests.utils import parse_shards_yaml, single_stage_tester
 
@@ -112,3 +132,133 @@ def test_finalize_MEDS_data():
             "check_row_order": True,
         },
     )
+
+
+def test_finalize_MEDS_data_in_batches():
+    single_stage_tester(
+        script=FINALIZE_DATA_SCRIPT,
+        stage_name="finalize_MEDS_data",
+        stage_kwargs={"batch_rows": 5},
+        input_files=INPUT_SHARDS,
+        want_outputs=WANT_OUTPUTS,
+        df_check_kwargs={
+            "check_column_order": True,
+            "check_dtypes": True,
+            "check_row_order": True,
+        },
+    )
+
+
+def test_subject_index_locates_every_subject():
+    for shard, want in WANT_OUTPUTS.items():
+        with tempfile.TemporaryDirectory() as d:
+            out_fp = Path(d) / f"{shard}.parquet"
+            write_MEDS_shard(want.to_arrow(), out_fp)
+
+            assert_frame_equal(pl.read_parquet(out_fp), want)
+            index = pl.read_ipc(subject_index_fp(out_fp))
+            assert index["subject_id"].to_list() == want["subject_id"].unique(maintain_order=True).to_list()
+            for subject_id in index["subject_id"]:
+                got = pl.from_arrow(read_subject(out_fp, subject_id))
+                assert_frame_equal(got, want.filter(pl.col("subject_id") == subject_id))
+
+
+def test_shards_are_read_optimized():
+    for shard, want in WANT_OUTPUTS.items():
+        with tempfile.TemporaryDirectory() as d:
+            out_fp = Path(d) / f"{shard}.parquet"
+            write_MEDS_shard(align_MEDS_table(want.lazy()), out_fp)
+
+            metadata = pq.ParquetFile(out_fp).metadata
+            for i in range(metadata.num_row_groups):
+                row_group = metadata.row_group(i)
+                assert [c.column_index for c in row_group.sorting_columns] == [0, 1]
+                assert all(row_group.column(j).has_column_index for j in range(row_group.num_columns))
+
+
+@pytest.mark.parametrize("finalize_output", [False, True])
+def test_pipeline_shards_are_read_optimized(finalize_output):
+    """The final shards of the example pipeline keep the layout `write_MEDS_tables` writes.
+
+    With ``finalize_output``, the shards are written by ``merge_to_MEDS_cohort``, then linked to the output.
+    """
+    from MEDS_extract.runner import run_pipeline
+
+    example_dir = Path(__file__).parent.parent / "example"
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        shutil.copytree(example_dir / "raw_data", root / "raw_data")
+        run_pipeline(
+            "pkg://MEDS_extract.configs._extract.yaml",
+            [
+                f"input_dir={root / 'raw_data'}",
+                f"output_dir={root / 'output'}",
+                f"event_conversion_config_fp={example_dir / 'event_cfg.yaml'}",
+                "dataset.name=EXAMPLE",
+                "dataset.version=1.0",
+                f"stage_configs.merge_to_MEDS_cohort.finalize_output={finalize_output}",
+            ],
+        )
+
+        data_fps = sorted((root / "output" / "data").rglob("*.parquet"))
+        assert data_fps
+        for fp in data_fps:
+            assert subject_index_fp(fp).is_file(), fp
+            metadata = pq.ParquetFile(fp).metadata
+            for i in range(metadata.num_row_groups):
+                row_group = metadata.row_group(i)
+                assert [c.column_index for c in row_group.sorting_columns] == [0, 1], fp
+                for j in range(row_group.num_columns):
+                    column = row_group.column(j)
+                    assert column.is_stats_set and column.has_column_index and column.has_offset_index, fp
+
+
+def test_finalize_in_batches_matches_whole_shard():
+    for shard, want in WANT_OUTPUTS.items():
+        with tempfile.TemporaryDirectory() as d:
+            whole_fp = Path(d) / "whole" / f"{shard}.parquet"
+            batched_fp = Path(d) / "batched" / f"{shard}.parquet"
+            write_MEDS_shard(align_MEDS_table(want.lazy()), whole_fp)
+            write_MEDS_shard(align_MEDS_batches(want.lazy(), batch_rows=5), batched_fp)
+
+            assert_frame_equal(pl.read_parquet(batched_fp), pl.read_parquet(whole_fp))
+            # Each batch closes its last row group, so only the row groups differ.
+            got_index = pl.read_ipc(subject_index_fp(batched_fp)).drop("row_group")
+            assert_frame_equal(got_index, pl.read_ipc(subject_index_fp(whole_fp)).drop("row_group"))
+
+
+def test_subject_batches_carry_subjects_across_chunks():
+    # Subjects of 1 to 7 rows, so that many straddle the chunks the frame is streamed in.
+    subject_ids = [subject_id for subject_id in range(40) for _ in range(subject_id % 7 + 1)]
+    df = pl.DataFrame({"subject_id": subject_ids, "row": range(len(subject_ids))})
+
+    for batch_rows in (1, 2, 3, 5, 8, 1000):
+        batches = list(subject_batches(df.lazy(), batch_rows=batch_rows))
+
+        assert_frame_equal(pl.concat(batches), df)
+        for batch in batches:
+            assert batch.height <= batch_rows or batch["subject_id"].n_unique() == 1
+        for before, after in pairwise(batches):
+            assert before["subject_id"][-1] != after["subject_id"][0]
+
+
+def test_finalized_shards_are_linked():
+    for shard, want in WANT_OUTPUTS.items():
+        with tempfile.TemporaryDirectory() as d:
+            in_fp = Path(d) / "in" / f"{shard}.parquet"
+            out_fp = Path(d) / "out" / f"{shard}.parquet"
+
+            # A shard finalized by the merge stage is linked to the output, not read and rewritten.
+            write_MEDS_tables([align_MEDS_table(want.lazy())], in_fp)
+            shard = read_MEDS_shard(in_fp)
+            assert isinstance(shard, FinalizedShard) and shard.fp == in_fp
+            write_MEDS_shard(finalize_MEDS_data(shard), out_fp)
+
+            assert out_fp.stat().st_ino == in_fp.stat().st_ino
+            assert_frame_equal(pl.read_parquet(out_fp), want)
+            assert_frame_equal(pl.read_ipc(subject_index_fp(out_fp)), pl.read_ipc(subject_index_fp(in_fp)))
+
+            # Any other shard is read to be finalized.
+            want.write_parquet(in_fp)
+            assert isinstance(read_MEDS_shard(in_fp), pl.LazyFrame)
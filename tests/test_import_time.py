@@ -0,0 +1,56 @@
+"""Tests that importing the package and resolving a stage stay cheap.
+
+Every stage invocation (and every parallel worker) starts a fresh interpreter that resolves its stage through
+the `MEDS_transforms.stages` entry points, so what that pulls in is paid for on every run. These tests run the
+imports in fresh interpreters under `python -X importtime` and check which modules they load.
+"""
+
+import subprocess
+import sys
+
+HEAVY_MODULES = ("polars", "pyarrow", "numpy", "dftly", "meds", "MEDS_transforms")
+
+STAGES = (
+    "shard_events",
+    "split_and_shard_subjects",
+    "convert_to_subject_sharded",
+    "convert_to_MEDS_events",
+    "merge_to_MEDS_cohort",
+    "extract_code_metadata",
+    "finalize_MEDS_metadata",
+    "finalize_MEDS_data",
+)
+
+
+def _import_times(code: str) -> dict[str, int]:
+    """Runs `code` in a fresh interpreter and returns the cumulative import time (in us) of each module."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = (part.strip() for part in line.removeprefix("import time:").split("|"))
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_package_import_is_light():
+    times = _import_times("import MEDS_extract")
+
+    heavy = [m for m in HEAVY_MODULES if m in times]
+    assert not heavy, f"`import MEDS_extract` imports {heavy} ({times['MEDS_extract']}us in total)"
+    assert not [m for m in times if m.startswith("MEDS_extract.")]
+
+
+def test_stage_entry_point_imports_only_its_stage():
+    code = (
+        "from importlib.metadata import entry_points\n"
+        "entry_points(group='MEDS_transforms.stages')['shard_events'].load()\n"
+    )
+    times = _import_times(code)
+
+    assert "MEDS_extract.shard_events.shard_events" in times
+    other_stages = [s for s in STAGES if s != "shard_events" and f"MEDS_extract.{s}" in times]
+    assert not other_stages, f"Resolving shard_events also imported the stages {other_stages}"
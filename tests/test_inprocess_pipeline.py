@@ -6,6 +6,7 @@ configs, external splits, metadata joining, and error paths.
 """
 
 import json
+import shutil
 import tempfile
 from pathlib import Path
 
@@ -132,6 +133,72 @@ data:
         assert vals == [20.0, 40.0]
 
 
+# ── convert_to_MEDS_events: unpivoted wide-table blocks ──────────────
+
+
+@pytest.mark.parametrize("streaming_sink", [False, True])
+def test_convert_to_MEDS_events_with_unpivot(streaming_sink):
+    """Tests that a single `_unpivot` block extracts one event per non-null value column."""
+    from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import main as cme_stage
+
+    event_cfg = """\
+subject_id_col: subject_id
+vitals:
+  vital:
+    _unpivot:
+      columns: [HR, SBP]
+      variable_name: vital
+    code: 'f"VITAL//{$vital}"'
+    time: '$charttime::"%Y-%m-%d"'
+    numeric_value: $value
+  visit:
+    code: VISIT
+    time: '$charttime::"%Y-%m-%d"'
+"""
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        shard_dir = root / "input" / "train" / "0"
+        shard_dir.mkdir(parents=True)
+        pl.DataFrame(
+            {
+                "subject_id": [1, 2, 2],
+                "charttime": ["2021-01-01", "2021-01-02", None],
+                "HR": [80.0, None, 70.0],
+                "SBP": [120.0, 110.0, 100.0],
+            }
+        ).write_parquet(shard_dir / "vitals.parquet")
+
+        event_cfg_fp = root / "event_cfgs.yaml"
+        event_cfg_fp.write_text(event_cfg)
+        shards_fp = root / ".shards.json"
+        shards_fp.write_text(json.dumps({"train/0": [1, 2]}))
+
+        cfg = _make_cfg(
+            {
+                "stage_cfg": {
+                    "data_input_dir": str(root / "input"),
+                    "output_dir": str(root / "output"),
+                    "do_dedup_text_and_numeric": False,
+                    "streaming_sink": streaming_sink,
+                },
+                "event_conversion_config_fp": str(event_cfg_fp),
+                "shards_map_fp": str(shards_fp),
+            }
+        )
+        cme_stage.main_fn(cfg)
+
+        df = pl.read_parquet(root / "output" / "train" / "0" / "vitals.parquet")
+        got = df.select("subject_id", "code", "numeric_value", "source_block").sort("subject_id", "code")
+        assert got.rows() == [
+            (1, "VISIT", None, "vitals/visit"),
+            (1, "VITAL//HR", 80.0, "vitals/vital"),
+            (1, "VITAL//SBP", 120.0, "vitals/vital"),
+            (2, "VISIT", None, "vitals/visit"),
+            (2, "VITAL//SBP", 110.0, "vitals/vital"),
+        ]
+
+
 # ── shard_events: skip unconfigured files (lines 358-359) ────────────
 
 
@@ -559,6 +626,77 @@ data:
         assert "; " in desc
 
 
+def test_extract_code_metadata_partitioned_reduction():
+    """Tests that reducing code metadata in hash partitions gives the same codes.parquet as reducing it whole.
+
+    With more codes than partitions, some partitions have duplicate codes (and so are aggregated) and others
+    do not, so the partitions are aggregated consistently before they are concatenated.
+    """
+    from MEDS_extract.extract_code_metadata.extract_code_metadata import main as ecm_stage
+
+    metadata_cfg = """\
+subject_id_col: subject_id
+data:
+  measurement:
+    code: $lab_code
+    _metadata:
+      source_a:
+        description: title_a
+      source_b:
+        description: title_b
+"""
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+
+        codes = ["HR", "RR", "SBP", "DBP", "TEMP"]
+        events_dir = root / "events" / "train" / "0"
+        events_dir.mkdir(parents=True)
+        events = pl.DataFrame(
+            {"subject_id": [1] * 5, "time": [None] * 5, "code": codes, "numeric_value": [None] * 5}
+        )
+        events.cast(
+            {"subject_id": pl.Int64, "time": pl.Datetime("us"), "numeric_value": pl.Float32}
+        ).write_parquet(events_dir / "data.parquet")
+
+        raw_dir = root / "raw"
+        raw_dir.mkdir()
+        (raw_dir / "source_a.csv").write_text("lab_code,title_a\n" + "".join(f"{c},{c} A\n" for c in codes))
+        (raw_dir / "source_b.csv").write_text("lab_code,title_b\nHR,Pulse Rate\n")
+
+        event_cfg_fp = root / "event_cfgs.yaml"
+        event_cfg_fp.write_text(metadata_cfg)
+        shards_fp = root / "metadata" / ".shards.json"
+        shards_fp.parent.mkdir(parents=True)
+        shards_fp.write_text(json.dumps({"train/0": [1]}))
+
+        def run(reduce_partitions: int) -> pl.DataFrame:
+            out_dir = root / f"metadata_out_{reduce_partitions}" / "metadata"
+            out_dir.mkdir(parents=True)
+            cfg = _make_cfg(
+                {
+                    "input_dir": str(raw_dir),
+                    "stage_cfg": {
+                        "data_input_dir": str(root / "events"),
+                        "output_dir": str(out_dir),
+                        "metadata_input_dir": str(root / "empty_meta"),
+                        "reducer_output_dir": str(out_dir),
+                        "description_separator": "; ",
+                        "reduce_partitions": reduce_partitions,
+                    },
+                    "event_conversion_config_fp": str(event_cfg_fp),
+                    "shards_map_fp": str(shards_fp),
+                }
+            )
+            ecm_stage.main_fn(cfg)
+            return pl.read_parquet(out_dir / "codes.parquet").sort("code")
+
+        whole = run(1)
+        partitioned = run(3)
+        assert whole.height == len(codes)
+        assert whole.equals(partitioned)
+
+
 def test_extract_code_metadata_duplicate_codes_no_description():
     """Tests aggregation of duplicate codes when metadata has no description column.
 
@@ -1267,3 +1405,429 @@ data:
         ecm_stage.main_fn(cfg)
         codes_df = pl.read_parquet(out_dir / "codes.parquet")
         assert len(codes_df) == 0
+
+
+# ── task_queue: workers claim distinct tasks and record timings ──
+
+
+def test_shard_events_with_task_queue():
+    """Tests that shard_events can distribute its row chunks through the shared-filesystem task queue."""
+    from MEDS_extract.shard_events.shard_events import main as shard_stage
+    from MEDS_extract.task_queue import TASK_QUEUE_DIRNAME, TaskQueue
+
+    minimal_cfg = """\
+subject_id_col: subject_id
+data:
+  event:
+    code: X
+    time: null
+"""
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        raw_dir = root / "raw_cohort"
+        raw_dir.mkdir()
+        pl.DataFrame({"subject_id": list(range(10))}).write_parquet(raw_dir / "data.parquet")
+
+        event_cfg_fp = root / "event_cfgs.yaml"
+        event_cfg_fp.write_text(minimal_cfg)
+
+        out_dir = root / "output" / "shard_events"
+        cfg = _make_cfg(
+            {
+                "stage": "shard_events",
+                "stage_cfg": {
+                    "data_input_dir": str(raw_dir / "data"),
+                    "output_dir": str(out_dir),
+                    "row_chunksize": 4,
+                    "infer_schema_length": 10000,
+                },
+                "event_conversion_config_fp": str(event_cfg_fp),
+                "task_queue": {
+                    "enabled": True,
+                    "run_id": "run_1",
+                    "heartbeat_interval": 0.1,
+                    "stale_after": 60,
+                },
+            }
+        )
+        shard_stage.main_fn(cfg)
+
+        # A second worker finds nothing left to do and does not rewrite any shard.
+        cfg.worker = 1
+        cfg.do_overwrite = False
+        shard_stage.main_fn(cfg)
+
+        assert sorted(fp.name for fp in (out_dir / "data").glob("*.parquet")) == [
+            "[0-4).parquet",
+            "[4-8).parquet",
+            "[8-10).parquet",
+        ]
+
+        timings = TaskQueue(out_dir / TASK_QUEUE_DIRNAME / "run_1").timings()
+        assert sorted(timings) == ["data/[0-4)", "data/[4-8)", "data/[8-10)"]
+        assert all(t["worker"] == "0" and t["computed"] for t in timings.values())
+
+
+def test_task_queue_claims_are_not_requeued_as_stale():
+    """Tests that a task claimed while another worker requeues stale claims is not requeued.
+
+    The pending files are backdated well past ``stale_after``; were a claim to keep the pending file's
+    modification time, a concurrent ``requeue_stale`` would see the fresh claim as stale and re-queue it.
+    """
+    import os
+    import threading
+    import time
+
+    from MEDS_extract.task_queue import TaskQueue
+
+    with tempfile.TemporaryDirectory() as d:
+        claimer = TaskQueue(Path(d), worker=0, stale_after=5)
+        reaper = TaskQueue(Path(d), worker=1, stale_after=5)
+        keys = [f"task_{i}" for i in range(500)]
+        claimer.enqueue(keys)
+
+        old = time.time() - 3600
+        for fp in claimer.pending_dir.iterdir():
+            os.utime(fp, (old, old))
+
+        requeued = []
+        stop = threading.Event()
+
+        def reap():
+            while not stop.is_set():
+                requeued.extend(reaper.requeue_stale())
+
+        thread = threading.Thread(target=reap)
+        thread.start()
+        try:
+            claims = []
+            while (key := claimer.claim()) is not None:
+                claims.append(key)
+        finally:
+            stop.set()
+            thread.join()
+
+        assert requeued == []
+        assert sorted(claims) == sorted(keys)
+        assert sorted(claimer.claimed()) == sorted(keys)
+
+
+# ── local_pool: a single worker dispatches a stage's tasks over local processes ──
+
+
+def test_shard_events_with_local_pool():
+    """Tests that shard_events can run its row chunks over the built-in local process pool."""
+    from MEDS_extract.shard_events.shard_events import main as shard_stage
+
+    minimal_cfg = """\
+subject_id_col: subject_id
+data:
+  event:
+    code: X
+    time: null
+"""
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        raw_dir = root / "raw_cohort"
+        raw_dir.mkdir()
+        pl.DataFrame({"subject_id": list(range(10))}).write_parquet(raw_dir / "data.parquet")
+
+        event_cfg_fp = root / "event_cfgs.yaml"
+        event_cfg_fp.write_text(minimal_cfg)
+
+        out_dir = root / "output" / "shard_events"
+        cfg = _make_cfg(
+            {
+                "stage": "shard_events",
+                "stage_cfg": {
+                    "data_input_dir": str(raw_dir / "data"),
+                    "output_dir": str(out_dir),
+                    "row_chunksize": 4,
+                    "infer_schema_length": 10000,
+                },
+                "event_conversion_config_fp": str(event_cfg_fp),
+                "executor": "local_pool",
+                "n_workers": 2,
+            }
+        )
+        shard_stage.main_fn(cfg)
+
+        out_fps = sorted((out_dir / "data").glob("*.parquet"))
+        assert [fp.name for fp in out_fps] == ["[0-4).parquet", "[4-8).parquet", "[8-10).parquet"]
+        got = pl.concat([pl.read_parquet(fp, glob=False) for fp in out_fps])
+        assert got["subject_id"].to_list() == list(range(10))
+
+        cfg.task_queue = {"enabled": True}
+        with pytest.raises(ValueError, match="cannot be used with the local_pool executor"):
+            shard_stage.main_fn(cfg)
+
+
+# ── plan: config errors surface in shard_events before any data is written ──
+
+
+def test_shard_events_validates_config_before_reading_data():
+    """Tests that shard_events compiles the MESSY config up front, storing it for later stages."""
+    from MEDS_extract.plan import EXTRACTION_PLAN_FN, ExtractionPlan, load_plan
+    from MEDS_extract.shard_events.shard_events import main as shard_stage
+
+    bad_cfg = """\
+subject_id_col: subject_id
+data:
+  event:
+    code: X
+"""
+    good_cfg = bad_cfg + "    time: $ts\n"
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        raw_dir = root / "raw_cohort"
+        raw_dir.mkdir()
+        pl.DataFrame({"subject_id": [1], "ts": ["2021-01-01"]}).write_parquet(raw_dir / "data.parquet")
+
+        event_cfg_fp = root / "event_cfgs.yaml"
+        event_cfg_fp.write_text(bad_cfg)
+
+        out_dir = root / "output" / "shard_events"
+        cfg = _make_cfg(
+            {
+                "stage": "shard_events",
+                "stage_cfg": {
+                    "data_input_dir": str(raw_dir / "data"),
+                    "output_dir": str(out_dir),
+                    "row_chunksize": 100,
+                    "infer_schema_length": 10000,
+                },
+                "event_conversion_config_fp": str(event_cfg_fp),
+                "output_dir": str(root / "output"),
+                "shards_map_fp": str(root / "output" / "metadata" / ".shards.json"),
+            }
+        )
+        with pytest.raises(ValueError, match=r"Error compiling event event: .*'time' key"):
+            shard_stage.main_fn(cfg)
+        assert not out_dir.exists()
+
+        event_cfg_fp.write_text(good_cfg)
+        shard_stage.main_fn(cfg)
+
+        assert not (root / "output" / "metadata" / EXTRACTION_PLAN_FN).exists()
+        plan = load_plan(root / "output" / EXTRACTION_PLAN_FN, OmegaConf.load(event_cfg_fp))
+        assert isinstance(plan, ExtractionPlan)
+        assert plan.prefixes["data"].columns == ("subject_id", "ts")
+
+
+# ── convert_to_MEDS_events: streaming sink fallback ──
+
+
+def test_sink_event_blocks_falls_back_per_block(monkeypatch, caplog):
+    """Tests that blocks the streaming sink cannot execute are collected, logged, and still written."""
+    from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import sink_event_blocks
+
+    real_sink = pl.LazyFrame.sink_parquet
+
+    def flaky_sink(self, path, **kwargs):
+        # Simulate a block the streaming engine can't run; the final concatenation of part files is fine.
+        if "unstreamable" in self.collect_schema() and "Parquet SCAN" not in self.explain():
+            raise pl.exceptions.InvalidOperationError("not supported by the streaming engine")
+        return real_sink(self, path, **kwargs)
+
+    monkeypatch.setattr(pl.LazyFrame, "sink_parquet", flaky_sink)
+
+    blocks = {
+        "data/a": pl.LazyFrame({"subject_id": [1], "code": ["A"]}),
+        "data/b": pl.LazyFrame({"subject_id": [2], "code": ["B"], "unstreamable": [True]}),
+    }
+    with tempfile.TemporaryDirectory() as d:
+        out_fp = Path(d) / "train" / "0" / "data.parquet"
+        with caplog.at_level("WARNING"):
+            sink_event_blocks(blocks, out_fp)
+
+        assert pl.read_parquet(out_fp).sort("subject_id").rows() == [(1, "A", None), (2, "B", True)]
+        assert [p.name for p in out_fp.parent.iterdir()] == ["data.parquet"]
+        assert "Event blocks data/b could not be streamed" in caplog.text
+
+
+def test_sink_event_blocks_raises_data_errors(monkeypatch):
+    """Tests that errors other than unsupported streaming operations are raised rather than retried."""
+    from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import sink_event_blocks
+
+    calls = []
+
+    def failing_sink(self, path, **kwargs):
+        calls.append(path)
+        raise pl.exceptions.ComputeError("bad data")
+
+    monkeypatch.setattr(pl.LazyFrame, "sink_parquet", failing_sink)
+
+    blocks = {"data/a": pl.LazyFrame({"subject_id": [1]}), "data/b": pl.LazyFrame({"subject_id": [2]})}
+    with tempfile.TemporaryDirectory() as d, pytest.raises(pl.exceptions.ComputeError, match="bad data"):
+        sink_event_blocks(blocks, Path(d) / "data.parquet")
+    assert len(calls) == 1
+
+
+# ── code sidecars: code vocabulary and partial-match metadata from per-file sidecars ──
+
+
+@pytest.mark.parametrize("code_sidecar", ["drop_components", "keep_components"])
+@pytest.mark.parametrize("streaming_sink,sort_outputs", [(False, False), (True, False), (False, True)])
+def test_partial_match_metadata_from_code_sidecars(streaming_sink, sort_outputs, code_sidecar):
+    """Metadata is built from the `code_sidecar` sidecars, whether or not events keep `code_components`."""
+    from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import SORTED_BY_METADATA_KEY
+    from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import main as cme_stage
+    from MEDS_extract.extract_code_metadata.extract_code_metadata import main as ecm_stage
+
+    event_cfg = """\
+subject_id_col: subject_id
+labs:
+  lab:
+    code: 'f"LAB//{$test_name}//{$units}"'
+    time: null
+    numeric_value: $value
+    _metadata:
+      lab_meta:
+        _match_on: test_name
+        description: title
+  visit:
+    code: VISIT
+    time: null
+"""
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        shard_dir = root / "input" / "train" / "0"
+        shard_dir.mkdir(parents=True)
+        pl.DataFrame(
+            {
+                "subject_id": [1, 2, 2],
+                "test_name": ["Glucose", "Glucose", "BUN"],
+                "units": ["mg/dL", "mmol/L", "mg/dL"],
+                "value": [100.0, 5.5, 20.0],
+            }
+        ).write_parquet(shard_dir / "labs.parquet")
+
+        event_cfg_fp = root / "event_cfgs.yaml"
+        event_cfg_fp.write_text(event_cfg)
+        shards_fp = root / "metadata" / ".shards.json"
+        shards_fp.parent.mkdir(parents=True)
+        shards_fp.write_text(json.dumps({"train/0": [1, 2]}))
+
+        cme_stage.main_fn(
+            _make_cfg(
+                {
+                    "stage_cfg": {
+                        "data_input_dir": str(root / "input"),
+                        "output_dir": str(root / "convert_to_MEDS_events"),
+                        "do_dedup_text_and_numeric": False,
+                        "streaming_sink": streaming_sink,
+                        "sort_outputs": sort_outputs,
+                        "code_sidecar": code_sidecar,
+                    },
+                    "event_conversion_config_fp": str(event_cfg_fp),
+                    "shards_map_fp": str(shards_fp),
+                }
+            )
+        )
+
+        events_fp = root / "convert_to_MEDS_events" / "train" / "0" / "labs.parquet"
+        events = pl.read_parquet(events_fp)
+        assert ("code_components" in events.columns) == (code_sidecar == "keep_components")
+        assert len(events) == 5
+        assert sorted(fp.name for fp in events_fp.parent.iterdir()) == ["labs.codes.parquet", "labs.parquet"]
+        if sort_outputs:
+            assert events["subject_id"].is_sorted()
+            assert SORTED_BY_METADATA_KEY in pl.read_parquet_metadata(events_fp)
+
+        codes = pl.read_parquet(events_fp.with_name("labs.codes.parquet"))
+        assert sorted(codes["code"].to_list()) == [
+            "LAB//BUN//mg/dL",
+            "LAB//Glucose//mg/dL",
+            "LAB//Glucose//mmol/L",
+            "VISIT",
+        ]
+
+        # Stand in for the merged cohort, which only holds the event files.
+        merged_dir = root / "data" / "train"
+        merged_dir.mkdir(parents=True)
+        shutil.copy(events_fp, merged_dir / "0.parquet")
+
+        raw_dir = root / "raw"
+        raw_dir.mkdir()
+        (raw_dir / "lab_meta.csv").write_text("test_name,title\nGlucose,Blood Glucose\n")
+
+        out_dir = root / "metadata_out" / "metadata"
+        out_dir.mkdir(parents=True)
+        ecm_stage.main_fn(
+            _make_cfg(
+                {
+                    "input_dir": str(raw_dir),
+                    "stage_cfg": {
+                        "data_input_dir": str(root / "data"),
+                        "output_dir": str(out_dir),
+                        "metadata_input_dir": str(root / "empty_meta"),
+                        "reducer_output_dir": str(out_dir),
+                        "description_separator": "\n",
+                        "code_components_dir": str(root / "convert_to_MEDS_events"),
+                    },
+                    "event_conversion_config_fp": str(event_cfg_fp),
+                    "shards_map_fp": str(shards_fp),
+                }
+            )
+        )
+
+        codes_df = pl.read_parquet(out_dir / "codes.parquet").sort("code")
+        assert codes_df.select("code", "description").rows() == [
+            ("LAB//Glucose//mg/dL", "Blood Glucose"),
+            ("LAB//Glucose//mmol/L", "Blood Glucose"),
+        ]
+
+        # The code vocabulary was reduced from the sidecars.
+        vocabulary = pl.read_parquet(out_dir / ".code_vocabulary.parquet")
+        assert sorted(vocabulary["code"].to_list()) == sorted(codes["code"].to_list())
+
+
+# ── runner: the single-process pipeline runner matches MEDS_transform-pipeline ──
+
+
+def test_run_pipeline_matches_subprocess_runner():
+    """Tests that running the example pipeline in-process writes the same data as the subprocess runner."""
+    import subprocess
+
+    from MEDS_extract.runner import run_pipeline
+
+    example_dir = Path(__file__).parent.parent / "example"
+
+    with tempfile.TemporaryDirectory() as d:
+        root = Path(d)
+        shutil.copytree(example_dir / "raw_data", root / "raw_data")
+
+        def overrides(output_dir: Path) -> list[str]:
+            return [
+                f"input_dir={root / 'raw_data'}",
+                f"output_dir={output_dir}",
+                f"event_conversion_config_fp={example_dir / 'event_cfg.yaml'}",
+                "dataset.name=EXAMPLE",
+                "dataset.version=1.0",
+            ]
+
+        pipeline_fp = "pkg://MEDS_extract.configs._extract.yaml"
+        result = subprocess.run(
+            ["MEDS_transform-pipeline", pipeline_fp, "--overrides", *overrides(root / "subprocess")],
+            capture_output=True,
+        )
+        assert result.returncode == 0, result.stderr.decode()[-500:]
+
+        run_pipeline(pipeline_fp, overrides(root / "inprocess"))
+        assert (root / "inprocess" / ".logs" / "_all_stages.done").is_file()
+
+        want_fps = sorted((root / "subprocess" / "data").rglob("*.parquet"))
+        got_fps = sorted((root / "inprocess" / "data").rglob("*.parquet"))
+        assert [fp.relative_to(root / "subprocess") for fp in want_fps] == [
+            fp.relative_to(root / "inprocess") for fp in got_fps
+        ]
+        for want_fp, got_fp in zip(want_fps, got_fps, strict=True):
+            assert pl.read_parquet(want_fp).equals(pl.read_parquet(got_fp)), got_fp
+
+        want_codes = pl.read_parquet(root / "subprocess" / "metadata" / "codes.parquet")
+        got_codes = pl.read_parquet(root / "inprocess" / "metadata" / "codes.parquet")
+        assert want_codes.sort("code").equals(got_codes.sort("code"))
@@ -4,6 +4,15 @@ Set the bash env variable `DO_USE_LOCAL_SCRIPTS=1` to use the local py files, ra
 scripts.
 """
 
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import polars as pl
+from polars.testing import assert_frame_equal
+
+from MEDS_extract.convert_to_MEDS_events.convert_to_MEDS_events import write_sorted_events
+from MEDS_extract.merge_to_MEDS_cohort.merge_to_MEDS_cohort import merge_subdirs_and_sort
 from tests import MERGE_TO_MEDS_COHORT_SCRIPT
 from tests.utils import parse_shards_yaml, single_stage_tester
 
@@ -257,6 +266,57 @@ def test_merge_to_MEDS_cohort():
         df_check_kwargs={"check_column_order": False},
     )
 
+    # Deduplicating on row fingerprints yields the same output as a full-row unique.
+    single_stage_tester(
+        script=MERGE_TO_MEDS_COHORT_SCRIPT,
+        stage_name="merge_to_MEDS_cohort",
+        stage_kwargs=None,
+        input_files={
+            **INPUT_SHARDS,
+            "event_cfgs.yaml": EVENT_CFGS_YAML,
+            "metadata/.shards.json": SHARDS_JSON,
+        },
+        event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+        shards_map_fp="{input_dir}/metadata/.shards.json",
+        # `dedup_strategy` is a pipeline-level option, which the single-stage config does not declare.
+        **{"+dedup_strategy": "hash_fingerprint"},
+        stdout_regex=r"dedup_strategy: hash_fingerprint",
+        want_outputs=WANT_OUTPUTS,
+        df_check_kwargs={"check_column_order": False},
+    )
+
+    # The multithreaded sort yields the same rows in the same order.
+    single_stage_tester(
+        script=MERGE_TO_MEDS_COHORT_SCRIPT,
+        stage_name="merge_to_MEDS_cohort",
+        stage_kwargs={"multithreaded_sort": True},
+        input_files={
+            **INPUT_SHARDS,
+            "event_cfgs.yaml": EVENT_CFGS_YAML,
+            "metadata/.shards.json": SHARDS_JSON,
+        },
+        event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+        shards_map_fp="{input_dir}/metadata/.shards.json",
+        want_outputs=WANT_OUTPUTS,
+        df_check_kwargs={"check_column_order": False},
+    )
+
+    # Merging each subject in its own range (as a tiny memory budget forces) yields the same output.
+    single_stage_tester(
+        script=MERGE_TO_MEDS_COHORT_SCRIPT,
+        stage_name="merge_to_MEDS_cohort",
+        stage_kwargs={"memory_budget_mb": 0},
+        input_files={
+            **INPUT_SHARDS,
+            "event_cfgs.yaml": EVENT_CFGS_YAML,
+            "metadata/.shards.json": SHARDS_JSON,
+        },
+        event_conversion_config_fp="{input_dir}/event_cfgs.yaml",
+        shards_map_fp="{input_dir}/metadata/.shards.json",
+        want_outputs=WANT_OUTPUTS,
+        df_check_kwargs={"check_column_order": False},
+    )
+
     # Should error without event conversion file
     single_stage_tester(
         script=MERGE_TO_MEDS_COHORT_SCRIPT,
@@ -270,3 +330,54 @@ def test_merge_to_MEDS_cohort():
         shards_map_fp="{input_dir}/metadata/.shards.json",
         should_error=True,
     )
+
+
+def test_merge_presorted_matches_sort():
+    """Merging presorted event files yields exactly the rows and order of sorting their concatenation."""
+    event_dfs = {
+        "subjects": pl.DataFrame(
+            {
+                "subject_id": [3, 1, 2, 1],
+                "time": [None, None, None, None],
+                "code": ["EYE_COLOR//BLUE", "EYE_COLOR//BROWN", "HEIGHT", "HEIGHT"],
+                "numeric_value": [None, None, 160.1, 175.3],
+            },
+            schema_overrides={"time": pl.Datetime},
+        ),
+        "admit_vitals": pl.DataFrame(
+            {
+                "subject_id": [1, 2, 1, 1, 2, 1, 1],
+                "time": [datetime(2010, 1, d) for d in (3, 1, 1, 3, 1, 1, 1)],
+                "code": ["HR", "HR", "ADMISSION", "TEMP", "ADMISSION", "HR", "HR"],
+                "numeric_value": [80.0, 90.0, None, 98.6, None, 80.0, 75.0],
+            }
+        ),
+    }
+
+    for additional_sort_by in (None, ["code"]):
+        sort_by = ["subject_id", "time", *(additional_sort_by or [])]
+        with tempfile.TemporaryDirectory() as unsorted_dir, tempfile.TemporaryDirectory() as sorted_dir:
+            for name, df in event_dfs.items():
+                df.write_parquet(Path(unsorted_dir) / f"{name}.parquet")
+                write_sorted_events(df, Path(sorted_dir) / f"{name}.parquet", sort_by=sort_by)
+
+            for unique_by in (None, "*"):
+                kwargs = {
+                    "event_subsets": list(event_dfs),
+                    "unique_by": unique_by,
+                    "additional_sort_by": additional_sort_by,
+                }
+                want = merge_subdirs_and_sort(Path(unsorted_dir), **kwargs).collect()
+                got = merge_subdirs_and_sort(Path(sorted_dir), **kwargs).collect()
+                assert_frame_equal(got, want)
+
+            # Over a unique_by subset, the first of each set of duplicates in the sorted output is retained.
+            for unique_by in (["subject_id", "time", "code"], ["subject_id", "code"]):
+                kwargs = {"event_subsets": list(event_dfs), "additional_sort_by": additional_sort_by}
+                want = (
+                    merge_subdirs_and_sort(Path(unsorted_dir), unique_by=None, **kwargs)
+                    .unique(subset=unique_by, maintain_order=True)
+                    .collect()
+                )
+                got = merge_subdirs_and_sort(Path(sorted_dir), unique_by=unique_by, **kwargs).collect()
+                assert_frame_equal(got, want)